@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks the phases of maxpacker on a synthetic file tree.
+The tree is generated on a tmpfs (/dev/shm by default) from a seed, with
+a lognormal file size distribution and a mix of file contents, so the
+results are reproducible and don't depend on the disk.
+The timings are written as JSON, and two results can be compared with
+`bench.py --compare OLD.json NEW.json`.
+'''
+
+import os
+import sys
+import json
+import lzma
+import math
+import time
+import zlib
+import random
+import shutil
+import logging
+import argparse
+import platform
+
+os.environ.setdefault('HIDE_ETA', '1')
+
+import maxpacker
+
+KINDS = {
+    # kind: file extensions
+    'text': ('txt', 'py', 'html', 'csv'),
+    'random': ('bin', 'dat'),
+    'zeros': ('img', 'raw'),
+    'media': ('jpg', 'mp4', 'zip'),
+}
+
+WORDS = ('the of and to in is for on that by this with you it not or be are from at as your all have new more '
+         'an was we will home can us about if page my has search free but our one other do no information time '
+         'they site he up may what which their news out use any there see only so his when contact here business').split()
+
+def mountfstype(path):
+    '''
+    Returns the file system type of the mount point containing `path`.
+    '''
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    with open('/proc/mounts', 'r') as f:
+        for line in f:
+            fields = line.split()
+            mountpoint = fields[1].replace('\\040', ' ')
+            if (path == mountpoint or path.startswith(mountpoint.rstrip('/') + '/')) and len(mountpoint) >= len(best):
+                best, fstype = mountpoint, fields[2]
+    return fstype
+
+def parsemix(s):
+    mix = {}
+    for item in s.split(','):
+        kind, weight = item.split('=')
+        if kind not in KINDS:
+            raise ValueError('unknown content kind: ' + kind)
+        mix[kind] = float(weight)
+    return mix
+
+class TreeGenerator:
+    '''
+    Generates a file tree of `count` files in directories `depth` levels deep
+    with `fanout` subdirectories each. File sizes are lognormal around `median`
+    (capped at `maxsize`), and the contents are chosen by the weights in `mix`.
+    '''
+
+    def __init__(self, count=10000, median=4096, sigma=1.5, maxsize=64*1048576,
+                 depth=3, fanout=4, mix=None, seed=0):
+        self.count = count
+        self.median = median
+        self.sigma = sigma
+        self.maxsize = maxsize
+        self.depth = depth
+        self.fanout = fanout
+        self.mix = mix or {'text': 0.5, 'random': 0.2, 'zeros': 0.1, 'media': 0.2}
+        self.seed = seed
+        self.rnd = random.Random(seed)
+        self.textpool = self.maketext(1048576)
+        self.mediapool = self.makemedia(1048576)
+
+    def params(self):
+        return {'count': self.count, 'median': self.median, 'sigma': self.sigma, 'maxsize': self.maxsize,
+                'depth': self.depth, 'fanout': self.fanout, 'mix': self.mix, 'seed': self.seed}
+
+    def maketext(self, size):
+        words = []
+        length = 0
+        while length < size:
+            line = ' '.join(self.rnd.choice(WORDS) for i in range(self.rnd.randint(4, 16))) + '\n'
+            words.append(line)
+            length += len(line)
+        return ''.join(words).encode('ascii')[:size]
+
+    def makemedia(self, size):
+        # compressed data: looks random to the compressors, but isn't
+        data = bytearray()
+        while len(data) < size:
+            data += zlib.compress(self.rnd.randbytes(256) + self.textpool[:self.rnd.randrange(4096)], 9)
+        return bytes(data[:size])
+
+    def dirs(self):
+        dirs = ['']
+        level = ['']
+        for d in range(self.depth):
+            level = [os.path.join(parent, 'd%d' % k) for parent in level for k in range(self.fanout)]
+            dirs.extend(level)
+        return dirs
+
+    def content(self, kind, size):
+        if kind == 'zeros':
+            return bytes(size)
+        elif kind == 'random':
+            return self.rnd.randbytes(size)
+        pool = self.textpool if kind == 'text' else self.mediapool
+        chunks = []
+        while size > 0:
+            start = self.rnd.randrange(len(pool))
+            chunk = pool[start:start + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def generate(self, root):
+        '''
+        Writes the tree to `root`, and returns (number of files, total size).
+        '''
+        dirs = self.dirs()
+        for d in dirs:
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+        kinds = list(self.mix)
+        weights = [self.mix[k] for k in kinds]
+        total = 0
+        mu = math.log(self.median)
+        for i in range(self.count):
+            kind = self.rnd.choices(kinds, weights)[0]
+            size = min(int(self.rnd.lognormvariate(mu, self.sigma)), self.maxsize)
+            name = 'f%06d.%s' % (i, self.rnd.choice(KINDS[kind]))
+            with open(os.path.join(root, self.rnd.choice(dirs), name), 'wb') as f:
+                f.write(self.content(kind, size))
+            total += size
+        return self.count, total
+
+def timed(results, phase, func, *args, **kwargs):
+    start = time.perf_counter()
+    cpustart = time.process_time()
+    ret = func(*args, **kwargs)
+    wall = time.perf_counter() - start
+    result = results.setdefault(phase, {'wall': [], 'cpu': []})
+    result['wall'].append(wall)
+    result['cpu'].append(time.process_time() - cpustart)
+    return ret
+
+def makeoutput(fmt, srcbase, dst, cmd7z, jobs=1):
+    if fmt == 'copy':
+        return maxpacker.OutputCopy(srcbase, dst)
+    elif fmt == 'zip':
+        return maxpacker.OutputZip(srcbase, dst)
+    elif fmt in ('7z', 'py7zr'):
+        output = maxpacker.Output7z(srcbase, dst, cmd7z=cmd7z)
+        output.backend = 'py7zr' if fmt == 'py7zr' else 'cmd'
+        output.jobs = jobs
+        return output
+    elif fmt.startswith('tar'):
+        ext = fmt.split('.')
+        return maxpacker.OutputTar(srcbase, dst, None, ext[1] if len(ext) == 2 else None)
+    raise ValueError('unsupported output format ' + fmt)
+
+def havemodule(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+def dirsize(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+def runbench(tree, workdir, args):
+    results = {}
+    names = []
+    for i in range(args.repeat):
+        vol = maxpacker.Volume(maxpacker.LimitPacker(maxpacker.human2bytes(args.maxpartsize)), compressfunc=lzma.compress)
+        vol.samplesize = args.samplesize
+        fl, ignored, mtimes = timed(results, 'scan', vol.scanfiles, [tree], tree)
+        ffilter = maxpacker.RsyncFilter(['*.tmp', '/d0/d1/'], [])
+        timed(results, 'filter', lambda: [entry for entry in fl if ffilter(entry[0], tree)])
+        timed(results, 'estimate', vol.estimate, fl, tree)
+        parts = timed(results, 'dispatch', vol.packer.dispatch, fl)
+        timed(results, 'sort', lambda: [part.sortfile(args.sort, tree) for part in parts])
+        timed(results, 'index', lambda: list(vol.genindex(fl, [tree], ignored, parts)))
+        for fmt in args.formats.split(','):
+            if fmt == '7z' and not shutil.which(args.p7z_cmd):
+                logging.warning('%s not found, skipping 7z' % args.p7z_cmd)
+                continue
+            elif fmt == 'py7zr' and not havemodule('py7zr'):
+                logging.warning('py7zr not found, skipping py7zr')
+                continue
+            dst = os.path.join(workdir, 'out')
+            os.makedirs(dst)
+            output = makeoutput(fmt, tree, dst, args.p7z_cmd, args.jobs)
+            timed(results, 'output:' + fmt, output.output, parts)
+            results['output:' + fmt]['bytes'] = dirsize(dst)
+            shutil.rmtree(dst)
+    return results, len(parts)
+
+def summarize(results, numfiles, totalsize):
+    for phase, result in results.items():
+        best = min(result['wall'])
+        result['best'] = best
+        result['files_per_s'] = numfiles / best if best else None
+        result['bytes_per_s'] = totalsize / best if best else None
+    return results
+
+def compare(oldfile, newfile):
+    with open(oldfile, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+    with open(newfile, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+    if old['tree'] != new['tree']:
+        print('Warning: the trees are different')
+    print('phase\t\told\tnew\tchange')
+    for phase, result in new['phases'].items():
+        if phase not in old['phases']:
+            continue
+        a, b = old['phases'][phase]['best'], result['best']
+        print('%-12s\t%.3fs\t%.3fs\t%+.1f%%' % (phase, a, b, (b - a) / a * 100 if a else 0))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark maxpacker phases on a synthetic file tree on tmpfs.")
+    parser.add_argument("-d", "--dir", help="working directory, must be on tmpfs (Default: /dev/shm)", default="/dev/shm")
+    parser.add_argument("-c", "--count", help="number of files (Default: 10000)", type=int, default=10000)
+    parser.add_argument("--median", help="median file size (Default: 4K)", default="4K", metavar='SIZE')
+    parser.add_argument("--sigma", help="sigma of the lognormal file size distribution (Default: 1.5)", type=float, default=1.5)
+    parser.add_argument("--max-size", help="max file size (Default: 64M)", default="64M", metavar='SIZE')
+    parser.add_argument("--depth", help="directory depth (Default: 3)", type=int, default=3)
+    parser.add_argument("--fanout", help="subdirectories per directory (Default: 4)", type=int, default=4)
+    parser.add_argument("--mix", help="content weights of text, random, zeros, media (Default: text=0.5,random=0.2,zeros=0.1,media=0.2)", default="text=0.5,random=0.2,zeros=0.1,media=0.2")
+    parser.add_argument("--seed", help="random seed (Default: 0)", type=int, default=0)
+    parser.add_argument("-f", "--formats", help="output formats to time, separated by commas, where py7zr is 7z written in-process (Default: tar,tar.gz,zip,copy)", default="tar,tar.gz,zip,copy")
+    parser.add_argument("-s", "--maxpartsize", help="max partition size (Default: 64M)", default="64M", metavar='SIZE')
+    parser.add_argument("--samplesize", help="sample size for the compressed size estimation (Default: 1024)", type=int, default=1024)
+    parser.add_argument("--sort", help="--tar-sort level for the sort phase (Default: 2)", type=int, choices=(0, 1, 2, 3, 4, 5), default=2)
+    parser.add_argument("--p7z-cmd", help="7z program to use (Default: 7za)", default='7za')
+    parser.add_argument("-j", "--jobs", help="7z processes or py7zr threads at the same time (Default: 1)", type=int, default=1)
+    parser.add_argument("-n", "--repeat", help="runs of each phase (Default: 1)", type=int, default=1)
+    parser.add_argument("-o", "--output", help="JSON result file (Default: stdout)", metavar='FILE')
+    parser.add_argument("--keep", help="keep the generated tree", action='store_true')
+    parser.add_argument("--compare", help="compare two JSON result files instead", nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if mountfstype(args.dir) != 'tmpfs':
+        parser.error('%s is not on tmpfs' % args.dir)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    gen = TreeGenerator(args.count, maxpacker.human2bytes(args.median), args.sigma,
+                        maxpacker.human2bytes(args.max_size), args.depth, args.fanout,
+                        parsemix(args.mix), args.seed)
+    workdir = os.path.join(args.dir, 'maxpacker-bench-%d' % os.getpid())
+    tree = os.path.join(workdir, 'tree')
+    try:
+        start = time.perf_counter()
+        numfiles, totalsize = gen.generate(tree)
+        print('Generated %d files, %s in %.1fs' % (numfiles, maxpacker.sizeof_fmt(totalsize), time.perf_counter() - start), file=sys.stderr)
+        results, numparts = runbench(tree, workdir, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        'version': maxpacker.__version__,
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S %Z'),
+        'tree': dict(gen.params(), files=numfiles, bytes=totalsize),
+        'settings': {'maxpartsize': args.maxpartsize, 'samplesize': args.samplesize, 'sort': args.sort,
+                     'jobs': args.jobs, 'repeat': args.repeat, 'partitions': numparts},
+        'phases': summarize(results, numfiles, totalsize),
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Compares the archiving throughput of each file order (--tar-sort) on cold cache.
+The source files are evicted from the page cache before each run, and the
+archive is written to /dev/null, so the numbers reflect reading the source.
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+import maxpacker
+
+def evict(basedir, filelist, dropcaches=False):
+    if dropcaches:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return
+    for fn, size, estsize in filelist:
+        try:
+            fd = os.open(os.path.join(basedir, fn), os.O_RDONLY)
+        except OSError:
+            continue
+        maxpacker.fadvise(fd, 0, 0, 'DONTNEED')
+        os.close(fd)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare archiving throughput of file orders on cold cache.")
+    parser.add_argument("-f", "--format", help="tar format, can be one of 'tar', 'tar.gz', 'tar.bz2', 'tar.xz' (Default: tar)", default="tar")
+    parser.add_argument("-l", "--levels", help="sort levels to compare (Default: 0,1,2,3,4,5)", default="0,1,2,3,4,5")
+    parser.add_argument("-n", "--repeat", help="runs for each level (Default: 1)", type=int, default=1)
+    parser.add_argument("--drop-caches", help="drop all caches via /proc/sys/vm/drop_caches (needs root) instead of evicting the source files", action='store_true')
+    parser.add_argument("PATH", nargs='+', help="Paths to archive")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ext = args.format.split('.')
+    compression = ext[1] if len(ext) == 2 else None
+    basedir = maxpacker.basepath(args.PATH)
+    vol = maxpacker.Volume(maxpacker.SingleVolumePacker())
+    filelist, ignored = vol.scanpaths(args.PATH, basedir)
+    total = sum(map(maxpacker._ig1, filelist))
+    print('%d files, %s' % (len(filelist), maxpacker.sizeof_fmt(total)))
+    print('level\tsort\toutput\tthroughput')
+    for level in map(int, args.levels.split(',')):
+        for i in range(args.repeat):
+            part = maxpacker.SingleVolumePacker().dispatch(filelist)[0]
+            start = time.perf_counter()
+            part.sortfile(level, basedir)
+            sorttime = time.perf_counter() - start
+            evict(basedir, filelist, args.drop_caches)
+            output = maxpacker.OutputTar(basedir, None, None, compression, maxpacker.StreamSink(os.devnull))
+            start = time.perf_counter()
+            output.output([part])
+            elapsed = time.perf_counter() - start
+            print('%d\t%.3fs\t%.3fs\t%s/s' % (level, sorttime, elapsed, maxpacker.sizeof_fmt(total / elapsed)))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
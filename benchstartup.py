@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Measures the startup time of maxpacker with `python -X importtime`, for a
+bare `import maxpacker` and for a tiny planning run (`-f none`).
+Exits with status 1 if the time exceeds --max-ms, or if any of the modules
+that should only be imported on demand (compression, archive formats,
+subprocess, ...) are imported at startup.
+'''
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+DEFERRED = ('bz2', 'lzma', 'zlib', 'gzip', 'tarfile', 'zipfile', 'shutil',
+            'tempfile', 'subprocess', 'socket', 'hashlib', 'sqlite3')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def importtime(args, cachedir):
+    '''
+    Runs python with `args` and returns (wall ms, {module: cumulative us}).
+    '''
+    env = dict(os.environ, HIDE_ETA='1')
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    cmd = [sys.executable, '-X', 'importtime', '-X', 'pycache_prefix=' + cachedir] + args
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=HERE, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    wall = (time.perf_counter() - start) * 1000
+    if proc.returncode:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(args), proc.stderr))
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('| imported package'):
+            continue
+        fields = line[12:].split('|')
+        try:
+            modules[fields[2].strip()] = int(fields[1])
+        except ValueError:
+            pass
+    return wall, modules
+
+def bench(name, args, repeat, cachedir, top):
+    importtime(args, cachedir)  # warm up the bytecode cache
+    walls = []
+    for i in range(repeat):
+        wall, modules = importtime(args, cachedir)
+        walls.append(wall)
+    deferred = sorted(set(DEFERRED).intersection(modules))
+    print('%s: min %.1fms, median %.1fms' % (name, min(walls), statistics.median(walls)))
+    for module, us in sorted(modules.items(), key=lambda x: -x[1])[:top]:
+        print('  %8.1fms  %s' % (us / 1000, module))
+    if deferred:
+        print('  imported at startup: ' + ', '.join(deferred))
+    return min(walls), deferred
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of maxpacker.")
+    parser.add_argument("-n", "--repeat", help="runs of each case (Default: 10)", type=int, default=10)
+    parser.add_argument("-t", "--top", help="show the N slowest imports (Default: 10)", type=int, default=10)
+    parser.add_argument("--max-ms", help="fail if the best run of a case takes longer", type=float)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix='maxpacker-startup-') as tmpdir:
+        cachedir = os.path.join(tmpdir, 'pycache')
+        src = os.path.join(tmpdir, 'src')
+        os.makedirs(os.path.join(tmpdir, 'out'))
+        os.makedirs(src)
+        with open(os.path.join(src, 'file'), 'wb') as f:
+            f.write(b'maxpacker\n')
+        cases = (
+            ('import', ['-c', 'import maxpacker']),
+            ('plan', ['maxpacker.py', '-f', 'none', '-o', os.path.join(tmpdir, 'out'),
+                      '-i', os.path.join(tmpdir, 'index.txt'), src]),
+        )
+        for name, cmd in cases:
+            best, deferred = bench(name, cmd, args.repeat, cachedir, args.top)
+            if deferred or (args.max_ms and best > args.max_ms):
+                failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,8 @@
 '''
 Displays a progress meter and an ETA calculation based upon either a user supplied number (out of a total)
 or based upon a file and it's size.  In the case of a file, the position information is calculated from the
-tell() method.  The ETA is calculated by taking the average of the last 50 ETA calculations so that the numbers
-can be smoothed out.  Additionally, you can set a 'modulo' parameter that will only display a message every
+tell() method.  The ETA is smoothed with an exponential moving average over about the last 50 updates,
+which are rendered by a timer thread.  Additionally, you can set a 'modulo' parameter that will only display a message every
 N iterations (thus relieving you from having to calculate it).
 
 Marcus R Breese <marcus@breese.com>
@@ -14,8 +14,17 @@ import sys
 import datetime
 import os
 
-import threading
-import socket
+import json
+import time
+import atexit
+import signal
+import struct
+import collections
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = termios = None
 
 
 def eta_open_iter(fname, callback=None):
@@ -32,149 +41,332 @@ def eta_open_iter(fname, callback=None):
 
 
 class _NoopETA(object):
-    def __init__(self, *args, **kwargs):
-        pass
+    def __init__(self, total=0, *args, **kwargs):
+        self.total = total
 
     def done(self):
         pass
 
-    def print_status(self, *args, **kwargs):
-        pass
+    def print_status(self, current=None, *args, **kwargs):
+        if status is not None and current is not None:
+            status.progress(current, self.total)
 
 
-class _SocketETA(object):
-    def __init__(self, total, modulo=None, fileobj=None, *args, **kwargs):
-        self.total = total
-        self.started = 0
-        self.elapsed = 0
-        self.extra = ''
-        self.current = 0
-        self.last_step = 0
-        self.end = False
+class StatusServer(object):
+    """
+    A run-wide status server on a Unix socket, which lives across phases
+    and ETA instances.
 
-        try:
-            fileobj.fileobj.tell()
-            self.fileobj = fileobj.fileobj
-        except:
-            self.fileobj = fileobj
+    A client may send one request line: 'json' (default), 'prometheus' or
+    'text', or an HTTP GET request for /status (JSON) or /metrics
+    (Prometheus text format), eg.
+        curl --unix-socket SOCKET http://localhost/metrics
+    """
 
+    formats = ('json', 'prometheus', 'text')
+
+    def __init__(self, socket_fname, namespace='eta', fmt='json'):
+        self.socket_fname = socket_fname
+        self.namespace = namespace
+        self.fmt = fmt
+        self.started = time.time()
+        self.phase = None
+        self.phase_started = self.started
+        self.current = 0
+        self.total = 0
+        self.extra = ''
+        self.counters = {}
+        self.values = {}
+        self.workers = {}
+        # (time, bytes_done, files_done) to calculate the rates
+        self.samples = collections.deque(maxlen=16)
+        import threading
+        self._lock = threading.Lock()
         self._sock = None
         self._t = None
-        self.start()
+        self._shutdown = False
 
     def start(self):
-        if not self._t and not self._sock:
-            self._t = threading.Thread(target=self._start_listener, args = ())
-            self._t.daemon = True
-            self._t.start()
-
-            self._shutdown = False
-
-    def _start_listener(self):
-        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        if os.environ['SOCKET_ETA'] == '1':
-            socket_fname = "/tmp/eta-%s" % os.getpid()
-        else:
-            socket_fname = os.environ['SOCKET_ETA']
-
+        if self._t:
+            return
+        import socket
+        import threading
         try:
-            os.remove(socket_fname)
+            os.remove(self.socket_fname)
         except OSError:
             pass
-        
-        self._sock.bind(socket_fname)
-        self._sock.listen(1)
-
-        try:
-            while not self._shutdown:
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_fname)
+        self._sock.listen(4)
+        self._t = threading.Thread(target=self._serve, name='StatusServer')
+        self._t.daemon = True
+        self._t.start()
+
+    def _serve(self):
+        while not self._shutdown:
+            try:
                 conn, addr = self._sock.accept()
-                conn.sendall(self.get_status())
+            except OSError:
+                break
+            try:
+                self._handle(conn)
+            except Exception:
+                pass
+            finally:
                 conn.close()
-        except:
-            pass
 
+    def _handle(self, conn):
+        import socket
+        conn.settimeout(0.2)
         try:
-            os.remove(socket_fname)
-        except OSError:
-            pass
+            request = conn.recv(4096).decode('latin-1')
+        except socket.timeout:
+            request = ''
+        conn.settimeout(5)
+        line = request.split('\n', 1)[0].strip()
+        if line.startswith('GET '):
+            path = line.split()[1] if len(line.split()) > 1 else '/'
+            fmt = 'prometheus' if path.startswith('/metrics') else 'json'
+            body = self.render(fmt).encode('utf-8')
+            ctype = 'text/plain; version=0.0.4' if fmt == 'prometheus' else 'application/json'
+            conn.sendall(('HTTP/1.0 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n' % (ctype, len(body))).encode('latin-1') + body)
+        else:
+            conn.sendall(self.render(line if line in self.formats else self.fmt).encode('utf-8'))
 
-    def done(self):
+    def close(self):
         self._shutdown = True
         if self._sock:
+            import socket
             try:
                 self._sock.shutdown(socket.SHUT_RDWR)
-            except:
+            except OSError:
                 pass
             self._sock.close()
             self._sock = None
         if self._t:
-            self._t.join(30)
+            self._t.join(5)
             self._t = None
+        try:
+            os.remove(self.socket_fname)
+        except OSError:
+            pass
 
-    def print_status(self, current=None, extra='', *args, **kwargs):
+    def set_phase(self, phase, total=0):
+        with self._lock:
+            self.phase = phase
+            self.phase_started = time.time()
+            self.current = 0
+            self.total = total
+            self.extra = ''
+
+    def progress(self, current, total=None, extra=''):
         self.current = current
+        if total is not None:
+            self.total = total
         self.extra = extra
 
-        if self.started == 0:
-            now = datetime.datetime.now()
-            self.started = now
-            self.elapsed = 0
-
-        if self.current is None and not self.fileobj:
-            self.current = self.last_step + self.step
-            self.last_step = self.current
-
-    def get_status(self):
-        now = datetime.datetime.now()
-        td = now - self.started
-        elapsed_sec = (td.days * 86400) + td.seconds
-
-        if elapsed_sec < 0:
-            elapsed_sec = 0
-
-        elapsed_time = pretty_time(elapsed_sec)
-
-        if self.current is None and self.fileobj:
-            current = self.fileobj.tell()
-        else:
-            current = self.current
-
-        if current:
-            pct = float(current) / self.total
-            if pct > 1.0:
-                pct = 1.0
-            
-            if pct < 0:
-                est_remaining = 'Unknown'
+    def add(self, **counters):
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, **values):
+        with self._lock:
+            self.values.update(values)
+
+    def worker(self, name, **state):
+        """
+        Sets the state of a worker, or removes it without `state`.
+        """
+        with self._lock:
+            if state:
+                self.workers[name] = state
             else:
-                est_remaining = pretty_time((elapsed_sec / pct) - elapsed_sec)
+                self.workers.pop(name, None)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            counters = dict(self.counters)
+            values = dict(self.values)
+            workers = dict((k, dict(v)) for k, v in self.workers.items())
+            bytes_done = counters.get('bytes_done', 0)
+            files_done = counters.get('files_done', 0)
+            if not self.samples or now - self.samples[-1][0] >= 1:
+                self.samples.append((now, bytes_done, files_done))
+            # rates since the oldest sample in the last minute
+            first = self.samples[0]
+            for sample in self.samples:
+                if now - sample[0] <= 60:
+                    first = sample
+                    break
+        elapsed = now - self.started
+        phase_elapsed = now - self.phase_started
+        current, total = self.current, self.total
+        if current and total:
+            pct = min(float(current) / total, 1.0)
+            remaining = phase_elapsed / pct - phase_elapsed
         else:
             pct = 0
-            est_remaining = 'Unknown'
-
-        if 'JOB_ID' in os.environ:
-            jobid = 'Job ID   : %s\n' % os.environ['JOB_ID']
-        else:
-            jobid = None
-
+            remaining = None
+        dt = now - first[0]
+        status = {
+            'command': ' '.join(sys.argv),
+            'pid': os.getpid(),
+            'job_id': os.environ.get('JOB_ID'),
+            'started': self.started,
+            'elapsed': elapsed,
+            'phase': self.phase,
+            'phase_elapsed': phase_elapsed,
+            'current': current,
+            'total': total,
+            'percent': pct * 100,
+            'remaining': remaining,
+            'rate': current / phase_elapsed if phase_elapsed else 0,
+            'bytes_per_s': (bytes_done - first[1]) / dt if dt else 0,
+            'files_per_s': (files_done - first[2]) / dt if dt else 0,
+            'extra': self.extra,
+            'workers': workers,
+        }
+        status.update(values)
+        status.update(counters)
+        return status
+
+    def render(self, fmt='json'):
+        status = self.snapshot()
+        if fmt == 'prometheus':
+            return self.render_prometheus(status)
+        elif fmt == 'text':
+            return self.render_text(status)
+        return json.dumps(status) + '\n'
+
+    def render_prometheus(self, status):
+        ns = self.namespace
+        lines = []
+        typed = set()
+        def metric(name, value, mtype='gauge', labels=None):
+            if value is None:
+                return
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                return
+            if name not in typed:
+                lines.append('# TYPE %s_%s %s' % (ns, name, mtype))
+                typed.add(name)
+            if labels:
+                label = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in sorted(labels.items()))
+                lines.append('%s_%s{%s} %s' % (ns, name, label, value))
+            else:
+                lines.append('%s_%s %s' % (ns, name, value))
+        metric('start_time_seconds', status['started'])
+        metric('elapsed_seconds', status['elapsed'])
+        if status['phase']:
+            metric('phase_info', 1, labels={'phase': status['phase']})
+        for key in ('phase_elapsed', 'current', 'total', 'percent', 'remaining', 'rate', 'bytes_per_s', 'files_per_s'):
+            metric(key, status[key])
+        known = set(['command', 'pid', 'job_id', 'started', 'elapsed', 'phase', 'phase_elapsed', 'current',
+                     'total', 'percent', 'remaining', 'rate', 'bytes_per_s', 'files_per_s', 'extra', 'workers'])
+        for key, value in sorted(status.items()):
+            if key in self.counters:
+                # counters are named with a _total suffix, by the Prometheus conventions
+                metric(key + '_total', value, 'counter')
+            elif key not in known:
+                metric(key, value)
+        for name, state in sorted(status['workers'].items()):
+            labels = dict((k, v) for k, v in state.items() if not isinstance(v, (int, float)))
+            labels['worker'] = name
+            metric('worker_info', 1, labels=labels)
+            for k, v in state.items():
+                if isinstance(v, (int, float)):
+                    metric('worker_' + k, v, labels={'worker': name})
+        return '\n'.join(lines) + '\n'
+
+    def render_text(self, status):
         return """\
 %sCommand  : %s
 
 Started  : %s
 Elapsed  : %s
+Phase    : %s
 Remaining: %s
 
 Total    : %s
 Current  : %s (%.2f%%)
 %s
-""" % (jobid if jobid else '', ' '.join(sys.argv), self.started, elapsed_time, est_remaining, self.total, current, pct*100, '\n%s' % self.extra if self.extra else '')
+""" % ('Job ID   : %s\n' % status['job_id'] if status['job_id'] else '', status['command'],
+       datetime.datetime.fromtimestamp(status['started']), pretty_time(status['elapsed']),
+       status['phase'] or '', pretty_time(status['remaining']) or 'Unknown',
+       status['total'], status['current'], status['percent'],
+       '\n%s' % status['extra'] if status['extra'] else '')
+
+
+status = None
+
+
+def serve_status(socket_fname, **kwargs):
+    """
+    Starts the run-wide status server, which the ETA instances report to.
+    """
+    global status
+    if status is None:
+        status = StatusServer(socket_fname, **kwargs)
+        status.start()
+        atexit.register(status.close)
+    return status
+
+
+class _SocketETA(object):
+    """
+    Reports to the status server on the socket given by $SOCKET_ETA
+    ('1' for /tmp/eta-PID) instead of printing.
+    """
+    def __init__(self, total, modulo=None, fileobj=None, *args, **kwargs):
+        self.total = total
+        self.current = 0
+        self.last_step = 0
+        self.step = kwargs.get('step', 1)
+
+        try:
+            fileobj.fileobj.tell()
+            self.fileobj = fileobj.fileobj
+        except:
+            self.fileobj = fileobj
+
+        if os.environ['SOCKET_ETA'] == '1':
+            socket_fname = "/tmp/eta-%s" % os.getpid()
+        else:
+            socket_fname = os.environ['SOCKET_ETA']
+        serve_status(socket_fname, fmt='text')
+        status.progress(0, total)
+
+    def done(self):
+        # the server lives on for the next phase
+        status.progress(self.total, self.total)
+
+    def print_status(self, current=None, extra='', *args, **kwargs):
+        if current is None:
+            if self.fileobj:
+                current = self.fileobj.tell()
+            else:
+                current = self.last_step + self.step
+        self.current = self.last_step = current
+        status.progress(current, self.total, extra)
 
 
 class _ETA(object):
+    """
+    Prints a progress bar to stderr.
+
+    `print_status` only stores the progress, so it is cheap enough to call for
+    every item. A timer thread renders the bar every `min_ms_between_updates`
+    milliseconds. The remaining time is smoothed with an exponential moving
+    average, which weighs about the last `window` renders.
+    """
     def __init__(self, total, modulo=None, fileobj=None, window=50, step=1, prog_bar_length=20, min_ms_between_updates=None):
         self.started = datetime.datetime.now()
-        self.last = []
+        self._start_ns = time.monotonic_ns()
         self.total = total
         self.spinner = "|/-\\"
         self.spinner_pos = 0
@@ -190,9 +382,13 @@ class _ETA(object):
         self.last_len = 0
         self.step = step
         self.last_step = 0
+        self.current = None
+        self.extra = ''
         self.window = window
+        self.alpha = 2.0 / (window + 1)
+        self.smoothed = None
         self.prog_bar_length = prog_bar_length
-        
+
         if min_ms_between_updates is not None:
             self.min_ms_between_updates = min_ms_between_updates  # in milliseconds
         elif sys.stderr.isatty():
@@ -200,8 +396,12 @@ class _ETA(object):
         else:
             self.min_ms_between_updates = 10000
 
-        self._last_update = 0
-        self._started = 0
+        import threading
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._t = None
+        # the bar is rendered in the timer thread, signals are set up in this one
+        _watch_resize()
 
     def pct(self, current):
         if current < self.total:
@@ -209,71 +409,78 @@ class _ETA(object):
         return 1
 
     def ave_remaining(self, current, elapsed_sec):
-        if len(self.last) > self.window:
-            self.last = self.last[-self.window:]
         rem = self.remaining(current, elapsed_sec)
-        if rem:
-            self.last.append(rem)
-
-        acc = 0.0
-        for p in self.last:
-            acc += p
-
-        if len(self.last) > 0:
-            return acc / len(self.last)
-        else:
-            return None
+        if rem is not None:
+            if self.smoothed is None:
+                self.smoothed = rem
+            else:
+                self.smoothed += self.alpha * (rem - self.smoothed)
+        return self.smoothed
 
     def remaining(self, current, elapsed_sec):
-        # elapsed = (datetime.datetime.now() - self.started).seconds
         pct = self.pct(current)
         if pct > 0:
-            eta = elapsed_sec / self.pct(current)
+            eta = elapsed_sec / pct
         else:
             return None
 
         remaining = eta - elapsed_sec
         return remaining
 
+    def elapsed(self):
+        return (time.monotonic_ns() - self._start_ns) / 1e9
+
     def done(self, overwrite=True):
-        if overwrite:
-            sys.stderr.write('\r')
-            sys.stderr.write(' ' * self.last_len)
-            sys.stderr.write('\b' * self.last_len)
+        if self._t:
+            self._stop.set()
+            self._t.join()
+            self._t = None
+        with self._lock:
+            if overwrite:
+                sys.stderr.write('\r')
+                sys.stderr.write(' ' * self.last_len)
+                sys.stderr.write('\b' * self.last_len)
 
-        elapsed = (datetime.datetime.now() - self.started).seconds
-        sys.stderr.write("Done! (%s)\n" % pretty_time(elapsed))
-        sys.stderr.flush()
+            sys.stderr.write("Done! (%s)\n" % pretty_time(int(self.elapsed())))
+            sys.stderr.flush()
 
     def print_status(self, current=None, extra='', overwrite=True):
         self.i += 1
+        if status is not None and current is not None:
+            status.progress(current, self.total, extra)
         if self.modulo and self.i % self.modulo > 0:
             return
 
-        now = datetime.datetime.now()
+        if current is None and not self.fileobj:
+            current = self.last_step + self.step
+        if current is not None:
+            self.last_step = current
+        self.current = current
+        self.extra = extra
 
-        if self._last_update:
-            elapsed = (now - self._last_update)
-            millis = (elapsed.seconds * 1000) + (elapsed.microseconds / 1000)
-            if millis < self.min_ms_between_updates:
-                return
+        if self._t is None:
+            import threading
+            self.overwrite = overwrite
+            self._t = threading.Thread(target=self._run, name='ETA')
+            self._t.daemon = True
+            self._t.start()
 
-        self._last_update = now
+    def _run(self):
+        interval = self.min_ms_between_updates / 1000.0
+        self.render()
+        while not self._stop.wait(interval):
+            self.render()
 
-        if not self._started:
-            self._started = now
-            elapsed_sec = 0
-        else:
-            td = now - self.started
-            elapsed_sec = (td.days * 86400) + td.seconds
+    def render(self):
+        with self._lock:
+            self._render(self.overwrite)
 
+    def _render(self, overwrite=True):
+        current = self.current
         if current is None:
-            if self.fileobj:
-                current = self.fileobj.tell()
-            else:
-                current = self.last_step + self.step
-
-        self.last_step = current
+            current = self.fileobj.tell() if self.fileobj else 0
+        extra = self.extra
+        elapsed_sec = self.elapsed()
 
         if overwrite:
             sys.stderr.write("\r")
@@ -284,8 +491,8 @@ class _ETA(object):
         if extra:
             extra = " | %s" % extra
 
+        pct_current = self.pct(current)
         if self.prog_bar_length > 0:
-            pct_current = self.pct(current)
             completed = int(self.prog_bar_length * pct_current)
             remaining = self.prog_bar_length - completed
             prog_bar = '[%s>%s] ' % ('=' * completed, ' ' * (remaining - 1))
@@ -294,7 +501,7 @@ class _ETA(object):
 
         line = "%6.1f%% %s %s %sETA: %s%s" % (pct_current * 100,
                                          self.spinner[self.spinner_pos],
-                                         pretty_time(elapsed_sec),
+                                         pretty_time(int(elapsed_sec)),
                                          prog_bar,
                                          pretty_time(self.ave_remaining(current, elapsed_sec)),
                                          extra)
@@ -345,12 +552,9 @@ def pretty_time(secs):
 # http://stackoverflow.com/questions/566746/how-to-get-console-window-width-in-python
 
 
-def getTerminalSize():
+def _getTerminalSize():
     def ioctl_GWINSZ(fd):
         try:
-            import fcntl
-            import termios
-            import struct
             cr = struct.unpack('hh', fcntl.ioctl(fd, termios.TIOCGWINSZ,
         '1234'))
         except:
@@ -375,6 +579,59 @@ def getTerminalSize():
     return int(cr[1]), int(cr[0])
 
 
+_terminal_size = None
+
+
+def getTerminalSize():
+    """
+    Returns (width, height) of the terminal, cached until it is resized.
+    """
+    global _terminal_size
+    if _terminal_size is None:
+        _terminal_size = _getTerminalSize()
+    return _terminal_size
+
+
+def _sigwinch(signum, frame):
+    global _terminal_size
+    _terminal_size = None
+    if callable(_prev_sigwinch):
+        _prev_sigwinch(signum, frame)
+
+
+_prev_sigwinch = None
+_watching = False
+
+
+def _watch_resize():
+    """
+    Installs the SIGWINCH handler which resets the cached terminal size,
+    when the first progress bar is shown.
+    """
+    global _prev_sigwinch, _watching
+    if _watching or not hasattr(signal, 'SIGWINCH'):
+        return
+    try:
+        _prev_sigwinch = signal.signal(signal.SIGWINCH, _sigwinch)
+        _watching = True
+    except ValueError:
+        # not in the main thread
+        pass
+
+
+class NoopETA(object):
+    """
+    Shows nothing and reports nowhere, for library use.
+    """
+    def __init__(self, total=0, *args, **kwargs):
+        self.total = total
+
+    def done(self):
+        pass
+
+    def print_status(self, current=None, *args, **kwargs):
+        pass
+
 if 'HIDE_ETA' in os.environ:
     ETA = _NoopETA
 elif 'SOCKET_ETA' in os.environ:
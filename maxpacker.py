@@ -4,32 +4,40 @@
 import os
 import re
 import sys
-import bz2
-import zlib
-import lzma
+# Compression and archive modules (bz2, gzip, lzma, zlib, tarfile, zipfile,
+# shutil, tempfile, subprocess...) are imported where they are used, so that
+# planning runs (-f none) start fast.
+import errno
+import json
 import time
+import heapq
+import bisect
 import shlex
-import shutil
+import struct
 import fnmatch
+import weakref
+import itertools
+import io
 import logging
-import tarfile
-import zipfile
-import tempfile
+import threading
+import mmap
 import operator
+import contextlib
+import functools
+import array
 import argparse
-import subprocess
+import collections
 
-from eta import ETA
+from eta import ETA, NoopETA, serve_status
 
 __version__ = '2.1'
 
+_ig0 = operator.itemgetter(0)
 _ig1 = operator.itemgetter(1)
+_ig2 = operator.itemgetter(2)
 _psize = operator.attrgetter('size')
 
 DEFAULT_ENCODING = 'utf-8'
-tarfile.ENCODING = DEFAULT_ENCODING
-
-logging.basicConfig(stream=sys.stdout, format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
 
 exts_ord = {e:i for i,e in enumerate(
 '''7z xz lzma ace arc arj bz tbz bz2 tbz2 cab deb gz tgz ha lha lzh lzo lzx pak rar rpm sit zoo
@@ -62,6 +70,9 @@ exe dll ocx vbx sfx sys tlb awx com obj lib out o so
 pdb pch idb ncb opt'''.split(), 1)}
 exts_ord[''] = 0
 
+def fileext(filename):
+    return os.path.splitext(filename)[1].lower().lstrip('.')
+
 def splitpath(path):
     '''
     Splits a path to a list.
@@ -112,105 +123,382 @@ def sizeof_fmt(num, suffix='B'):
         num /= 1024.0
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
+def issparse(st):
+    '''
+    Checks whether a file has holes, according to its stat result.
+    '''
+    return getattr(st, 'st_blocks', None) is not None and st.st_blocks * 512 < st.st_size
+
+def dataextents(fd, size):
+    '''
+    Yields (offset, length) of the data regions of a file, skipping holes.
+    Falls back to the whole file if SEEK_DATA/SEEK_HOLE is not supported.
+    '''
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield 0, size
+        return
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                # only a hole remains
+                break
+            elif pos == 0:
+                yield 0, size
+                break
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if end > start:
+            yield start, end - start
+        pos = end
+
+def allocsize(path, st=None):
+    '''
+    Returns the number of data bytes in a file, i.e. the size without holes.
+    '''
+    st = st or os.stat(path)
+    if not issparse(st):
+        return st.st_size
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return sum(length for offset, length in dataextents(fd, st.st_size))
+    finally:
+        os.close(fd)
+
+def scantree(top, onerror=None):
+    '''
+    Walks a directory tree top-down with one os.scandir call per directory,
+    and yields (DirEntry, empty) of each entry below `top`, where `empty` is
+    None for non-directories, and whether the directory is empty otherwise.
+    A directory is yielded just before its contents, and the files of a
+    directory before its subdirectories. Symbolic links to directories are
+    yielded, but not followed. DirEntry caches stat(), so an entry is
+    stat'ed at most once. `onerror` is called with the OSError of a directory
+    that can't be read.
+    '''
+    def listdir(path):
+        try:
+            with os.scandir(path) as it:
+                return list(it)
+        except OSError as ex:
+            if onerror is not None:
+                onerror(ex)
+            return None
+
+    def isdir(entry):
+        try:
+            return entry.is_dir()
+        except OSError:
+            return False
+
+    # a stack of directory entries (or the top path) to scan
+    stack = [None]
+    while stack:
+        entry = stack.pop()
+        if entry is None:
+            entries = listdir(top)
+        elif entry.is_symlink():
+            try:
+                yield entry, not os.listdir(entry.path)
+            except OSError:
+                yield entry, False
+            continue
+        else:
+            entries = listdir(entry.path)
+            yield entry, not entries
+        if not entries:
+            continue
+        dirs = []
+        for child in entries:
+            if isdir(child):
+                dirs.append(child)
+            else:
+                yield child, None
+        stack.extend(reversed(dirs))
+
+def readsample(f, fsize, samplesize):
+    '''
+    Reads `samplesize` bytes from the middle of the data regions of `f`.
+    `fsize` is the size without holes.
+    '''
+    st = os.fstat(f.fileno())
+    if not issparse(st):
+        if fsize > samplesize:
+            f.seek((fsize - samplesize) // 2)
+        return f.read(samplesize)
+    pos = max(fsize - samplesize, 0) // 2
+    sample = []
+    remaining = samplesize
+    for offset, length in dataextents(f.fileno(), st.st_size):
+        if pos >= length:
+            pos -= length
+            continue
+        sample.append(os.pread(f.fileno(), min(length - pos, remaining), offset + pos))
+        remaining -= len(sample[-1])
+        pos = 0
+        if remaining <= 0:
+            break
+    return b''.join(sample)
+
+def estcompresssize(filename, fsize, compressfunc, samplesize=1024, factor=None, err=0.1):
+    '''
+    Estimates the compressed size of a file from a compressed sample.
+    The ratio is corrected by `factor` (see `EstimateStats`) if given,
+    or by the error margin `err` otherwise.
+    '''
+    if not fsize:
+        return 0
+    with open(filename, 'rb') as f:
+        sample = readsample(f, fsize, samplesize)
+    if not sample:
+        return 0
+    compsize = len(compressfunc(sample)) / len(sample)
+    if factor is not None:
+        return int(fsize * compsize * factor)
+    return int(fsize * compsize / (1 + err))
+
 class Volume:
 
     def __init__(self, packer, ffilter=None, indexfile='index.txt', output=None, compressfunc=None, sortfile=0):
         self.packer = packer
         self.ffilter = ffilter or TrueFilter()
-        self.indexfile = indexfile or os.devnull
-        self.output = output or OutputBase()
+        # None to skip writing the index
+        self.indexfile = indexfile
+        self.output = output or OutputBase('.', '.')
         self.compressfunc = compressfunc
         self.sortfile = sortfile
         self.totalsizelim = None
+        self.selector = Selector()
         self.samplesize = 1024
+        self.chunksize = None
+        self.indexformat = 'text'
+        self.lookupfile = None
+        # verify the archives against the checksums in the lookup table
+        self.verify = False
+        self.eststats = None
+        self.journal = None
+        self.resume = False
+        self.savescan = None
+        self.loadscan = None
+        self.store = None
+        self.metrics = None
+        # an eta.StatusServer to report the progress to
+        self.status = None
+        # a WorkQueue to distribute the partitions to workers, instead of the output
+        self.queue = None
+        # local worker processes to start for the queue
+        self.workers = 0
 
     def run(self, paths, basedir=None):
-        self.output.output(self.partition(paths, basedir=None))
+        basedir = basedir or basepath(paths)
+        parts = None
+        if self.journal and self.resume:
+            parts = self.journal.load(paths, self.output, self.store)
+            if parts is None:
+                logging.info("No complete plan to resume, starting over.")
+            else:
+                self.output.skip = self.journal.verify()
+                self.journal.restore(self.output, self.output.skip)
+                logging.info("Resuming: %d of %d partitions completed." % (len(self.output.skip), len(parts)))
+        if parts is None:
+            parts = self.partition(paths, basedir)
+            if self.journal:
+                self.journal.writeplan(paths, basedir, parts, self.output)
+        self.output.journal = self.journal
+        if self.queue:
+            self.distribute(parts)
+        else:
+            with self.phase('output:' + self.output.fmt, sum(map(len, parts))):
+                self.output.output(parts)
+        if self.lookupfile:
+            with self.phase('lookup'):
+                writelookup(self.lookupfile, parts, self.output, self.store)
+        if self.verify:
+            with self.phase('verify', sum(map(len, parts))):
+                lookup = Lookup(self.lookupfile)
+                errors = verifyarchives(lookup, self.output.dst, cmd7z=getattr(self.output, 'cmd7z', '7za'),
+                                        backend=getattr(self.output, 'backend', 'cmd'))
+                lookup.close()
+            if errors:
+                raise ArchiveError(errors)
+        if self.metrics:
+            self.metrics.save()
         logging.info("Done.")
 
+    def distribute(self, parts):
+        '''
+        Queues the partitions for the workers of `queue`, and collects the
+        archive files, offsets and checksums of each partition done,
+        as if the output had created them.
+        '''
+        import subprocess
+        logging.info("Queueing %d partitions in %s..." % (len(parts), self.queue.filename))
+        self.queue.submit(parts, self.output, self.output.skip)
+        cmd = [sys.executable, os.path.abspath(__file__), 'worker', self.queue.filename]
+        procs = [subprocess.Popen(cmd) for i in range(self.workers)]
+        def ondone(pn, result):
+            self.output.offsets.update(result['offsets'])
+            self.output.checksums.update(result['checksums'])
+            if self.journal:
+                names = set(result['offsets']).union(result['checksums'])
+                self.journal.done(pn, result['files'], journalmembers(names, result['offsets'], result['checksums']))
+        try:
+            with self.phase('queue', sum(map(len, parts))):
+                errors = self.queue.wait(ondone, procs)
+        except BaseException:
+            for proc in procs:
+                proc.terminate()
+            raise
+        finally:
+            for proc in procs:
+                proc.wait()
+        if errors:
+            for pn, msg in sorted(errors.items()):
+                logging.error('Archive %s failed: %s' % (self.output.name % pn, msg))
+            raise ArchiveError(errors)
+
+    def phase(self, name, files=0):
+        if self.status:
+            self.status.set_phase(name)
+        if self.metrics:
+            return self.metrics.phase(name, files)
+        return contextlib.nullcontext({})
+
     def partition(self, paths, basedir=None):
         basedir = basedir or basepath(paths)
         filelist, ignored = self.scanpaths(paths, basedir)
+        if self.chunksize:
+            with self.phase('split') as record:
+                filelist = list(self.splitfiles(filelist, basedir))
+                record['files'] = len(filelist)
         logging.info("Dispatching files...")
-        parts = self.packer.dispatch(filelist)
-        for p in parts:
-            p.sortfile(self.sortfile)
-        with open(self.indexfile, 'w', encoding='utf-8') as f:
-            for ln in self.genindex(filelist, paths, ignored, parts):
-                f.write(ln + '\n')
+        with self.phase('dispatch', len(filelist)):
+            parts = self.packer.dispatch(filelist)
+        with self.phase('sort', len(filelist)):
+            for p in parts:
+                p.sortfile(self.sortfile, basedir)
+        if isinstance(self.packer, GroupLimitPacker) and callable(self.compressfunc):
+            self.comparepacking(filelist, parts, basedir)
+        if not self.indexfile:
+            return parts
+        with self.phase('index', len(filelist)):
+            if self.indexformat == 'jsonl':
+                with IndexWriter(self.indexfile) as writer:
+                    writer.header(paths)
+                    for pn, part in enumerate(parts):
+                        writer.partition(pn, part)
+                    for fn, size in ignored:
+                        writer.ignore(fn, size)
+            else:
+                with open(self.indexfile, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                    for ln in self.genindex(filelist, paths, ignored, parts):
+                        f.write(ln + '\n')
         return parts
 
     def scanpaths(self, paths, prefix=None):
         prefix = prefix or os.path.join(*os.path.commonprefix(tuple(map(splitpath, map(os.path.abspath, paths)))))
-        fl = []
-        estsize = 0
-        ignored = []
-        logging.info("Scanning files...")
-        for path in paths:
-            if os.path.isfile(path):
-                try:
-                    relfn = os.path.relpath(path, prefix)
-                    if self.ffilter(relfn, prefix):
-                        filesize = os.path.getsize(path)
-                        fl.append((os.path.relpath(path, prefix), filesize, filesize))
-                        estsize += min(self.samplesize, filesize)
-                    else:
-                        ignored.append(path)
-                except Exception as ex:
-                    logging.error(ex)
-            else:
-                for root, dirs, files in os.walk(path):
-                    for name in files:
-                        fn = os.path.join(root, name)
-                        relfn = os.path.relpath(fn, prefix)
-                        try:
-                            if self.ffilter(relfn, prefix):
-                                filesize = os.path.getsize(fn)
-                                fl.append((relfn, filesize, filesize))
-                                estsize += min(self.samplesize, filesize)
-                            else:
-                                ignored.append((relfn, os.path.getsize(fn)))
-                        except Exception as ex:
-                            logging.error(ex)
-                            # file access error -> ignore
-                            ignored.append((relfn, 0))
-                    for name in dirs:
-                        fn = os.path.join(root, name)
-                        # not ignoring empty dirs
-                        if not os.listdir(fn):
-                            fl.append((os.path.relpath(fn + '/', prefix), 0, 0))
-        # estimate compressd size
-        if callable(self.compressfunc):
-            logging.info("Calculating estimated compressed size...")
-            eta = ETA(estsize, min_ms_between_updates=500)
-            estcurrent = 0
-            for k, v in enumerate(fl):
-                filename, size, size2 = v
-                fn = os.path.join(prefix, filename)
-                try:
-                    fl[k] = (filename, size, self.estcompresssize(fn, size))
-                except Exception as ex:
-                    logging.exception("Can't access " + path)
-                estcurrent += min(self.samplesize, size)
-                eta.print_status(estcurrent)
-            eta.done()
+        if self.loadscan:
+            logging.info("Loading scan result...")
+            with self.phase('loadscan') as record:
+                meta, fl, ignored, mtimes = loadscan(self.loadscan, self.store)
+                record['files'] = len(fl)
+            if meta['paths'] != list(paths):
+                logging.warning("The scan result is of different paths: " + ' '.join(meta['paths']))
+            if meta['compress'] != compressname(self.compressfunc):
+                logging.warning("The scan result is estimated with different compression: %s" % meta['compress'])
+        else:
+            with self.phase('scan') as record:
+                fl, ignored, mtimes = self.scanfiles(paths, prefix)
+                record['files'] = len(fl) + len(ignored)
+            if callable(self.compressfunc):
+                with self.phase('estimate', len(fl)):
+                    self.estimate(fl, prefix)
+            if self.savescan:
+                logging.info("Saving scan result...")
+                with self.phase('savescan', len(fl)):
+                    savescan(self.savescan, {'paths': list(paths), 'basedir': os.path.abspath(prefix),
+                             'compress': compressname(self.compressfunc), 'samplesize': self.samplesize},
+                             fl, ignored, mtimes)
         if self.totalsizelim:
-            filtered = []
+            with self.phase('select', len(fl)):
+                fl = self.selectfiles(fl, ignored, mtimes)
+        return fl, ignored
+
+    def scanfiles(self, paths, prefix):
+        '''
+        Walks the paths, and returns the list of selected files, the list of
+        ignored files, and the modification times of the selected files.
+        '''
+        if self.store:
+            fl, ignored = self.store.new(), self.store.new(2)
+            mtimes = fl.column('mtime')
+            addfile = fl.append
+        else:
+            fl, ignored, mtimes = [], [], array.array('d')
+            def addfile(entry, mtime):
+                fl.append(entry)
+                mtimes.append(mtime)
+        def onerror(name, ex):
+            logging.error(ex)
+            # file access error -> ignore
+            ignored.append((name, 0))
+        logging.info("Scanning files...")
+        for entry in scan(paths, prefix, self.ffilter, lambda name, size: ignored.append((name, size)), onerror):
+            addfile(entry[:3], entry.mtime)
+        return fl, ignored, mtimes
+
+    def estimate(self, fl, prefix):
+        '''
+        Estimates the compressed size of the files in place.
+        '''
+        if not callable(self.compressfunc):
+            return
+        logging.info("Calculating estimated compressed size...")
+        eta = ETA(len(fl), min_ms_between_updates=500)
+        def onerror(name, ex):
+            logging.error("Can't access %s: %s" % (os.path.join(prefix, name), ex))
+        entries = (Entry(filename, size, estsize, None) for filename, size, estsize in fl)
+        for k, entry in enumerate(estimate(entries, prefix, self.compressfunc, self.samplesize,
+                                           stats=self.eststats, onerror=onerror,
+                                           progress=lambda files, nbytes: eta.print_status(files))):
+            fl[k] = entry[:3]
+        eta.done()
+
+    def selectfiles(self, fl, ignored, mtimes=None):
+        '''
+        Selects the files in the order of `selector` until `totalsizelim`
+        is reached. The others are added to `ignored`.
+        '''
+        if isinstance(fl, FileTable):
+            filtered = self.store.new()
+            key, reverse = self.selector.rowkey()
             sizesum = 0
-            maxfilesize = 0
-            for k, v in sorted(enumerate(fl), key=lambda x: x[1][2]):
-                filename, origsize, size = v
-                if sizesum + size > self.totalsizelim:
-                    ignored.append(fl[k][:2])
-                    if not maxfilesize:
-                        maxfilesize = origsize
+            cutoff = None
+            for entry, mtime in fl.sortedrows(reverse=reverse, rowkey=key):
+                if cutoff is None and sizesum + entry[2] <= self.totalsizelim:
+                    filtered.append(entry, mtime)
+                    sizesum += entry[2]
                 else:
-                    filtered.append(fl[k])
-                    sizesum += size
-            fl = filtered
-            if maxfilesize:
-                logging.info("Max file size is " + sizeof_fmt(maxfilesize))
-        return fl, ignored
+                    if cutoff is None:
+                        cutoff = entry
+                    ignored.append(entry[:2])
+        else:
+            sizes = array.array('q', map(_ig2, fl))
+            order = self.selector.order(fl, sizes, mtimes)
+            cumsum = array.array('q', itertools.accumulate(map(sizes.__getitem__, order)))
+            k = bisect.bisect_right(cumsum, self.totalsizelim)
+            filtered = [fl[i] for i in itertools.islice(order, k)]
+            ignored.extend(fl[i][:2] for i in itertools.islice(order, k, None))
+            cutoff = fl[order[k]] if k < len(order) else None
+        if cutoff is not None:
+            if self.selector.policy == 'smallest':
+                logging.info("Max file size is " + sizeof_fmt(cutoff[1]))
+            else:
+                logging.info("Selected %d files, %s" % (len(filtered), sizeof_fmt(sum(map(_ig1, filtered)))))
+        return filtered
 
     def genindex(self, filelist, paths, ignored, partitions, showignored=True):
         yield '# '+ time.strftime('%Y-%m-%d %H:%M:%S %Z')
@@ -219,24 +507,1166 @@ class Volume:
             yield '# %s' % p
         for pn, part in enumerate(partitions):
             for fn, size, estsize in part.filelist:
-                yield "%03d\t%s" % (pn, fn)
+                if isinstance(fn, FileChunk):
+                    yield "%03d\t%s\t%s\t%d\t%d" % (pn, fn, fn.filename, fn.offset, fn.length)
+                else:
+                    yield "%03d\t%s" % (pn, fn)
         if showignored:
             yield "# Ignored files:"
             for fn, size in ignored:
                 yield "#\t" + fn
 
-    def estcompresssize(self, filename, fsize, err=0.1):
-        if not fsize:
-            return 0
-        if fsize <= self.samplesize:
-            with open(filename, 'rb') as f:
-                sample = f.read()
+    def estsolidsize(self, part, prefix, maxsamples=256, context=4):
+        '''
+        Estimates the compressed size of a solid archive of the partition.
+        Each sampled file is compressed after the samples of the files before it,
+        and its estimated size is scaled by how much the context helped.
+        '''
+        step = max(1, len(part) // maxsamples)
+        overhead = len(self.compressfunc(b''))
+        ctx = b''
+        ctxsize = overhead
+        weighted = total = 0
+        for fn, size, estsize in part.filelist[::step]:
+            try:
+                if isinstance(fn, FileChunk):
+                    with SourceFile(os.path.join(prefix, fn.filename), fn.offset, min(fn.length, self.samplesize)) as f:
+                        sample = f.read()
+                elif size:
+                    with open(os.path.join(prefix, fn), 'rb') as f:
+                        sample = readsample(f, size, self.samplesize)
+                else:
+                    continue
+            except Exception as ex:
+                logging.error(ex)
+                continue
+            if not sample:
+                continue
+            separate = len(self.compressfunc(sample)) - overhead
+            if ctx and separate > 0:
+                marginal = len(self.compressfunc(ctx + sample)) - ctxsize
+                gain = min(1, max(marginal, 0) / separate)
+            else:
+                gain = 1
+            weighted += estsize * gain
+            total += estsize
+            ctx = (ctx + sample)[-context*self.samplesize:]
+            ctxsize = len(self.compressfunc(ctx))
+        if not total:
+            return part.size
+        return int(part.size * weighted / total)
+
+    def comparepacking(self, filelist, parts, prefix):
+        '''
+        Logs the estimated solid compressed size against the plain LimitPacker.
+        '''
+        logging.info("Comparing with plain packing...")
+        plain = LimitPacker(self.packer.maxsize, self.packer.maxentries, self.packer.multipart).dispatch(list(filelist))
+        for p in plain:
+            p.sortfile(self.sortfile, prefix)
+        grouped = sum(self.estsolidsize(p, prefix) for p in parts)
+        plain = sum(self.estsolidsize(p, prefix) for p in plain)
+        logging.info("Estimated compressed size: %s, %s with plain packing (%+.1f%%)" % (
+            sizeof_fmt(grouped), sizeof_fmt(plain), (grouped - plain) / plain * 100 if plain else 0))
+
+    def splitfiles(self, filelist, prefix):
+        '''
+        Splits files larger than `chunksize` into chunks of `chunksize` bytes,
+        so they can be packed like other files.
+        Raises ValueError if a chunk name is the path of a file or directory.
+        '''
+        # the chunks are found by their names, which must not be taken
+        paths = set()
+        for filename, origsize, size in filelist:
+            while filename and filename not in paths:
+                paths.add(filename)
+                filename = os.path.dirname(filename)
+        for filename, origsize, size in filelist:
+            if origsize <= self.chunksize:
+                yield filename, origsize, size
+                continue
+            try:
+                # sparse files are split by their apparent size
+                fsize = os.stat(os.path.join(prefix, filename)).st_size
+            except Exception as ex:
+                logging.error(ex)
+                yield filename, origsize, size
+                continue
+            for num, offset in enumerate(range(0, fsize, self.chunksize), 1):
+                length = min(self.chunksize, fsize - offset)
+                chunk = FileChunk(filename, offset, length, num)
+                if chunk in paths:
+                    raise ValueError('chunk %s of %s has the name of another file, rename that file' % (chunk, filename))
+                yield chunk, origsize * length // fsize, size * length // fsize
+
+class EstimateStats:
+    '''
+    Correction factors (actual size / estimated size) for the compressed
+    size estimation, learned from the archives created.
+    Factors are kept for each output format, per file extension,
+    and persisted in a JSON file.
+    Each new observation moves a factor by `rate` in log scale towards the
+    factor it implies, by at most `maxstep` times.
+    '''
+    maxstep = 2.0
+
+    def __init__(self, filename, fmt, err=0.1, rate=0.5):
+        self.filename = filename
+        self.fmt = fmt
+        self.rate = rate
+        self.data = {'formats': {}}
+        if filename and os.path.isfile(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        self.stats = self.data['formats'].setdefault(fmt, {'default': 1 / (1 + err), 'ext': {}})
+        # factors used for the estimates of the current run
+        self.applied = {'default': self.stats['default'], 'ext': dict(self.stats['ext'])}
+
+    def factor(self, ext, stats=None):
+        stats = stats or self.stats
+        return stats['ext'].get(ext, stats['default'])
+
+    def correct(self, part):
+        '''
+        Updates the estimated size of a partition planned earlier in this run
+        with the current factors.
+        '''
+        part.size = int(sum(
+            estsize * self.factor(fileext(fn)) / self.factor(fileext(fn), self.applied)
+            for fn, size, estsize in part.filelist))
+
+    def move(self, current, target):
+        step = min(max(target / current, 1 / self.maxstep), self.maxstep)
+        return current * step ** self.rate
+
+    def record(self, part, actual, extsizes=None):
+        '''
+        Records the actual compressed size of a partition, and optionally
+        the actual compressed sizes per extension.
+        The file estimates were made with the factors of `applied`, so the
+        observed ratios are relative to those, not to the current factors
+        or the size updated by `correct`.
+        '''
+        estimate = sum(estsize for fn, size, estsize in part.filelist)
+        if not estimate or not actual:
+            return
+        ratio = actual / estimate
+        extest = collections.Counter()
+        for fn, size, estsize in part.filelist:
+            extest[fileext(fn)] += estsize
+        for ext, estsize in extest.items():
+            if extsizes is not None:
+                if not estsize or not extsizes.get(ext):
+                    continue
+                extratio = extsizes[ext] / estsize
+            else:
+                extratio = ratio
+            self.stats['ext'][ext] = self.move(self.factor(ext), self.factor(ext, self.applied) * extratio)
+        self.stats['default'] = self.move(self.stats['default'], self.applied['default'] * ratio)
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(self.filename + '.tmp', self.filename)
+
+# Run metrics
+
+def procio():
+    '''
+    Returns the I/O counters of this process from /proc/self/io, or {}.
+    '''
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return {k: int(v) for k, v in (line.split(':') for line in f)}
+    except OSError:
+        return {}
+
+class Metrics:
+    '''
+    Records the wall and CPU time, I/O and peak memory of each phase
+    of a run into a JSON file. If `profiledir` is given, each phase is
+    also profiled with cProfile, and the stats are dumped to
+    `profiledir/NN-phase.pstats`.
+    '''
+
+    def __init__(self, filename=None, profiledir=None):
+        self.filename = filename
+        self.profiledir = profiledir
+        self.phases = []
+        self.started = time.time()
+        self.profiling = False
+        if profiledir:
+            os.makedirs(profiledir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def phase(self, name, files=0):
+        '''
+        Measures the enclosed code. The yielded record can be updated,
+        eg. with the number of files processed.
+        '''
+        import resource
+        record = {'phase': name, 'files': files}
+        profiler = None
+        if self.profiledir and not self.profiling:
+            import cProfile
+            # nested phases are included in the profile of the outer phase
+            profiler = cProfile.Profile()
+            self.profiling = True
+        io0 = procio()
+        ru0 = resource.getrusage(resource.RUSAGE_SELF)
+        ruc0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+                self.profiling = False
+            wall = time.perf_counter() - start
+            ru1 = resource.getrusage(resource.RUSAGE_SELF)
+            ruc1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            io1 = procio()
+            record.update({
+                'wall': wall,
+                'user': ru1.ru_utime - ru0.ru_utime,
+                'sys': ru1.ru_stime - ru0.ru_stime,
+                'children_cpu': (ruc1.ru_utime + ruc1.ru_stime) - (ruc0.ru_utime + ruc0.ru_stime),
+                'files_per_s': record['files'] / wall if wall else None,
+                'voluntary_switches': ru1.ru_nvcsw - ru0.ru_nvcsw,
+                'involuntary_switches': ru1.ru_nivcsw - ru0.ru_nivcsw,
+                # ru_maxrss is in KiB on Linux
+                'peak_rss': ru1.ru_maxrss * 1024,
+            })
+            for key, field in (('rchar', 'read_chars'), ('wchar', 'written_chars'),
+                               ('read_bytes', 'read_bytes'), ('write_bytes', 'written_bytes'),
+                               ('syscr', 'read_syscalls'), ('syscw', 'write_syscalls')):
+                if key in io1:
+                    record[field] = io1[key] - io0.get(key, 0)
+            if profiler:
+                fn = os.path.join(self.profiledir, '%02d-%s.pstats' % (len(self.phases), re.sub(r'[^\w.-]', '-', name)))
+                profiler.dump_stats(fn)
+                record['profile'] = fn
+            self.phases.append(record)
+
+    def save(self):
+        if not self.filename:
+            return
+        import resource
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        result = {
+            'version': __version__,
+            'argv': sys.argv,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(self.started)),
+            'wall': time.time() - self.started,
+            'user': ru.ru_utime,
+            'sys': ru.ru_stime,
+            'peak_rss': ru.ru_maxrss * 1024,
+            'phases': self.phases,
+        }
+        with open(self.filename, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=1)
+
+# Scan results
+
+SCAN_MAGIC = b'MPKSCAN1'
+
+def compressname(compressfunc):
+    return getattr(compressfunc, '__module__', None) if callable(compressfunc) else None
+
+def _writearray(f, typecode, values, blocksize=65536):
+    it = iter(values)
+    while True:
+        block = array.array(typecode, itertools.islice(it, blocksize))
+        if not block:
+            break
+        block.tofile(f)
+
+def _writepaths(f, names):
+    first = True
+    for fn in names:
+        if not first:
+            f.write(b'\0')
+        f.write(fn.encode('utf-8', 'surrogateescape'))
+        first = False
+
+def _pathlen(names):
+    length = -1
+    for fn in names:
+        length += len(fn.encode('utf-8', 'surrogateescape')) + 1
+    return max(length, 0)
+
+def _readcolumns(mm, pos, count, pathlen, typecodes, blocksize=65536):
+    '''
+    Yields (path, *values) from the columns at `pos` of a scan result.
+    '''
+    pathpos = pos + count * 8 * len(typecodes)
+    pathend = pathpos + pathlen
+    for start in range(0, count, blocksize):
+        stop = min(start + blocksize, count)
+        columns = []
+        for k, typecode in enumerate(typecodes):
+            column = array.array(typecode)
+            colpos = pos + count * 8 * k
+            column.frombytes(mm[colpos + start * 8:colpos + stop * 8])
+            columns.append(column)
+        for values in zip(*columns):
+            end = mm.find(b'\0', pathpos, pathend)
+            if end == -1:
+                end = pathend
+            yield (mm[pathpos:end].decode('utf-8', 'surrogateescape'),) + values
+            pathpos = end + 1
+
+def savescan(filename, meta, fl, ignored, mtimes):
+    '''
+    Saves a scan result in a compact binary format: a JSON header,
+    then arrays of sizes, estimated sizes and modification times,
+    and NUL-separated paths.
+    '''
+    meta = dict(meta, version=__version__, count=len(fl), ignored=len(ignored),
+                pathlen=_pathlen(map(_ig0, fl)), ignoredpathlen=_pathlen(map(_ig0, ignored)))
+    meta = json.dumps(meta).encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(SCAN_MAGIC + struct.pack('<I', len(meta)) + meta)
+        _writearray(f, 'q', map(_ig1, fl))
+        _writearray(f, 'q', map(_ig2, fl))
+        _writearray(f, 'd', mtimes)
+        _writepaths(f, map(_ig0, fl))
+        _writearray(f, 'q', map(_ig1, ignored))
+        _writepaths(f, map(_ig0, ignored))
+
+def loadscan(filename, store=None):
+    '''
+    Loads a scan result saved by `savescan`.
+    Returns (meta, filelist, ignored, mtimes).
+    If `store` is given, the file lists are `FileTable`s from the store.
+    '''
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(SCAN_MAGIC)] != SCAN_MAGIC:
+            raise ValueError('not a scan result: ' + filename)
+        pos = len(SCAN_MAGIC) + 4
+        metalen, = struct.unpack_from('<I', mm, len(SCAN_MAGIC))
+        meta = json.loads(mm[pos:pos + metalen].decode('utf-8'))
+        pos += metalen
+        count = meta['count']
+        if store:
+            fl, ignored = store.new(), store.new(2)
+            mtimes = fl.column('mtime')
+            for fn, size, estsize, mtime in _readcolumns(mm, pos, count, meta['pathlen'], 'qqd'):
+                fl.append((fn, size, estsize), mtime)
         else:
-            with open(filename, 'rb') as f:
-                f.seek(int((fsize - self.samplesize)/2))
-                sample = f.read(self.samplesize)
-        compsize = len(self.compressfunc(sample)) / len(sample)
-        return int(fsize * compsize / (1 + err))
+            fl, ignored, mtimes = [], [], array.array('d')
+            for fn, size, estsize, mtime in _readcolumns(mm, pos, count, meta['pathlen'], 'qqd'):
+                fl.append((fn, size, estsize))
+                mtimes.append(mtime)
+        pos += count * 24 + meta['pathlen']
+        for fn, size in _readcolumns(mm, pos, meta['ignored'], meta['ignoredpathlen'], 'q'):
+            ignored.append((fn, size))
+    return meta, fl, ignored, mtimes
+
+# Index files
+
+def openindex(filename, mode='r'):
+    '''
+    Opens an index file in text mode ('r', 'w' or 'a').
+    Undecodable file names are kept with surrogateescape, like `FileTable`.
+    Files ending with .gz or .zst are (de)compressed on the fly,
+    appending adds a new gzip member or zstd frame.
+    '''
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, mode + 't', encoding='utf-8', errors='surrogateescape')
+    elif filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('zstandard is required for .zst index files')
+        if mode in ('w', 'a'):
+            stream = zstandard.ZstdCompressor().stream_writer(open(filename, mode + 'b'))
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(stream, encoding='utf-8', errors='surrogateescape')
+    return open(filename, mode, encoding='utf-8', errors='surrogateescape')
+
+class IndexWriter:
+    '''
+    Writes a JSON lines index incrementally.
+    Each line is a record with a `type` of 'header', 'file', 'partition',
+    'ignored' or 'summary'. Only running totals are kept in memory.
+    '''
+
+    def __init__(self, filename):
+        self.fp = openindex(filename, 'w')
+        self.files = 0
+        self.size = 0
+        self.partitions = 0
+        self.ignored = 0
+        self.ignoredsize = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def write(self, record):
+        self.fp.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def header(self, paths, **extra):
+        record = {'type': 'header', 'version': __version__,
+                  'time': time.strftime('%Y-%m-%d %H:%M:%S %Z'),
+                  'paths': list(paths)}
+        record.update(extra)
+        self.write(record)
+
+    def partition(self, pn, part):
+        '''
+        Writes the records of a sealed partition.
+        '''
+        origsize = estsize = 0
+        for fn, size, est in part.filelist:
+            record = {'type': 'file', 'part': pn, 'path': fn, 'size': size, 'estsize': est}
+            if isinstance(fn, FileChunk):
+                record.update(file=fn.filename, offset=fn.offset, length=fn.length)
+            self.write(record)
+            origsize += size
+            estsize += est
+        self.write({'type': 'partition', 'part': pn, 'files': len(part),
+                    'size': origsize, 'estsize': estsize})
+        self.files += len(part)
+        self.size += origsize
+        self.partitions += 1
+
+    def ignore(self, fn, size):
+        self.write({'type': 'ignored', 'path': fn, 'size': size})
+        self.ignored += 1
+        self.ignoredsize += size
+
+    def close(self, summary=True):
+        if summary:
+            self.write({'type': 'summary', 'files': self.files, 'size': self.size,
+                        'partitions': self.partitions, 'ignored': self.ignored,
+                        'ignoredsize': self.ignoredsize})
+        self.fp.close()
+
+def readindex(filename):
+    '''
+    Iterates over the records of an index file, in the format of `IndexWriter`.
+    The text format written by `Volume.genindex` is also accepted,
+    yielding 'file' and 'ignored' records.
+    '''
+    with openindex(filename) as f:
+        for ln in f:
+            ln = ln.rstrip('\n')
+            if ln.startswith('{'):
+                yield json.loads(ln)
+            elif ln.startswith('#\t'):
+                yield {'type': 'ignored', 'path': ln[2:]}
+            elif ln and not ln.startswith('#'):
+                fields = ln.split('\t')
+                record = {'type': 'file', 'part': int(fields[0]), 'path': fields[1]}
+                if len(fields) == 5:
+                    record.update(file=fields[2], offset=int(fields[3]), length=int(fields[4]))
+                yield record
+
+CHECKSUMS = ('blake2b', 'xxh64')
+
+def newhash(name):
+    '''
+    Returns a new hash object of a checksum algorithm in `CHECKSUMS`.
+    '''
+    if name == 'blake2b':
+        import hashlib
+        return hashlib.blake2b(digest_size=16)
+    elif name == 'xxh64':
+        try:
+            import xxhash
+        except ImportError:
+            raise RuntimeError('xxhash is required for xxh64 checksums')
+        return xxhash.xxh64()
+    raise ValueError('unknown checksum ' + name)
+
+def quicksum(filename, blocksize=1048576):
+    '''
+    Returns a quick checksum of a file: BLAKE2b of its size,
+    first and last `blocksize` bytes.
+    '''
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode('ascii'))
+        h.update(f.read(blocksize))
+        if size > blocksize:
+            f.seek(max(blocksize, size - blocksize))
+            h.update(f.read(blocksize))
+    return h.hexdigest()
+
+class Journal:
+    '''
+    Records the partition plan of a run and each completed partition,
+    with the size and quick checksum of its archive files, and the offsets
+    and checksums of its members, so an interrupted run can be resumed.
+    The plan is written in the format of `IndexWriter`.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.completed = {}
+        # partition number -> {member name: [offset, checksum hex or None]}
+        self.members = {}
+
+    def writeplan(self, paths, basedir, partitions, output):
+        with IndexWriter(self.filename) as writer:
+            writer.header(paths, basedir=os.path.abspath(basedir), format=output.fmt, name=output.name)
+            for pn, part in enumerate(partitions):
+                writer.partition(pn, part)
+        self.completed = {}
+        self.members = {}
+
+    def load(self, paths, output, store=None):
+        '''
+        Returns the partitions planned by a previous run, with the file lists
+        in `store` if given, or None if there is no complete plan.
+        '''
+        if not os.path.isfile(self.filename):
+            return None
+        partitions = []
+        complete = False
+        for record in readindex(self.filename):
+            rtype = record['type']
+            if rtype == 'header':
+                if (record['paths'] != list(paths) or record['format'] != output.fmt
+                    or record['name'] != output.name):
+                    raise ValueError('the journal %s is from a different run: %s, -f %s, -n %s' % (
+                        self.filename, ' '.join(record['paths']), record['format'], record['name']))
+            elif rtype in ('file', 'partition'):
+                while len(partitions) <= record['part']:
+                    partitions.append(Partition(store))
+                if rtype == 'file':
+                    if 'file' in record:
+                        fn = FileChunk(record['file'], record['offset'], record['length'], int(record['path'].rsplit('.', 1)[1]))
+                    else:
+                        fn = record['path']
+                    partitions[record['part']].addfile(fn, record['size'], record['estsize'])
+            elif rtype == 'summary':
+                complete = True
+            elif rtype == 'done':
+                self.completed[record['part']] = record['files']
+                self.members[record['part']] = record.get('members', {})
+        return partitions if complete else None
+
+    def verify(self):
+        '''
+        Returns the numbers of the completed partitions whose archive files
+        are intact, judged by size and quick checksum.
+        '''
+        verified = set()
+        for pn, files in self.completed.items():
+            try:
+                if all(os.path.getsize(fn) == size and quicksum(fn) == checksum
+                       for fn, size, checksum in files):
+                    verified.add(pn)
+                    continue
+            except OSError:
+                pass
+            logging.warning('Archive of partition %d is changed, recreating' % pn)
+        return verified
+
+    def restore(self, output, partitions):
+        '''
+        Restores the member offsets and checksums of the completed
+        `partitions` into `output`.
+        '''
+        for pn in partitions:
+            for name, (offset, digest) in self.members.get(pn, {}).items():
+                if offset >= 0:
+                    output.offsets[name] = offset
+                if digest:
+                    output.checksums[name] = bytes.fromhex(digest)
+
+    def done(self, pn, files, members=None):
+        '''
+        Records a completed partition, with its archive files, and `members`
+        as returned by `journalmembers`.
+        '''
+        record = {'type': 'done', 'part': pn, 'time': time.strftime('%Y-%m-%d %H:%M:%S %Z'),
+                  'files': [(fn, os.path.getsize(fn), quicksum(fn)) for fn in files],
+                  'members': members or {}}
+        with openindex(self.filename, 'a') as f:
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+class WorkQueue:
+    '''
+    A queue of partitions to archive, in an SQLite database on a filesystem
+    shared by the coordinator and the workers of a distributed run
+    (the filesystem must support file locks).
+    A worker claims a partition with a lease of `lease` seconds, and renews
+    it while archiving. When the lease has expired, as the worker crashed,
+    the partition is claimed by another worker, up to `attempts` times.
+    The hosts' clocks should agree within the lease.
+    '''
+    lease = 300
+    attempts = 3
+
+    def __init__(self, filename, timeout=60):
+        import sqlite3
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=timeout, isolation_level=None, check_same_thread=False)
+        # the lease is renewed from another thread
+        self.lock = threading.RLock()
+        with self.lock:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+                CREATE TABLE IF NOT EXISTS units (
+                    pn INTEGER PRIMARY KEY, plan BLOB, state TEXT DEFAULT 'pending',
+                    worker TEXT, expires REAL, attempts INTEGER DEFAULT 0,
+                    result BLOB, error TEXT);
+            ''')
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'lease'").fetchone()
+        if row:
+            self.lease, self.attempts = json.loads(row[0])
+
+    def close(self):
+        self.db.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def submit(self, partitions, output, skip=()):
+        '''
+        Replaces the queue with the partitions not in `skip`, to be archived
+        by the workers with a copy of `output`.
+        '''
+        import copy
+        import pickle
+        output = copy.copy(output)
+        output.journal = None
+        output.status = None
+        output.skip = frozenset()
+        output.offsets = {}
+        output.checksums = {}
+        with self.transaction() as db:
+            db.execute('DELETE FROM meta')
+            db.execute('DELETE FROM units')
+            db.execute("INSERT INTO meta VALUES ('output', ?)", (pickle.dumps(output),))
+            db.execute("INSERT INTO meta VALUES ('lease', ?)", (json.dumps((self.lease, self.attempts)),))
+            db.executemany('INSERT INTO units (pn, plan) VALUES (?, ?)', (
+                (pn, pickle.dumps([tuple(entry) for entry in part.filelist]))
+                for pn, part in enumerate(partitions) if pn not in skip))
+
+    def output(self):
+        import pickle
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'output'").fetchone()
+        if row is None:
+            raise ValueError('nothing is queued in ' + self.filename)
+        return pickle.loads(row[0])
+
+    def claim(self, worker):
+        '''
+        Claims the next partition for `worker`, and returns (number, partition),
+        or None if no partition is available now.
+        '''
+        import pickle
+        now = time.time()
+        with self.transaction() as db:
+            while True:
+                row = db.execute(
+                    "SELECT pn, plan, state, worker, attempts FROM units WHERE state = 'pending'"
+                    " OR (state = 'running' AND expires < ?) ORDER BY pn LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                pn, plan, state, owner, attempts = row
+                if state == 'running':
+                    logging.warning('Lease of partition %d by %s expired' % (pn, owner))
+                if attempts >= self.attempts:
+                    db.execute("UPDATE units SET state = 'failed', error = ? WHERE pn = ?",
+                               ('lease expired %d times' % attempts, pn))
+                    continue
+                db.execute("UPDATE units SET state = 'running', worker = ?, expires = ?,"
+                           " attempts = attempts + 1 WHERE pn = ?", (worker, now + self.lease, pn))
+                break
+        part = Partition()
+        for fn, origsize, size in pickle.loads(plan):
+            part.addfile(fn, origsize, size)
+        return pn, part
+
+    def renew(self, pn, worker):
+        '''
+        Extends the lease of a partition, returns False if the lease is lost.
+        '''
+        with self.lock:
+            cur = self.db.execute("UPDATE units SET expires = ? WHERE pn = ? AND worker = ? AND state = 'running'",
+                                  (time.time() + self.lease, pn, worker))
+        return cur.rowcount == 1
+
+    def finish(self, pn, worker, result):
+        '''
+        Marks a partition as done with a result dict, returns False if the
+        lease is lost.
+        '''
+        import pickle
+        with self.lock:
+            cur = self.db.execute("UPDATE units SET state = 'done', result = ? WHERE pn = ? AND worker = ? AND state = 'running'",
+                                  (pickle.dumps(result), pn, worker))
+        return cur.rowcount == 1
+
+    def fail(self, pn, worker, error):
+        with self.lock:
+            cur = self.db.execute("UPDATE units SET state = 'failed', error = ? WHERE pn = ? AND worker = ? AND state = 'running'",
+                                  (error, pn, worker))
+        return cur.rowcount == 1
+
+    def counts(self):
+        '''
+        Returns the number of partitions in each state:
+        pending, running, done and failed.
+        '''
+        counts = dict.fromkeys(('pending', 'running', 'done', 'failed'), 0)
+        with self.lock:
+            counts.update(self.db.execute('SELECT state, count(*) FROM units GROUP BY state'))
+        return counts
+
+    def finished(self):
+        counts = self.counts()
+        return not (counts['pending'] or counts['running'])
+
+    def results(self):
+        '''
+        Iterates over (number, result) of the partitions done.
+        '''
+        import pickle
+        with self.lock:
+            rows = self.db.execute("SELECT pn, result FROM units WHERE state = 'done' ORDER BY pn").fetchall()
+        for pn, result in rows:
+            yield pn, pickle.loads(result)
+
+    def errors(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT pn, error FROM units WHERE state = 'failed'"))
+
+    def wait(self, ondone=None, procs=(), interval=2):
+        '''
+        Waits until every partition is done or failed, and calls
+        ondone(pn, result) once for each partition done.
+        Returns {number: error} of the failed partitions.
+        Raises RuntimeError if the local worker processes `procs` have all
+        exited before.
+        '''
+        collected = set()
+        last = None
+        while True:
+            exited = procs and all(proc.poll() is not None for proc in procs)
+            counts = self.counts()
+            if ondone:
+                for pn, result in self.results():
+                    if pn not in collected:
+                        collected.add(pn)
+                        ondone(pn, result)
+            if counts != last:
+                logging.info('Queue: %(pending)d pending, %(running)d running, %(done)d done, %(failed)d failed' % counts)
+                last = counts
+            if not (counts['pending'] or counts['running']):
+                return self.errors()
+            if exited:
+                raise RuntimeError('all workers exited, %d partitions left' % (counts['pending'] + counts['running']))
+            time.sleep(interval)
+
+def runworker(queue, worker=None, interval=5):
+    '''
+    Archives the partitions of a WorkQueue until all of them are done or
+    failed. Returns the number of partitions failed by this worker.
+    '''
+    import socket
+    worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+    output = queue.output()
+    failed = 0
+    logging.info('Worker %s started' % worker)
+    while True:
+        unit = queue.claim(worker)
+        if unit is None:
+            if queue.finished():
+                break
+            time.sleep(interval)
+            continue
+        pn, part = unit
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(queue.lease / 3):
+                if not queue.renew(pn, worker):
+                    logging.warning('Lost the lease of partition %d' % pn)
+                    return
+        renewer = threading.Thread(target=heartbeat, daemon=True)
+        renewer.start()
+        archives = {}
+        output.offsets = {}
+        output.checksums = {}
+        output.journal = CallbackJournal(archives.__setitem__)
+        error = None
+        try:
+            output.output({pn: part})
+        except ArchiveError as ex:
+            # already logged by the output
+            error = ex.errors.get(pn, str(ex))
+        except Exception as ex:
+            logging.exception('Partition %d failed' % pn)
+            error = str(ex)
+        finally:
+            stop.set()
+            renewer.join()
+        if error is not None:
+            queue.fail(pn, worker, error)
+            failed += 1
+            continue
+        result = {'files': archives.get(pn, []), 'offsets': output.offsets, 'checksums': output.checksums}
+        if not queue.finish(pn, worker, result):
+            logging.warning('Lost the lease of partition %d, another worker archives it' % pn)
+    logging.info('Worker %s finished' % worker)
+    return failed
+
+def journalmembers(names, offsets, checksums):
+    '''
+    Returns {member name: [offset, checksum hex or None]} of the `names`
+    known in `offsets` or `checksums`, for `Journal.done`.
+    '''
+    members = {}
+    for name in names:
+        offset = offsets.get(name, -1)
+        digest = checksums.get(name)
+        if offset >= 0 or digest:
+            members[name] = [offset, digest.hex() if digest else None]
+    return members
+
+LOOKUP_MAGIC = b'MPKLKUP1'
+# path offset, path length, partition number, member offset, size
+_lookuprec = struct.Struct('<QIIqQ')
+
+def externalsorted(items, runlen, dirname=None):
+    '''
+    Like `sorted`, but sorts runs of `runlen` items in memory, spills them
+    to temporary files in `dirname`, and merges them.
+    '''
+    import pickle
+    import tempfile
+    items = iter(items)
+    run = sorted(itertools.islice(items, runlen))
+    if len(run) < runlen:
+        yield from run
+        return
+    runs = []
+    try:
+        while run:
+            f = tempfile.TemporaryFile(dir=dirname)
+            runs.append(f)
+            for k in range(0, len(run), 1024):
+                pickle.dump(run[k:k+1024], f, pickle.HIGHEST_PROTOCOL)
+            f.seek(0)
+            run = sorted(itertools.islice(items, runlen))
+        def readrun(f):
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    return
+        yield from heapq.merge(*map(readrun, runs))
+    finally:
+        for f in runs:
+            f.close()
+
+def writelookup(filename, partitions, output, store=None):
+    '''
+    Writes a binary lookup table of member paths, sorted by path,
+    with the partition number and the member offset in the archive.
+    If the output recorded checksums, a column of digests (zeros if unknown)
+    follows the records.
+    With a TableStore `store`, the entries are sorted out of core within its
+    budget, and the digests and paths are buffered in temporary files.
+    '''
+    import shutil
+    import tempfile
+    digestsize = len(newhash(output.checksum).digest()) if output.checksum else 0
+    checksums = getattr(output, 'checksums', {})
+    count = sum(len(part) for part in partitions)
+    entries = ((fn.encode('utf-8', 'surrogateescape'), pn, output.offsets.get(fn, -1), size,
+                checksums.get(fn) or bytes(digestsize))
+               for pn, part in enumerate(partitions) for fn, size, estsize in part.filelist)
+    if store:
+        entries = externalsorted(entries, max(store.budget // FileTable.entrymem, 1), store.dirname)
+    else:
+        entries = sorted(entries)
+    meta = json.dumps({'format': output.fmt, 'name': output.name,
+                       'srcbase': os.path.abspath(output.srcbase),
+                       'count': count, 'checksum': output.checksum,
+                       'digestsize': digestsize}).encode('utf-8')
+    tmpdir = store.dirname if store else None
+    with open(filename, 'wb') as f, tempfile.TemporaryFile(dir=tmpdir) as digests, tempfile.TemporaryFile(dir=tmpdir) as paths:
+        f.write(LOOKUP_MAGIC + struct.pack('<I', len(meta)) + meta)
+        pathoff = 0
+        for path, pn, offset, size, digest in entries:
+            f.write(_lookuprec.pack(pathoff, len(path), pn, offset, size))
+            pathoff += len(path)
+            digests.write(digest)
+            paths.write(path)
+        for tmp in (digests, paths):
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, f)
+
+class Lookup:
+    '''
+    Finds members in a lookup table written by `writelookup` by binary search,
+    without loading the table into memory.
+    '''
+
+    def __init__(self, filename):
+        self.fp = open(filename, 'rb')
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(LOOKUP_MAGIC)] != LOOKUP_MAGIC:
+            raise ValueError('not a lookup table: ' + filename)
+        metalen, = struct.unpack_from('<I', self.mm, len(LOOKUP_MAGIC))
+        metastart = len(LOOKUP_MAGIC) + 4
+        self.meta = json.loads(self.mm[metastart:metastart+metalen].decode('utf-8'))
+        self.count = self.meta['count']
+        self.digestsize = self.meta.get('digestsize', 0)
+        self.recstart = metastart + metalen
+        self.digests = self.recstart + self.count * _lookuprec.size
+        self.arena = self.digests + self.count * self.digestsize
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mm.close()
+        self.fp.close()
+
+    def record(self, i):
+        pathoff, pathlen, pn, offset, size = _lookuprec.unpack_from(self.mm, self.recstart + i * _lookuprec.size)
+        start = self.arena + pathoff
+        return self.mm[start:start+pathlen], pn, offset, size
+
+    def digest(self, i):
+        '''
+        Returns the checksum digest of record `i`, or None if unknown.
+        '''
+        if not self.digestsize:
+            return None
+        start = self.digests + i * self.digestsize
+        digest = self.mm[start:start+self.digestsize]
+        return digest if any(digest) else None
+
+    def find(self, path):
+        '''
+        Returns (partition number, member offset, size) of `path`, or None.
+        The member offset is -1 if unknown.
+        '''
+        key = path.encode('utf-8', 'surrogateescape')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            rec = self.record(lo)
+            if rec[0] == key:
+                return rec[1:]
+        return None
+
+    def locate(self, path):
+        '''
+        Yields (member name, partition number, member offset, size) of `path`,
+        or of its chunks in order.
+        '''
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.meta['srcbase'])
+        path = os.path.normpath(path)
+        rec = self.find(path)
+        if rec:
+            yield (path,) + rec
+            return
+        num = 1
+        while True:
+            member = '%s.%03d' % (path, num)
+            rec = self.find(member)
+            if rec is None:
+                break
+            yield (member,) + rec
+            num += 1
+
+def extractmember(meta, archivedir, member, pn, offset, dest, cmd7z='7za'):
+    '''
+    Extracts one member from the archive of partition `pn` to `dest`.
+    Uncompressed tar archives are read from the member offset directly.
+    '''
+    fmt = meta['format']
+    archive = os.path.join(archivedir, meta['name'] % pn)
+    if fmt == 'tar' and offset >= 0:
+        import tarfile
+        with open(archive, 'rb') as f:
+            f.seek(offset)
+            with tarfile.open(fileobj=f, mode='r:', encoding=DEFAULT_ENCODING) as tar:
+                tar.extract(tar.next(), dest)
+    elif fmt.startswith('tar'):
+        import tarfile
+        with tarfile.open(archive, encoding=DEFAULT_ENCODING) as tar:
+            for tarinfo in tar:
+                if tarinfo.name == member:
+                    tar.extract(tarinfo, dest)
+                    break
+            else:
+                raise KeyError('%s not found in %s' % (member, archive))
+    elif fmt == 'zip':
+        import zipfile
+        with zipfile.ZipFile(archive) as zipf:
+            zipf.extract(member, dest)
+    elif fmt == '7z':
+        import subprocess
+        subprocess.check_call([cmd7z, 'x', '-y', '-o' + dest, '--', archive, member], stdout=subprocess.DEVNULL)
+    elif fmt in ('copy', 'link'):
+        import shutil
+        dst = os.path.join(dest, member)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(os.path.join(archive, member), dst)
+    else:
+        raise ValueError("can't extract from format " + fmt)
+
+def archivemembers(meta, archivedir, pn, names, cmd7z='7za', backend='cmd'):
+    '''
+    Iterates over (member name, file object) of the regular files in the
+    archive of partition `pn`. For directories (copy, link), only `names`
+    are looked up. 7z archives are extracted to a temporary directory,
+    with `cmd7z`, or with py7zr if `backend` is 'py7zr' (except multi-volume
+    archives, which the py7zr backend leaves to 7z).
+    '''
+    fmt = meta['format']
+    archive = os.path.join(archivedir, meta['name'] % pn)
+    if fmt.startswith('tar'):
+        import tarfile
+        with tarfile.open(archive, 'r|*', encoding=DEFAULT_ENCODING) as tar:
+            for tarinfo in tar:
+                if tarinfo.isreg():
+                    yield tarinfo.name, tar.extractfile(tarinfo)
+    elif fmt == 'zip':
+        import zipfile
+        with zipfile.ZipFile(archive) as zipf:
+            for zinfo in zipf.infolist():
+                if not zinfo.is_dir():
+                    with zipf.open(zinfo) as f:
+                        yield zinfo.filename, f
+    elif fmt in ('7z', 'copy', 'link'):
+        tmpdir = None
+        if fmt == '7z':
+            import tempfile
+            import subprocess
+            tmpdir = tempfile.TemporaryDirectory(prefix='maxpacker-verify-')
+            if not os.path.isfile(archive) and os.path.isfile(archive + '.001'):
+                # multi-volume archive
+                subprocess.check_call([cmd7z, 'x', '-y', '-o' + tmpdir.name, '--', archive + '.001'], stdout=subprocess.DEVNULL)
+            elif backend == 'py7zr':
+                import py7zr
+                with py7zr.SevenZipFile(archive, 'r') as z:
+                    z.extractall(path=tmpdir.name)
+            else:
+                subprocess.check_call([cmd7z, 'x', '-y', '-o' + tmpdir.name, '--', archive], stdout=subprocess.DEVNULL)
+            archive = tmpdir.name
+        try:
+            for name in names:
+                fn = os.path.join(archive, name)
+                if os.path.isfile(fn):
+                    with open(fn, 'rb') as f:
+                        yield name, f
+        finally:
+            if tmpdir:
+                tmpdir.cleanup()
+    else:
+        raise ValueError("can't verify format " + fmt)
+
+def verifyarchive(meta, archivedir, pn, members, cmd7z='7za', bufsize=1048576, backend='cmd'):
+    '''
+    Reads the archive of partition `pn`, and compares the checksums of
+    its members with `members`, a dict of member names and digests (or None).
+    Returns (pn, number of files verified, problems), where problems is
+    a list of (member name, message).
+    '''
+    problems = []
+    verified = 0
+    seen = set()
+    try:
+        for name, f in archivemembers(meta, archivedir, pn, members, cmd7z, backend):
+            digest = members.get(name)
+            seen.add(name)
+            if digest is None:
+                continue
+            h = newhash(meta['checksum'])
+            while True:
+                data = f.read(bufsize)
+                if not data:
+                    break
+                h.update(data)
+            if h.digest() == digest:
+                verified += 1
+            else:
+                problems.append((name, 'checksum mismatch'))
+    except Exception as ex:
+        problems.append(('', '%s: %s' % (type(ex).__name__, ex)))
+        return pn, verified, problems
+    for name, digest in members.items():
+        if digest is not None and name not in seen:
+            problems.append((name, 'missing'))
+    return pn, verified, problems
+
+def verifyarchives(lookup, archivedir, jobs=None, cmd7z='7za', backend='cmd'):
+    '''
+    Verifies the archives of a lookup table against the recorded checksums,
+    one archive per process in `jobs` processes (Default: number of CPUs).
+    7z archives are read with `cmd7z` or py7zr, see `archivemembers`.
+    Returns a dict of partition numbers and their problems.
+    '''
+    if not lookup.digestsize:
+        raise ValueError('the lookup table has no checksums, create it with --checksum')
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    members = collections.defaultdict(dict)
+    # files with data but no checksum, which should have one
+    nosum = collections.defaultdict(list)
+    for i in range(len(lookup)):
+        path, pn, offset, size = lookup.record(i)
+        name = path.decode('utf-8', 'surrogateescape')
+        digest = lookup.digest(i)
+        members[pn][name] = digest
+        if digest is None and size:
+            nosum[pn].append(name)
+    errors = {}
+    total = unchecked = 0
+    eta = ETA(len(members), min_ms_between_updates=500)
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(verifyarchive, lookup.meta, archivedir, pn, members[pn], cmd7z, backend=backend)
+                   for pn in sorted(members)]
+        for k, future in enumerate(as_completed(futures), 1):
+            pn, verified, problems = future.result()
+            total += verified
+            unchecked += sum(1 for digest in members[pn].values() if digest is None) - len(nosum[pn])
+            problems.extend((name, 'no checksum recorded') for name in nosum[pn])
+            for name, msg in problems:
+                logging.error('%s: %s%s' % (lookup.meta['name'] % pn, name + ': ' if name else '', msg))
+            if problems:
+                errors[pn] = '%d problem(s)' % len(problems)
+            eta.print_status(k)
+    eta.done()
+    logging.info('Verified %d files in %d archives, %d empty, %d archives with problems.' % (
+        total, len(members), unchecked, len(errors)))
+    return errors
 
 # Composition support magic from Whoosh
 
@@ -435,6 +1865,54 @@ class TimeFilter(Filter):
         return ((self.mintime is None or filetime >= self.mintime)
             and (self.maxtime is None or filetime <= self.maxtime))
 
+class Selector:
+    '''
+    Orders the files for the total size limit, most wanted first.
+    smallest: smallest estimated size first, to keep the most files
+    newest: latest modification time first
+    priority: files matching earlier rsync-style `patterns` first,
+              then smallest first
+    '''
+    policies = ('smallest', 'newest', 'priority')
+
+    def __init__(self, policy='smallest', patterns=()):
+        if policy not in self.policies:
+            raise ValueError('unknown selection policy ' + policy)
+        self.policy = policy
+        self.rsync = RsyncFilter()
+        self.patterns = tuple(map(self.rsync.translate, patterns))
+
+    def __repr__(self):
+        return "Selector(%r, %d patterns)" % (self.policy, len(self.patterns))
+
+    def rank(self, filename):
+        for k, pattern in enumerate(self.patterns):
+            if self.rsync.match(pattern, filename):
+                return k
+        return len(self.patterns)
+
+    def order(self, fl, sizes, mtimes):
+        '''
+        Returns the indices of the file list `fl` in order.
+        `sizes` is an array of the estimated sizes.
+        '''
+        if self.policy == 'newest':
+            return sorted(range(len(fl)), key=mtimes.__getitem__, reverse=True)
+        elif self.policy == 'priority':
+            ranks = array.array('l', (self.rank(fn) for fn, origsize, size in fl))
+            return sorted(range(len(fl)), key=lambda i: (ranks[i], sizes[i]))
+        return sorted(range(len(fl)), key=sizes.__getitem__)
+
+    def rowkey(self):
+        '''
+        Returns (key, reverse) for sorting the (entry, mtime) rows of a `FileTable`.
+        '''
+        if self.policy == 'newest':
+            return _ig1, True
+        elif self.policy == 'priority':
+            return (lambda row: (self.rank(row[0][0]), row[0][2])), False
+        return (lambda row: row[0][2]), False
+
 # Packing methods
 
 def sortbyext(val):
@@ -449,10 +1927,358 @@ def sortbyextlocal(val):
     ext = ext.lower().lstrip('.')
     return head, exts_ord.get(ext, 999), ext, base
 
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap with one struct fiemap_extent
+_fiemap = struct.Struct('=QQLLLL' + 'QQQQQLLLL')
+
+def physicalkey(path, offset=0):
+    '''
+    Returns a sort key for the physical location of a file on disk:
+    (physical offset of the first extent from FIEMAP, inode number).
+    The physical offset is 0 if FIEMAP is not available.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return 0, 0
+    try:
+        ino = os.fstat(fd).st_ino
+        try:
+            import fcntl
+            buf = bytearray(_fiemap.pack(offset, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0, *([0] * 9)))
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+            fields = _fiemap.unpack(buf)
+            # fm_mapped_extents, fe_physical
+            if fields[3]:
+                return fields[7], ino
+        except (ImportError, OSError):
+            pass
+        return 0, ino
+    finally:
+        os.close(fd)
+
+class FileChunk(str):
+    '''
+    A byte range of a file, packed as an independent item.
+    The string value is the member name, like `filename.001`.
+    '''
+
+    def __new__(cls, filename, offset, length, num):
+        self = super().__new__(cls, '%s.%03d' % (filename, num))
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+        self.num = num
+        return self
+
+    def __getnewargs__(self):
+        return self.filename, self.offset, self.length, self.num
+
+def _removefiles(filenames):
+    for fn in filenames:
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+class TableStore:
+    '''
+    Creates `FileTable`s in a temporary directory, and flushes their buffers
+    to disk when the buffered entries take more than `budget` bytes.
+    '''
+    maxmapped = 64
+
+    def __init__(self, budget, dirname=None):
+        import shutil
+        import tempfile
+        self.budget = budget
+        self.dirname = tempfile.mkdtemp(prefix='maxpacker-', dir=dirname)
+        self.buffered = 0
+        self.count = 0
+        self.tables = weakref.WeakSet()
+        self.mapped = collections.OrderedDict()
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.dirname, True)
+
+    def __repr__(self):
+        return "<TableStore dirname=%r budget=%r>" % (self.dirname, self.budget)
+
+    def new(self, width=3):
+        self.count += 1
+        table = FileTable(self, os.path.join(self.dirname, str(self.count)), width)
+        self.tables.add(table)
+        return table
+
+    def grow(self, nbytes):
+        self.buffered += nbytes
+        if self.buffered > self.budget:
+            for table in list(self.tables):
+                table.flush()
+
+    def touch(self, table):
+        # limit the number of open mappings (and file descriptors)
+        self.mapped[id(table)] = weakref.ref(table)
+        self.mapped.move_to_end(id(table))
+        while len(self.mapped) > self.maxmapped:
+            table = self.mapped.popitem(last=False)[1]()
+            if table is not None:
+                table.unmap()
+
+    def close(self):
+        for table in list(self.tables):
+            table.unmap()
+        self._finalizer()
+
+class TableColumn:
+    '''
+    A read-only view of a column of a `FileTable`.
+    '''
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, key):
+        return self.table.columns(key, key + 1)[self.name][0]
+
+    def __iter__(self):
+        for start in range(0, len(self.table), self.table.blocksize):
+            yield from self.table.columns(start, start + self.table.blocksize)[self.name]
+
+class FileTable:
+    '''
+    A list of (filename, origsize, size) entries, stored in column files on
+    disk and read through mmap, for file lists that don't fit in the memory.
+    The modification time of each entry is kept in another column.
+    Set `width` to 2 for (filename, size) entries.
+    New entries are kept in the memory until the store flushes them.
+    '''
+    COLUMNS = (('size', 'q'), ('estsize', 'q'), ('mtime', 'd'), ('end', 'Q'))
+    # estimated memory usage of an entry as Python objects, for sorting
+    entrymem = 320
+    blocksize = 65536
+
+    def __init__(self, store, basename, width=3):
+        self.store = store
+        self.basename = basename
+        self.width = width
+        self.length = 0
+        self.pathlen = 0
+        self.buf = {}
+        self.pathbuf = bytearray()
+        self.bufsize = 0
+        self.maps = None
+        self.clear()
+        self._finalizer = weakref.finalize(self, _removefiles, self.filenames())
+
+    def __repr__(self):
+        return "<FileTable %r len=%r>" % (self.basename, len(self))
+
+    def filenames(self):
+        return ['%s.%s' % (self.basename, name) for name, typecode in self.COLUMNS + (('path', 'B'),)]
+
+    def clear(self):
+        self.buf = {name: array.array(typecode) for name, typecode in self.COLUMNS}
+        self.pathbuf = bytearray()
+        self.store.buffered -= self.bufsize
+        self.bufsize = 0
+
+    def __len__(self):
+        return self.length + len(self.buf['size'])
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def append(self, entry, mtime=0.0):
+        name = entry[0].encode('utf-8', 'surrogateescape')
+        self.pathbuf += name
+        self.buf['size'].append(entry[1])
+        self.buf['estsize'].append(entry[2] if self.width > 2 else entry[1])
+        self.buf['mtime'].append(mtime)
+        self.buf['end'].append(self.pathlen + len(self.pathbuf))
+        nbytes = len(name) + 32
+        self.bufsize += nbytes
+        self.store.grow(nbytes)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def flush(self):
+        if not self.bufsize:
+            return
+        self.unmap()
+        for name, typecode in self.COLUMNS:
+            with open('%s.%s' % (self.basename, name), 'ab') as f:
+                self.buf[name].tofile(f)
+        with open(self.basename + '.path', 'ab') as f:
+            f.write(self.pathbuf)
+        self.length += len(self.buf['size'])
+        self.pathlen += len(self.pathbuf)
+        self.clear()
+
+    def map(self):
+        if self.maps is None:
+            self.maps = {}
+            for fn, name in zip(self.filenames(), [c[0] for c in self.COLUMNS] + ['path']):
+                with open(fn, 'r+b') as f:
+                    self.maps[name] = mmap.mmap(f.fileno(), 0)
+        self.store.touch(self)
+        return self.maps
+
+    def unmap(self):
+        if self.maps is not None:
+            for mm in self.maps.values():
+                mm.close()
+            self.maps = None
+            self.store.mapped.pop(id(self), None)
+
+    def columns(self, start, stop):
+        '''
+        Returns the columns of entries [start, stop), with the paths
+        in 'path' (bytes) and 'pathstart' (the offset of the first path).
+        '''
+        stop = min(stop, len(self))
+        columns = {name: array.array(typecode) for name, typecode in self.COLUMNS}
+        path = b''
+        pathstart = 0
+        if start < self.length:
+            maps = self.map()
+            end = min(stop, self.length)
+            for name, typecode in self.COLUMNS:
+                columns[name].frombytes(maps[name][start * 8:end * 8])
+            if start:
+                pathstart = struct.unpack_from('Q', maps['end'], (start - 1) * 8)[0]
+            path = maps['path'][pathstart:columns['end'][-1]] if end > start else b''
+        if stop > self.length:
+            bstart = max(start - self.length, 0)
+            bstop = stop - self.length
+            if start >= self.length:
+                pathstart = self.buf['end'][bstart - 1] if bstart else self.pathlen
+            for name, typecode in self.COLUMNS:
+                columns[name].extend(self.buf[name][bstart:bstop])
+            path += self.pathbuf[pathstart + len(path) - self.pathlen:columns['end'][-1] - self.pathlen]
+        columns['path'] = path
+        columns['pathstart'] = pathstart
+        return columns
+
+    def rows(self, start=0, stop=None):
+        '''
+        Yields (entry, mtime) of entries [start, stop).
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        for bstart in range(start, stop, self.blocksize):
+            columns = self.columns(bstart, min(bstart + self.blocksize, stop))
+            path = columns['path']
+            pos = columns['pathstart']
+            offset = pos
+            for size, estsize, mtime, end in zip(columns['size'], columns['estsize'], columns['mtime'], columns['end']):
+                name = path[pos - offset:end - offset].decode('utf-8', 'surrogateescape')
+                pos = end
+                if self.width > 2:
+                    yield (name, size, estsize), mtime
+                else:
+                    yield (name, size), mtime
+
+    def __iter__(self):
+        for entry, mtime in self.rows():
+            yield entry
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [entry for k, (entry, mtime) in enumerate(self.rows(*key.indices(len(self))[:2]))
+                    if k % (key.step or 1) == 0]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('FileTable index out of range')
+        return next(self.rows(key, key + 1))[0]
+
+    def __setitem__(self, key, entry):
+        '''
+        Updates the sizes of an entry. The filename can't be changed.
+        '''
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('FileTable index out of range')
+        size = entry[1]
+        estsize = entry[2] if self.width > 2 else entry[1]
+        if key >= self.length:
+            self.buf['size'][key - self.length] = size
+            self.buf['estsize'][key - self.length] = estsize
+        else:
+            maps = self.map()
+            struct.pack_into('q', maps['size'], key * 8, size)
+            struct.pack_into('q', maps['estsize'], key * 8, estsize)
+
+    def column(self, name):
+        return TableColumn(self, name)
+
+    def sortedrows(self, key=None, reverse=False, rowkey=None):
+        '''
+        Yields (entry, mtime) sorted by `key` of the entries, or `rowkey` of
+        the (entry, mtime) rows, with an external merge sort if the entries
+        don't fit in the budget.
+        '''
+        rowkey = rowkey or ((lambda row: key(row[0])) if key else _ig0)
+        runlen = max(self.store.budget // self.entrymem, 1)
+        if len(self) <= runlen:
+            yield from sorted(self.rows(), key=rowkey, reverse=reverse)
+            return
+        runs = []
+        rows = self.rows()
+        while True:
+            run = list(itertools.islice(rows, runlen))
+            if not run:
+                break
+            run.sort(key=rowkey, reverse=reverse)
+            table = self.store.new(self.width)
+            for entry, mtime in run:
+                table.append(entry, mtime)
+            del run
+            table.flush()
+            runs.append(table)
+        yield from heapq.merge(*(table.rows() for table in runs), key=rowkey, reverse=reverse)
+
+    def sorted(self, key=None, reverse=False):
+        for entry, mtime in self.sortedrows(key, reverse):
+            yield entry
+
+    def sort(self, key=None, reverse=False):
+        table = self.store.new(self.width)
+        for entry, mtime in self.sortedrows(key, reverse):
+            table.append(entry, mtime)
+        table.flush()
+        # take over the files of the sorted table
+        self.unmap()
+        self.clear()
+        table.unmap()
+        for src, dst in zip(table.filenames(), self.filenames()):
+            if os.path.exists(src):
+                os.replace(src, dst)
+            else:
+                _removefiles((dst,))
+        self.length = table.length
+        self.pathlen = table.pathlen
+
+def sortentries(filelist, key=None, reverse=False):
+    '''
+    Like `sorted`, but sorts `FileTable`s out of core.
+    '''
+    if isinstance(filelist, FileTable):
+        return filelist.sorted(key, reverse)
+    return sorted(filelist, key=key, reverse=reverse)
+
 class Partition:
-    def __init__(self):
-        self.filelist = []
+
+    def __init__(self, store=None):
+        # file list in a TableStore `store`, or in memory
+        self.filelist = store.new() if store else []
         self.size = 0
+        self.origsize = 0
 
     def __repr__(self):
         return "<Partition size=%r numfiles=%r>" % (self.size, self.numfiles)
@@ -472,14 +2298,18 @@ class Partition:
     def addfile(self, filename, origsize, size):
         self.filelist.append((filename, origsize, size))
         self.size += size
+        self.origsize += origsize
 
-    def sortfile(self, level=0):
+    def sortfile(self, level=0, basedir='.'):
         '''
         Sort file according to filename:
         0: No sort
         1: Normal sort
         2: Local 7z-style sort (within a directory)
         3: Global 7z-style sort (within a partition)
+        Or according to the location on disk, to reduce seeks:
+        4: Physical order
+        5: Local 7z-style sort, directories in physical order
         '''
         if level == 0:
             return
@@ -489,9 +2319,32 @@ class Partition:
             key = sortbyext
         elif level == 3:
             key = sortbyextlocal
+        elif level in (4, 5):
+            key = self.physicalsortkey(level, basedir)
         self.filelist.sort(key=key)
 
+    def physicalsortkey(self, level, basedir):
+        physkeys = {}
+        for fn, origsize, size in self.filelist:
+            if isinstance(fn, FileChunk):
+                physkeys[fn] = physicalkey(os.path.join(basedir, fn.filename), fn.offset)
+            else:
+                physkeys[fn] = physicalkey(os.path.join(basedir, fn))
+        if level == 4:
+            return lambda val: physkeys[val[0]]
+        dirkeys = {}
+        for fn, physkey in physkeys.items():
+            head = os.path.dirname(fn)
+            dirkeys[head] = min(dirkeys.get(head, physkey), physkey)
+        def key(val):
+            extkey = sortbyextlocal(val)
+            return dirkeys[extkey[0]], extkey
+        return key
+
 class PackerBase:
+    # TableStore for the file lists of the partitions, or None to keep them in memory
+    store = None
+
     def __repr__(self):
         attrs = ""
         if self.__dict__:
@@ -501,9 +2354,12 @@ class PackerBase:
     def dispatch(self, filelist):
         raise NotImplementedError
 
+    def newpartition(self):
+        return Partition(self.store)
+
 class SingleVolumePacker(PackerBase):
     def dispatch(self, filelist):
-        part = Partition()
+        part = self.newpartition()
         for filename, origsize, size in filelist:
             part.addfile(filename, origsize, size)
         return [part]
@@ -517,120 +2373,698 @@ class LimitPacker(PackerBase):
     def dispatch(self, filelist):
         partitions = self.single_dispatch(filelist, self.maxsize, self.maxentries)
         # efficiently split large files (in Partition 0) across partitions
-        if self.multipart:
+        # (there is no Partition 0 of large files without maxsize)
+        if self.multipart and self.maxsize:
             multipart = 1
             while partitions[0]:
                 multipart += 1
-                temppart = self.single_dispatch(partitions[0].filelist + partitions.pop().filelist, self.maxsize*multipart, self.maxentries)
+                temppart = self.single_dispatch(itertools.chain(partitions[0].filelist, partitions.pop().filelist), self.maxsize*multipart, self.maxentries)
                 partitions[0] = temppart[0]
                 partitions.extend(filter(None, temppart[1:]))
             partitions.pop(0)
         return partitions
 
-    def single_dispatch(self, filelist, maxsize=0, maxentries=0):
-        if maxsize:
-            # when maxsize is used, create a default partition (Partition 0)
-            #   that will hold files that does not match criteria
-            partitions = [Partition(), Partition()]
-            pn = startp = 1
+    def single_dispatch(self, filelist, maxsize=0, maxentries=0):
+        if maxsize:
+            # when maxsize is used, create a default partition (Partition 0)
+            #   that will hold files that does not match criteria
+            partitions = [self.newpartition(), self.newpartition()]
+            pn = startp = 1
+        else:
+            partitions = [self.newpartition()]
+            pn = startp = 0
+        for filename, origsize, size in filelist:
+            if 0 < maxsize < size:
+                partitions[0].addfile(filename, origsize, size)
+            else:
+                # examine each partition
+                while pn < len(partitions):
+                    # if file does not fit in partition
+                    if ((maxentries > 0) and (len(partitions[pn]) + 1 > maxentries)) or ((maxsize > 0) and (partitions[pn].size + size > maxsize)):
+                        # and we reached last partition, chain a new one
+                        if pn == len(partitions) - 1:
+                            partitions.append(self.newpartition())
+                        # examine next partition
+                        pn += 1
+                    else:
+                        # file fits in current partition, add it
+                        partitions[pn].addfile(filename, origsize, size)
+                        # examine next file
+                        break
+            # examine next file
+            # come back to the first partition
+            pn = startp
+        return partitions
+
+def groupkey(val):
+    head, tail = os.path.split(val[0])
+    base, ext = os.path.splitext(tail)
+    ext = ext.lower().lstrip('.')
+    return exts_ord.get(ext, 999), ext, head, base
+
+class GroupLimitPacker(LimitPacker):
+    '''
+    Keeps similar files together for better solid compression.
+    Files are ordered by extension class and directory, then filled into
+    partitions one after another, so a group is only split where
+    a partition is full.
+    '''
+
+    def single_dispatch(self, filelist, maxsize=0, maxentries=0):
+        if maxsize:
+            partitions = [self.newpartition(), self.newpartition()]
+        else:
+            partitions = [self.newpartition()]
+        for filename, origsize, size in sortentries(filelist, key=groupkey):
+            if 0 < maxsize < size:
+                partitions[0].addfile(filename, origsize, size)
+                continue
+            part = partitions[-1]
+            if ((maxentries > 0) and (len(part) + 1 > maxentries)) or ((maxsize > 0) and (part.size + size > maxsize)):
+                part = self.newpartition()
+                partitions.append(part)
+            part.addfile(filename, origsize, size)
+        return partitions
+
+class PartNumberLimitPacker(PackerBase):
+    def __init__(self, numentries):
+        self.numentries = numentries
+
+    def dispatch(self, filelist):
+        # our list of partitions
+        partitions = [self.newpartition() for i in range(self.numentries)]
+        # sort files with a fixed size of partitions
+        filelist.sort(key=_ig1, reverse=True)
+        emptyfiles = []
+        # dispatch files
+        for filename, origsize, size in filelist:
+            if size > 0:
+                # find most approriate partition
+                part = min(partitions, key=_psize)
+                # assign it and load the partition with file size
+                part.addfile(filename, origsize, size)
+            else:
+                emptyfiles.append((filename, origsize, size))
+        # re-dispatch empty files
+        fpp, rem = divmod(len(emptyfiles), len(partitions))
+        n = 0
+        for part in partitions:
+            for i in range(fpp):
+                part.addfile(*emptyfiles[n])
+                n += 1
+        for i in range(rem):
+            part.addfile(*emptyfiles[n])
+            n += 1
+        assert n == len(emptyfiles)
+        return partitions
+
+def hashzeros(hasher, length, bufsize=1048576):
+    '''
+    Updates `hasher` with `length` zero bytes, the contents of a hole.
+    '''
+    if length <= 0:
+        return
+    zeros = memoryview(bytes(min(length, bufsize)))
+    while length > 0:
+        hasher.update(zeros[:length])
+        length -= len(zeros)
+
+def copysparse(src, dst, bufsize=1048576, hasher=None):
+    '''
+    Copies a file with its metadata like `shutil.copy2`, but keeps the holes.
+    `hasher` is updated with the file contents, holes included.
+    '''
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        # end of the data hashed
+        pos = 0
+        for offset, length in dataextents(fsrc.fileno(), size):
+            end = offset + length
+            while offset < end:
+                buf = os.pread(fsrc.fileno(), min(bufsize, end - offset), offset)
+                if not buf:
+                    break
+                os.pwrite(fdst.fileno(), buf, offset)
+                if hasher:
+                    hashzeros(hasher, offset - pos)
+                    hasher.update(buf)
+                    pos = offset + len(buf)
+                offset += len(buf)
+        fdst.truncate(size)
+        if hasher:
+            hashzeros(hasher, size - pos)
+    import shutil
+    shutil.copystat(src, dst)
+
+BUFSIZE = 1048576
+
+def fadvise(fd, offset, length, advice):
+    '''
+    Gives an I/O hint, eg. 'SEQUENTIAL', 'WILLNEED' or 'DONTNEED', if supported.
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_' + advice))
+        except OSError:
+            pass
+
+class SourceFile:
+    '''
+    Reads a source file, or `length` bytes from `offset` of it, with large
+    buffers. The kernel is told that the file is read sequentially, and the
+    pages read are dropped from the page cache on close, unless `keepcache`.
+    '''
+
+    def __init__(self, filename, offset=0, length=None, bufsize=BUFSIZE, keepcache=False, hasher=None, onclose=None):
+        self.name = filename
+        self.fd = os.open(filename, os.O_RDONLY)
+        self.start = self.pos = offset
+        if length is None:
+            length = os.fstat(self.fd).st_size - offset
+        self.end = offset + length
+        self.bufsize = bufsize
+        self.keepcache = keepcache
+        # hash object updated with the data read, and
+        # onclose(self) is called if the whole range has been read
+        self.hasher = hasher
+        self.onclose = onclose
+        fadvise(self.fd, offset, length, 'SEQUENTIAL')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.end - self.pos
+        size = min(size, self.end - self.pos)
+        buf = []
+        while size > 0:
+            data = os.pread(self.fd, min(size, self.bufsize), self.pos)
+            if not data:
+                break
+            if self.hasher:
+                self.hasher.update(data)
+            buf.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return b''.join(buf)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if not self.keepcache:
+            fadvise(self.fd, self.start, self.pos - self.start, 'DONTNEED')
+        os.close(self.fd)
+        self.fd = None
+        if self.onclose and self.pos == self.end:
+            self.onclose(self)
+
+class SourceStream(io.BufferedIOBase):
+    '''
+    A `SourceFile` as a binary stream, for APIs that want an io object,
+    like py7zr's `writef`. Seeking is only for finding the size:
+    the data skipped is not hashed.
+    '''
+
+    def __init__(self, src):
+        super().__init__()
+        self.src = src
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.src.read(size)
+
+    read1 = read
+
+    def tell(self):
+        return self.src.pos - self.src.start
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: self.src.start, io.SEEK_CUR: self.src.pos, io.SEEK_END: self.src.end}[whence]
+        self.src.pos = min(max(base + offset, self.src.start), self.src.end)
+        return self.tell()
+
+class Prefetcher:
+    '''
+    Asks the kernel to read ahead the next files in a background thread,
+    while the current file is being compressed.
+    '''
+
+    def __init__(self, depth=1):
+        import queue
+        self.queue = queue.Queue(depth)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            filename, offset, length = item
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except OSError:
+                continue
+            fadvise(fd, offset, length, 'WILLNEED')
+            os.close(fd)
+
+    def push(self, filename, offset=0, length=0):
+        import queue
+        try:
+            self.queue.put_nowait((filename, offset, length))
+        except queue.Full:
+            # fallen behind, skip the hint
+            pass
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class SparseReader:
+    '''
+    File-like object that reads a GNU sparse 1.0 member body:
+    the sparse map, followed by the data regions of the file.
+    Like `SourceFile`, `hasher` is updated with the file contents of
+    `size` bytes, holes included, and onclose(self) is called at the end.
+    '''
+
+    def __init__(self, fileobj, sparsemap, extents, size=0, hasher=None, onclose=None):
+        self.fd = fileobj.fileno()
+        self.sparsemap = sparsemap
+        self.extents = list(extents)
+        self.pos = 0
+        self.size = size
+        self.hasher = hasher
+        self.onclose = onclose
+        # end of the data hashed
+        self.hashed = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.sparsemap) + sum(length for offset, length in self.extents) - self.pos
+        buf = []
+        if self.sparsemap:
+            buf.append(self.sparsemap[:size])
+            self.sparsemap = self.sparsemap[size:]
+            size -= len(buf[-1])
+        while size > 0 and self.extents:
+            offset, length = self.extents[0]
+            chunk = os.pread(self.fd, min(length - self.pos, size), offset + self.pos)
+            if not chunk:
+                break
+            if self.hasher:
+                hashzeros(self.hasher, offset + self.pos - self.hashed)
+                self.hasher.update(chunk)
+                self.hashed = offset + self.pos + len(chunk)
+            buf.append(chunk)
+            size -= len(chunk)
+            self.pos += len(chunk)
+            if self.pos >= length:
+                self.extents.pop(0)
+                self.pos = 0
+        if self.hasher and not (self.sparsemap or self.extents):
+            hashzeros(self.hasher, self.size - self.hashed)
+            self.hashed = self.size
+            if self.onclose:
+                self.onclose(self)
+                self.onclose = None
+        return b''.join(buf)
+
+def tar_addsparse(tar, name, arcname, hasher=None, onclose=None):
+    '''
+    Adds a sparse file to `tar` as a GNU sparse 1.0 (PAX) member.
+    Returns False if the file is not sparse.
+    `hasher` and `onclose` record the checksum, see `SparseReader`.
+    '''
+    import tarfile
+    st = os.lstat(name)
+    if not issparse(st):
+        return False
+    tarinfo = tar.gettarinfo(name, arcname)
+    if not tarinfo.isreg():
+        return False
+    with open(name, 'rb') as f:
+        extents = list(dataextents(f.fileno(), st.st_size))
+        entries = extents
+        if not extents or sum(extents[-1]) < st.st_size:
+            # GNU tar marks a trailing hole with an empty region
+            entries = extents + [(st.st_size, 0)]
+        sparsemap = ('%d\n' % len(entries) + ''.join('%d\n%d\n' % e for e in entries)).encode('ascii')
+        sparsemap += tarfile.NUL * (-len(sparsemap) % tarfile.BLOCKSIZE)
+        head, tail = os.path.split(tarinfo.name)
+        tarinfo.pax_headers = {
+            'GNU.sparse.major': '1',
+            'GNU.sparse.minor': '0',
+            'GNU.sparse.name': tarinfo.name,
+            'GNU.sparse.realsize': str(st.st_size),
+        }
+        tarinfo.name = os.path.join(head, 'GNUSparseFile.0', tail)
+        tarinfo.size = len(sparsemap) + sum(length for offset, length in extents)
+        tar.addfile(tarinfo, SparseReader(f, sparsemap, extents, st.st_size, hasher, onclose))
+    return True
+
+class CodecPolicy:
+    '''
+    Chooses how hard to compress a partition, from its estimated
+    compression ratio (estimated size / original size):
+    'store' if the ratio is above `store`, 'fast' if above `fast`,
+    otherwise 'strong'.
+    '''
+
+    def __init__(self, store=0.95, fast=0.7):
+        self.store = store
+        self.fast = fast
+
+    def __repr__(self):
+        return "%s(store=%r, fast=%r)" % (self.__class__.__name__, self.store, self.fast)
+
+    def __call__(self, part):
+        ratio = part.size / part.origsize if part.origsize else 1
+        if ratio > self.store:
+            return 'store'
+        elif ratio > self.fast:
+            return 'fast'
+        return 'strong'
+
+# Archive sinks
+
+class FileSink:
+    '''
+    Writes each archive to a file in the `dst` directory.
+    '''
+    streaming = False
+
+    def __init__(self, dst):
+        self.dst = dst
+
+    def open(self, name):
+        d = os.path.abspath(os.path.join(self.dst, name))
+        if os.path.isfile(d):
+            logging.warning('Archive already exists, overwriting: ' + d)
+        return open(d, 'wb')
+
+    def close(self, fileobj):
+        fileobj.close()
+
+class CountingWriter:
+    '''
+    Counts the bytes written to a file-like object.
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.count += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.count
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        pass
+
+class StreamSink(FileSink):
+    '''
+    Writes all archives one after another to a named pipe, or stdout if `dst` is '-'.
+    '''
+    streaming = True
+
+    def open(self, name):
+        if self.dst == '-':
+            return sys.stdout.buffer
+        return open(self.dst, 'wb')
+
+    def close(self, fileobj):
+        if fileobj is sys.stdout.buffer:
+            fileobj.flush()
         else:
-            partitions = [Partition()]
-            pn = startp = 0
-        for filename, origsize, size in filelist:
-            if 0 < maxsize < size:
-                partitions[0].addfile(filename, origsize, size)
-            else:
-                # examine each partition
-                while pn < len(partitions):
-                    # if file does not fit in partition
-                    if ((maxentries > 0) and (len(partitions[pn]) + 1 > maxentries)) or ((maxsize > 0) and (partitions[pn].size + size > maxsize)):
-                        # and we reached last partition, chain a new one
-                        if pn == len(partitions) - 1:
-                            partitions.append(Partition())
-                        # examine next partition
-                        pn += 1
-                    else:
-                        # file fits in current partition, add it
-                        partitions[pn].addfile(filename, origsize, size)
-                        # examine next file
-                        break
-            # examine next file
-            # come back to the first partition
-            pn = startp
-        return partitions
+            fileobj.close()
 
-class PartNumberLimitPacker(PackerBase):
-    def __init__(self, numentries):
-        self.numentries = numentries
+class PipeSink(FileSink):
+    '''
+    Pipes each archive to a shell command, where `%s` in the command
+    is replaced by the archive name. Writes block when the command is busy.
+    '''
+    streaming = True
 
-    def dispatch(self, filelist):
-        # our list of partitions
-        partitions = [Partition() for i in range(self.numentries)]
-        # sort files with a fixed size of partitions
-        filelist.sort(key=_ig1, reverse=True)
-        emptyfiles = []
-        # dispatch files
-        for filename, origsize, size in filelist:
-            if size > 0:
-                # find most approriate partition
-                part = min(partitions, key=_psize)
-                # assign it and load the partition with file size
-                part.addfile(filename, origsize, size)
-            else:
-                emptyfiles.append((filename, origsize, size))
-        # re-dispatch empty files
-        fpp, rem = divmod(len(emptyfiles), len(partitions))
-        n = 0
-        for part in partitions:
-            for i in range(fpp):
-                part.addfile(*emptyfiles[n])
-                n += 1
-        for i in range(rem):
-            part.addfile(*emptyfiles[n])
-            n += 1
-        assert n == len(emptyfiles)
-        return partitions
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+
+    def open(self, name):
+        import subprocess
+        cmd = self.cmd.replace('%s', shlex.quote(name))
+        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+        return self.proc.stdin
+
+    def close(self, fileobj):
+        try:
+            fileobj.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.proc.wait()
+        if returncode:
+            import subprocess
+            raise subprocess.CalledProcessError(returncode, self.proc.args)
 
 class OutputBase:
+    fmt = 'none'
+    bufsize = BUFSIZE
+    keepcache = False
+    prefetch = True
+    # a CodecPolicy, or None to use the default level
+    policy = None
+    # an EstimateStats to learn from the archive sizes
+    eststats = None
+    # a Journal to record the completed partitions
+    journal = None
+    # partitions completed in a previous run
+    skip = frozenset()
+    # an eta.StatusServer to report the progress to
+    status = None
+    # checksum algorithm (see `newhash`) of the files to record while reading them, or None
+    checksum = None
+    # progress bar class, see eta.ETA
+    progressbar = ETA
+
     def __init__(self, srcbase, dst, name=None):
         self.srcbase = srcbase
         self.dst = dst
         self.name = name or '%03d'
+        # member name -> offset of its header in the archive
+        self.offsets = {}
+        # member name -> checksum digest
+        self.checksums = {}
 
     def output(self, partitions):
         pass
 
+    def opensrc(self, fn, keepcache=None):
+        '''
+        Opens a file, or a file chunk, to read with `SourceFile`.
+        The checksum of the data is recorded when it has been read.
+        '''
+        if keepcache is None:
+            keepcache = self.keepcache
+        hasher, onclose = self.hashing(fn)
+        if isinstance(fn, FileChunk):
+            return SourceFile(os.path.join(self.srcbase, fn.filename), fn.offset, fn.length, self.bufsize, keepcache, hasher, onclose)
+        return SourceFile(os.path.join(self.srcbase, fn), bufsize=self.bufsize, keepcache=keepcache, hasher=hasher, onclose=onclose)
+
+    def hashing(self, fn):
+        '''
+        Returns (hash object, onclose callback) to record the checksum of `fn`
+        when it has been read, or (None, None) without `checksum`.
+        '''
+        if not self.checksum:
+            return None, None
+        return newhash(self.checksum), functools.partial(self.recordsum, fn)
+
+    def recordsum(self, fn, src):
+        self.checksums[fn] = src.hasher.digest()
+
+    def unfinished(self, partitions):
+        '''
+        Returns a list of (number, partition) of the partitions to be created,
+        skipping the ones completed in a previous run.
+        `partitions` is a list, or a dict of number -> partition.
+        '''
+        if self.status:
+            self.status.set(partitions_total=len(partitions))
+        todo = []
+        items = partitions.items() if isinstance(partitions, dict) else enumerate(partitions)
+        for pn, part in items:
+            if pn in self.skip:
+                logging.info('Skipping completed partition %s' % (self.name % pn))
+                if self.status:
+                    self.status.add(partitions_done=1)
+                continue
+            todo.append((pn, part))
+        return todo
+
+    def pending(self, partitions):
+        '''
+        Iterates over (number, partition) of the partitions to be created.
+        '''
+        for pn, part in self.unfinished(partitions):
+            if self.status:
+                self.status.worker('main', state='archiving', partition=pn, archive=self.name % pn)
+            yield pn, part
+            if self.status:
+                self.status.add(partitions_done=1)
+        if self.status:
+            self.status.worker('main', state='idle')
+
+    def advance(self, nbytes, files=1):
+        '''
+        Reports the files written to the status server.
+        '''
+        if self.status:
+            self.status.add(files_done=files, bytes_done=nbytes)
+
+    def done(self, pn, part, files=None):
+        '''
+        Records a completed partition, its archive files, and the offsets and
+        checksums of its members in the journal.
+        '''
+        if self.journal is None:
+            return
+        if files is None:
+            sink = getattr(self, 'sink', None)
+            if sink is None or sink.streaming:
+                files = ()
+            else:
+                files = (os.path.abspath(os.path.join(self.dst, self.name % pn)),)
+        names = (fn for fn, size, estsize in part.filelist)
+        self.journal.done(pn, files, journalmembers(names, self.offsets, self.checksums))
+
+    def feedback(self, pn, part, actual, extsizes=None):
+        '''
+        Compares the actual archive size with the estimated size.
+        '''
+        if part.size:
+            logging.info('Archive %s: %s, estimated %s (%+.1f%%)' % (
+                self.name % pn, sizeof_fmt(actual), sizeof_fmt(part.size), (actual - part.size) / part.size * 100))
+        if self.eststats:
+            self.eststats.record(part, actual, extsizes)
+            self.eststats.save()
+
+    def chooselevel(self, pn, part):
+        '''
+        Returns 'store', 'fast', 'strong' or None (default) for a partition.
+        '''
+        if self.eststats:
+            self.eststats.correct(part)
+        if self.policy is None:
+            logging.info('Creating archive %s...' % (self.name % pn))
+            return None
+        level = self.policy(part)
+        logging.info('Creating archive %s (%s)...' % (self.name % pn, level))
+        return level
+
+    def iterpart(self, part):
+        '''
+        Iterates over the files of a partition, and reads ahead the next file.
+        '''
+        if not self.prefetch:
+            for item in part.filelist:
+                yield item
+                self.advance(item[1])
+            return
+        prefetcher = Prefetcher()
+        try:
+            filelist = part.filelist
+            for k, item in enumerate(filelist):
+                if k + 1 < len(filelist):
+                    fn = filelist[k+1][0]
+                    if isinstance(fn, FileChunk):
+                        prefetcher.push(os.path.join(self.srcbase, fn.filename), fn.offset, fn.length)
+                    else:
+                        prefetcher.push(os.path.join(self.srcbase, fn))
+                yield item
+                self.advance(item[1])
+        finally:
+            prefetcher.close()
+
 class OutputCopy(OutputBase):
+    fmt = 'copy'
+
     def output(self, partitions):
-        for pn, part in enumerate(partitions):
+        import shutil
+        for pn, part in self.pending(partitions):
             d = os.path.abspath(os.path.join(self.dst, self.name % pn))
             logging.info('Copying to %s' % d)
-            eta = ETA(part.size, min_ms_between_updates=500)
+            eta = self.progressbar(part.size, min_ms_between_updates=500)
+            current = 0
             for fn, size, estsize in part.filelist:
                 src = os.path.join(self.srcbase, fn)
                 dst = os.path.join(d, fn)
                 try:
-                    if os.path.isdir(src):
+                    if isinstance(fn, FileChunk):
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                        with self.opensrc(fn) as fsrc, open(dst, 'wb') as fdst:
+                            shutil.copyfileobj(fsrc, fdst, self.bufsize)
+                    elif os.path.isdir(src):
                         os.makedirs(dst, exist_ok=True)
                     else:
                         os.makedirs(os.path.dirname(dst), exist_ok=True)
-                        shutil.copy2(src, dst)
+                        if issparse(os.stat(src)):
+                            hasher, onclose = self.hashing(fn)
+                            copysparse(src, dst, self.bufsize, hasher)
+                            if hasher:
+                                self.checksums[fn] = hasher.digest()
+                        elif self.checksum:
+                            # read it ourselves to record the checksum
+                            with self.opensrc(fn) as fsrc, open(dst, 'wb') as fdst:
+                                shutil.copyfileobj(fsrc, fdst, self.bufsize)
+                            shutil.copystat(src, dst)
+                        else:
+                            shutil.copy2(src, dst)
                 except Exception as ex:
                     logging.error(ex)
                     continue
-                eta.print_status(estsize)
+                self.advance(size)
+                current += estsize
+                eta.print_status(current)
+            self.done(pn, part)
             eta.done()
 
 class OutputLink(OutputBase):
+    fmt = 'link'
+
     def output(self, partitions):
+        import shutil
         logging.info('Linking...')
-        for pn, part in enumerate(partitions):
+        for pn, part in self.pending(partitions):
             d = os.path.abspath(os.path.join(self.dst, self.name % pn))
             for fn, size, estsize in part.filelist:
                 src = os.path.join(self.srcbase, fn)
                 dst = os.path.join(d, fn)
                 try:
-                    if os.path.isdir(src):
+                    if isinstance(fn, FileChunk):
+                        # a range can't be linked
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                        with self.opensrc(fn) as fsrc, open(dst, 'wb') as fdst:
+                            shutil.copyfileobj(fsrc, fdst, self.bufsize)
+                    elif os.path.isdir(src):
                         os.makedirs(dst, exist_ok=True)
                     else:
                         os.makedirs(os.path.dirname(dst), exist_ok=True)
@@ -638,108 +3072,900 @@ class OutputLink(OutputBase):
                 except Exception as ex:
                     logging.error(ex)
                     continue
+                self.advance(size)
+            self.done(pn, part)
+
+class ArchiveError(Exception):
+    '''
+    Some partitions could not be archived.
+    `errors` maps the partition numbers to the error messages.
+    '''
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('%d partition(s) failed: %s' % (len(errors), ', '.join(map(str, sorted(errors)))))
 
 class Output7z(OutputBase):
+    '''
+    Creates the archives with the 7z program, running up to `jobs` processes
+    at the same time in an asyncio event loop. The file list of the next
+    partition is written while the previous ones are compressed, and the
+    progress (-bsp1) of all processes is shown in one ETA display.
+    With the 'py7zr' backend, the archives are written in threads of this
+    process instead, except multi-volume archives and file chunks.
+    '''
+    fmt = '7z'
+    # 'cmd' to run the 7z program, or 'py7zr' to write in-process
+    backend = 'cmd'
+    # number of 7z processes (or py7zr threads) to run at the same time
+    jobs = 1
+    # niceness increment of the 7z processes
+    nice = 0
+    # ionice class of the 7z processes, with an optional level, eg. 'idle', 'best-effort:7'
+    ionice = None
+    # address space limit of each 7z process in bytes
+    memlimit = None
+
+    progress_re = re.compile(r'\s*(\d+)%')
+
     def __init__(self, srcbase, dst, name=None, maxsize=None, extargs=None, cmd7z='7za'):
         self.srcbase = srcbase
         self.dst = dst
         self.name = name or '%03d.7z'
+        self.offsets = {}
         self.maxsize = maxsize
         self.extargs = extargs or []
         self.cmd7z = cmd7z
+        self.checksums = {}
+        # partition number -> error message
+        self.errors = {}
+
+    levels = {'store': ['-mx0'], 'fast': ['-mx1'], 'strong': ['-mx9'], None: []}
+    # py7zr filters, with the names of the filter ids
+    filters = {
+        'store': [{'id': 'FILTER_COPY'}],
+        'fast': [{'id': 'FILTER_LZMA2', 'preset': 1}],
+        'strong': [{'id': 'FILTER_LZMA2', 'preset': 9}],
+        None: [{'id': 'FILTER_LZMA2', 'preset': 5}],
+    }
 
     def output(self, partitions):
-        parabase = [self.cmd7z, 'a', '-t7z'] + self.extargs
-        for pn, part in enumerate(partitions):
-            d = os.path.abspath(os.path.join(self.dst, self.name % pn))
-            fd, tmpname = tempfile.mkstemp()
-            if self.maxsize and part.size > self.maxsize:
-                para1 = ['-v' + str(self.maxsize), '--', d, '@' + tmpname]
-                cfiles = ['%s.%03d' % (d, i) for i in range(1, int(part.size/self.maxsize)+2)]
-            else:
-                para1 = ['--', d, '@' + tmpname]
-                cfiles = [d]
-            if os.path.isfile(cfiles[0]):
-                logging.warning('Archive already exists: ' + d)
+        import asyncio
+        import threading
+        todo = self.unfinished(partitions)
+        self.errors = {}
+        # stops the py7zr threads
+        self.stopping = threading.Event()
+        # partition number -> bytes compressed
+        self.progress = {}
+        self.current = 0
+        self.eta = self.progressbar(sum(part.origsize for pn, part in todo), min_ms_between_updates=500)
+        try:
+            asyncio.run(self.run(todo))
+        finally:
+            self.eta.done()
+        if self.errors:
+            for pn, msg in sorted(self.errors.items()):
+                logging.error('Archive %s failed: %s' % (self.name % pn, msg))
+            raise ArchiveError(self.errors)
+
+    async def run(self, todo):
+        '''
+        Runs the 7z processes of the partitions in `todo`, at most `jobs` at a time.
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        preexec = self.limits()
+        free = list(range(max(self.jobs, 1)))
+        running = set()
+        # the list file not handed over to a task yet, which removes it
+        pending = None
+        try:
+            for pn, part in todo:
+                if self.inprocess(part):
+                    listfile, chunks = None, ()
+                else:
+                    pending = listfile = self.newlist()
+                    # written while the running processes compress
+                    chunks = await loop.run_in_executor(None, self.writelist, listfile, part)
+                while not free:
+                    done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                level = self.chooselevel(pn, part)
+                running.add(asyncio.ensure_future(self.archive(free, free.pop(), pn, part, level, listfile, chunks, preexec)))
+                pending = None
+            if running:
+                await asyncio.wait(running)
+        except BaseException:
+            if pending:
+                try:
+                    os.remove(pending)
+                except OSError:
+                    pass
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+
+    def inprocess(self, part):
+        '''
+        Whether to write the archive of a partition with py7zr.
+        '''
+        if self.backend != 'py7zr' or (self.maxsize and part.size > self.maxsize):
+            return False
+        return not any(isinstance(fn, FileChunk) for fn, size, estsize in part.filelist)
+
+    def writepy7zr(self, loop, pn, part, filename, level):
+        '''
+        Writes the archive of a partition with py7zr, in a worker thread.
+        Regular files are read with `opensrc`, so their checksums are
+        computed from the data compressed.
+        '''
+        import pathlib
+        import py7zr
+        filters = [dict(f, id=getattr(py7zr, f['id'])) for f in self.filters[level]]
+        current = 0
+        with py7zr.SevenZipFile(filename, 'w', filters=filters) as archive:
+            for fn, size, estsize in part.filelist:
+                if self.stopping.is_set():
+                    raise RuntimeError('stopped')
+                src = os.path.join(self.srcbase, fn)
+                try:
+                    if self.checksum and os.path.isfile(src) and not os.path.islink(src):
+                        # the same metadata as archive.write
+                        info = archive._make_file_info(pathlib.Path(src), fn)
+                        with self.opensrc(fn) as f:
+                            archive.writef(SourceStream(f), fn)
+                        archive.header.files_info.files[-1].update(
+                            (key, info[key]) for key in ('creationtime', 'lastwritetime', 'lastaccesstime', 'attributes'))
+                    else:
+                        archive.write(src, fn)
+                except OSError as ex:
+                    logging.warning('Archive %s: %s' % (self.name % pn, ex))
+                current += size
+                loop.call_soon_threadsafe(self.update, pn, current)
+
+    def hashfiles(self, part, stop):
+        '''
+        Reads the files of a partition to record their checksums, in a worker
+        thread while the 7z program reads them (the py7zr backend hashes the
+        data it compresses). 7z reads the files itself, so each file is
+        read twice. The second read is served from the page cache only if
+        the pages are still cached. As in the other outputs, the pages
+        are dropped afterwards unless `keepcache` is set.
+        Stops early if the event `stop` is set.
+        '''
+        for fn, size, estsize in part.filelist:
+            if stop.is_set() or self.stopping.is_set():
+                break
+            # file chunks are hashed when they are fed to 7z
+            if isinstance(fn, FileChunk):
+                continue
+            if not os.path.isfile(os.path.join(self.srcbase, fn)):
+                continue
             try:
-                with os.fdopen(fd, 'w', encoding='utf-8') as f:
-                    for fn, size, estsize in part.filelist:
-                        f.write(fn + '\n')
-                logging.info('Creating archive %s...' % (self.name % pn))
-                proc = subprocess.Popen(parabase + para1, stdout=sys.stdout, stderr=sys.stderr, cwd=self.srcbase)
-                proc.wait()
-            except KeyboardInterrupt:
-                proc.terminate()
-                for fn in cfiles:
-                    try:
-                        os.remove(fn)
-                    except FileNotFoundError:
+                with self.opensrc(fn) as f:
+                    while f.read(self.bufsize):
                         pass
-                raise
-            finally:
-                os.remove(tmpname)
+            except OSError as ex:
+                logging.warning('Checksum of %s: %s' % (fn, ex))
+
+    def newlist(self):
+        '''
+        Creates an empty temporary list file for 7z, and returns its name.
+        '''
+        import tempfile
+        fd, tmpname = tempfile.mkstemp(prefix='maxpacker-', suffix='.lst')
+        os.close(fd)
+        return tmpname
+
+    def writelist(self, listfile, part):
+        '''
+        Writes the file names of a partition to a list file for 7z.
+        Returns the file chunks, which are not listed.
+        '''
+        chunks = []
+        with open(listfile, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            for fn, size, estsize in part.filelist:
+                if isinstance(fn, FileChunk):
+                    chunks.append(fn)
+                else:
+                    f.write(fn + '\n')
+        return chunks
+
+    def limits(self):
+        '''
+        Returns a function to set the niceness and memory limit
+        in the 7z processes before they start, or None.
+        '''
+        if not (self.nice or self.memlimit):
+            return None
+        import resource
+        def setlimits():
+            if self.nice:
+                os.nice(self.nice)
+            if self.memlimit:
+                resource.setrlimit(resource.RLIMIT_AS, (self.memlimit, self.memlimit))
+        return setlimits
+
+    def command(self, args):
+        if not self.ionice:
+            return args
+        ioclass, sep, level = self.ionice.partition(':')
+        return ['ionice', '-c', ioclass] + (['-n', level] if level else []) + args
+
+    def update(self, pn, value):
+        '''
+        Sets the bytes compressed of a partition, and updates the progress.
+        '''
+        delta = value - self.progress.get(pn, 0)
+        if delta <= 0:
+            return
+        self.progress[pn] = value
+        self.current += delta
+        self.eta.print_status(self.current)
+        self.advance(delta, 0)
+
+    async def watch(self, proc, pn, base, total):
+        '''
+        Reads the stdout of a 7z process, and updates the progress of the
+        partition from its -bsp1 percentage to `base` + `total` * percentage.
+        Returns the stderr output.
+        '''
+        import asyncio
+        errors = asyncio.ensure_future(proc.stderr.read())
+        buf = ''
+        while True:
+            data = await proc.stdout.read(4096)
+            if not data:
+                break
+            # the progress is overwritten with backspaces
+            fields = re.split(r'[\b\r\n]', buf + data.decode('utf-8', 'replace'))
+            buf = fields.pop()
+            for field in fields:
+                match = self.progress_re.match(field)
+                if match:
+                    if total:
+                        self.update(pn, base + total * int(match.group(1)) // 100)
+                elif field.strip():
+                    logging.debug('7z: ' + field.strip())
+        return (await errors).decode('utf-8', 'replace').strip()
+
+    def check(self, pn, returncode, errors):
+        if returncode == 1:
+            # warnings, eg. some files can't be read
+            logging.warning('Archive %s: 7z warnings: %s' % (self.name % pn, errors))
+        elif returncode:
+            raise RuntimeError('7z exited with code %d: %s' % (returncode, errors))
+
+    async def archive(self, free, slot, pn, part, level, listfile, chunks, preexec=None):
+        '''
+        Creates the archive of a partition in a job slot, which is put back
+        to `free` when finished. Errors are recorded in `self.errors`.
+        '''
+        import asyncio
+        worker = '7z-%d' % slot
+        if self.status:
+            self.status.worker(worker, state='archiving', partition=pn, archive=self.name % pn)
+        d = os.path.abspath(os.path.join(self.dst, self.name % pn))
+        if self.maxsize and part.size > self.maxsize:
+            para1 = ['-v' + str(self.maxsize), '--', d, '@%s' % listfile]
+            cfiles = ['%s.%03d' % (d, i) for i in range(1, int(part.size/self.maxsize)+2)]
+        else:
+            para1 = ['--', d, '@%s' % listfile]
+            cfiles = [d]
+        for fn in cfiles:
+            # 7z would update an existing archive
+            if os.path.isfile(fn):
+                logging.warning('Archive already exists, overwriting: ' + fn)
+                os.remove(fn)
+        parabase = [self.cmd7z, 'a', '-t7z', '-bsp1'] + self.extargs + self.levels[level]
+        pipe = asyncio.subprocess.PIPE
+        loop = asyncio.get_running_loop()
+        proc = None
+        hashing = None
+        stophashing = threading.Event()
+        if self.checksum and listfile is not None:
+            # py7zr hashes the files it reads
+            hashing = loop.run_in_executor(None, self.hashfiles, part, stophashing)
+        finished = False
+        try:
+            base = 0
+            if listfile is None:
+                await loop.run_in_executor(None, self.writepy7zr, loop, pn, part, d, level)
+            elif len(chunks) < len(part):
+                base = sum(size for fn, size, estsize in part.filelist if not isinstance(fn, FileChunk))
+                proc = await asyncio.create_subprocess_exec(
+                    *self.command(parabase + para1), stdout=pipe, stderr=pipe,
+                    cwd=self.srcbase, preexec_fn=preexec)
+                errors = await self.watch(proc, pn, 0, base)
+                self.check(pn, await proc.wait(), errors)
+            # file chunks are read from stdin, one at a time
+            for fn in chunks:
+                proc = await asyncio.create_subprocess_exec(
+                    *self.command(parabase + ['-si' + fn, '--', d]), stdin=pipe, stdout=pipe, stderr=pipe,
+                    cwd=self.srcbase, preexec_fn=preexec)
+                watcher = asyncio.ensure_future(self.watch(proc, pn, base, 0))
+                with self.opensrc(fn) as fsrc:
+                    while True:
+                        data = await loop.run_in_executor(None, fsrc.read, self.bufsize)
+                        if not data:
+                            break
+                        proc.stdin.write(data)
+                        await proc.stdin.drain()
+                        base += len(data)
+                        self.update(pn, base)
+                proc.stdin.close()
+                errors = await watcher
+                self.check(pn, await proc.wait(), errors)
+            if hashing:
+                await hashing
+            self.update(pn, part.origsize)
+            self.feedback(pn, part, sum(os.path.getsize(fn) for fn in cfiles if os.path.isfile(fn)))
+            self.done(pn, part, [fn for fn in cfiles if os.path.isfile(fn)])
+            self.advance(0, len(part))
+            finished = True
+            if self.status:
+                self.status.add(partitions_done=1)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            self.stopping.set()
+            if proc and proc.returncode is None:
+                proc.terminate()
+                await proc.wait()
+            self.removeparts(cfiles)
+            raise
+        except Exception as ex:
+            if proc and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            self.errors[pn] = str(ex)
+            self.removeparts(cfiles)
+            if self.status:
+                self.status.add(partitions_failed=1)
+        finally:
+            if hashing:
+                stophashing.set()
+                await asyncio.gather(hashing, return_exceptions=True)
+            if not finished:
+                # no checksums of a removed archive
+                for fn, size, estsize in part.filelist:
+                    self.checksums.pop(fn, None)
+            if listfile:
+                os.remove(listfile)
+            free.append(slot)
+            if self.status:
+                self.status.worker(worker, state='idle')
+
+    def removeparts(self, cfiles):
+        for fn in cfiles:
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
 
 class OutputTar(OutputBase):
-    def __init__(self, srcbase, dst, name=None, compression=None):
+    def __init__(self, srcbase, dst, name=None, compression=None, sink=None):
         self.srcbase = srcbase
         self.dst = dst
-        self.ext = 'tar.' + compression if compression else 'tar'
+        self.ext = self.fmt = 'tar.' + compression if compression else 'tar'
         self.name = name or '%03d.' + self.ext
-        self.mode = 'w:' + compression if compression else 'w'
+        self.compression = compression
+        self.sink = sink or FileSink(dst)
+        self.mode = 'w|' if self.sink.streaming else 'w'
+        self.offsets = {}
+        self.checksums = {}
+
+    levels = {
+        'gz': {'store': 0, 'fast': 1, 'strong': 9},
+        'bz2': {'store': 1, 'fast': 1, 'strong': 9},
+        'xz': {'store': 0, 'fast': 0, 'strong': 6},
+    }
+
+    def compressor(self, fileobj, level=None):
+        '''
+        Wraps `fileobj` to compress with the chosen level.
+        '''
+        if self.compression is None:
+            return fileobj
+        level = self.levels[self.compression].get(level)
+        if self.compression == 'gz':
+            import gzip
+            return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=9 if level is None else level)
+        elif self.compression == 'bz2':
+            import bz2
+            return bz2.BZ2File(fileobj, 'wb', compresslevel=9 if level is None else level)
+        elif self.compression == 'xz':
+            import lzma
+            return lzma.LZMAFile(fileobj, 'wb', preset=level)
+        raise ValueError('unsupported compression method ' + self.compression)
 
     def output(self, partitions):
-        for pn, part in enumerate(partitions):
-            d = os.path.abspath(os.path.join(self.dst, self.name % pn))
-            if os.path.isfile(d):
-                logging.warning('Archive already exists, overwriting: ' + d)
-            logging.info('Creating archive %s...' % (self.name % pn))
-            eta = ETA(part.size, min_ms_between_updates=500)
-            with tarfile.open(d, self.mode) as tar:
-                for fn, size, estsize in part.filelist:
+        import tarfile
+        for pn, part in self.pending(partitions):
+            level = self.chooselevel(pn, part)
+            eta = self.progressbar(part.size, min_ms_between_updates=500)
+            current = 0
+            fileobj = CountingWriter(self.sink.open(self.name % pn))
+            compfileobj = self.compressor(fileobj, level)
+            with tarfile.open(fileobj=compfileobj, mode=self.mode, encoding=DEFAULT_ENCODING) as tar:
+                tar.copybufsize = self.bufsize
+                for fn, size, estsize in self.iterpart(part):
+                    # offset in the uncompressed stream
+                    offset = tar.offset
                     try:
-                        tar.add(os.path.join(self.srcbase, fn), fn)
+                        self.addmember(tar, fn)
                     except Exception as ex:
                         logging.error(ex)
-                    eta.print_status(estsize)
+                    else:
+                        self.offsets[fn] = offset
+                    current += estsize
+                    eta.print_status(current)
+            if compfileobj is not fileobj:
+                compfileobj.close()
+            self.sink.close(fileobj.fileobj)
+            if self.compression:
+                # nothing was estimated for plain tar
+                self.feedback(pn, part, fileobj.count)
+            self.done(pn, part)
             eta.done()
 
+    def addmember(self, tar, fn):
+        if isinstance(fn, FileChunk):
+            tarinfo = tar.gettarinfo(os.path.join(self.srcbase, fn.filename), fn)
+            tarinfo.size = fn.length
+        else:
+            src = os.path.join(self.srcbase, fn)
+            if tar_addsparse(tar, src, fn, *self.hashing(fn)):
+                return
+            tarinfo = tar.gettarinfo(src, fn)
+            if not tarinfo.isreg():
+                tar.add(src, fn)
+                return
+        with self.opensrc(fn) as f:
+            tar.addfile(tarinfo, f)
+
 class OutputZip(OutputBase):
-    def __init__(self, srcbase, dst, name=None):
+    fmt = 'zip'
+
+    def __init__(self, srcbase, dst, name=None, sink=None):
         self.srcbase = srcbase
         self.dst = dst
         self.name = name or '%03d.zip'
+        self.sink = sink or FileSink(dst)
+        self.offsets = {}
+        self.checksums = {}
+
+    # (zipfile compression constant, level)
+    levels = {
+        'store': ('ZIP_STORED', None),
+        'fast': ('ZIP_DEFLATED', 1),
+        'strong': ('ZIP_DEFLATED', 9),
+        None: ('ZIP_DEFLATED', None),
+    }
 
     def output(self, partitions):
-        for pn, part in enumerate(partitions):
-            d = os.path.abspath(os.path.join(self.dst, self.name % pn))
-            if os.path.isfile(d):
-                logging.warning('Archive already exists, overwriting: ' + d)
-            logging.info('Creating archive %s...' % (self.name % pn))
-            eta = ETA(part.size, min_ms_between_updates=500)
-            with zipfile.ZipFile(d, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
-                for fn, size, estsize in part.filelist:
+        import shutil
+        import zipfile
+        for pn, part in self.pending(partitions):
+            compression, compresslevel = self.levels[self.chooselevel(pn, part)]
+            compression = getattr(zipfile, compression)
+            eta = self.progressbar(part.size, min_ms_between_updates=500)
+            current = 0
+            fileobj = self.sink.open(self.name % pn)
+            extsizes = collections.Counter()
+            # data descriptors are used if the sink is not seekable
+            with zipfile.ZipFile(fileobj, 'w', compression=compression, compresslevel=compresslevel) as zipf:
+                for fn, size, estsize in self.iterpart(part):
                     try:
-                        zipf.write(os.path.join(self.srcbase, fn), fn)
+                        src = os.path.join(self.srcbase, getattr(fn, 'filename', fn))
+                        zinfo = zipfile.ZipInfo.from_file(src, fn)
+                        if zinfo.is_dir():
+                            zipf.write(src, fn)
+                        else:
+                            zinfo.compress_type = zipf.compression
+                            if hasattr(zinfo, 'compress_level'):
+                                zinfo.compress_level = zipf.compresslevel
+                            else:
+                                zinfo._compresslevel = zipf.compresslevel
+                            if isinstance(fn, FileChunk):
+                                zinfo.file_size = fn.length
+                            with self.opensrc(fn) as fsrc, zipf.open(zinfo, 'w') as fdst:
+                                shutil.copyfileobj(fsrc, fdst, self.bufsize)
                     except Exception as ex:
                         logging.error(ex)
-                    eta.print_status(estsize)
+                    else:
+                        self.offsets[fn] = zipf.filelist[-1].header_offset
+                        extsizes[fileext(fn)] += zipf.filelist[-1].compress_size
+                    current += estsize
+                    eta.print_status(current)
+            self.sink.close(fileobj)
+            self.feedback(pn, part, sum(extsizes.values()), extsizes)
+            self.done(pn, part)
             eta.done()
 
+# Library API
+#
+# The stages of a run as composable functions, eg.
+#
+#     entries = scan(['data'])
+#     with concurrent.futures.ThreadPoolExecutor() as executor:
+#         entries = estimate(entries, 'data', lzma.compress, executor=executor)
+#         partitions = pack(entries, LimitPacker(4 << 30), sortfile=3, prefix='data')
+#     write(partitions, OutputTar('data', 'out', compression='xz'))
+#
+# scan and estimate are lazy. The stages report the progress to callbacks
+# instead of logging and progress bars, and keep their state in the
+# arguments, so several volumes can be packed in one process at once.
+
+class Entry(collections.namedtuple('Entry', 'name size estsize mtime')):
+    '''
+    A file to pack: its name relative to the base directory, size on disk,
+    estimated compressed size, and modification time (or None).
+    Empty directories are included with a size of 0.
+    '''
+    __slots__ = ()
+
+def _scanpath(path, onerror=None):
+    if os.path.isfile(path):
+        yield path, functools.partial(os.stat, path), None
+        return
+    for entry, empty in scantree(path, onerror):
+        yield entry.path, entry.stat, empty
+
+def scan(paths, prefix=None, ffilter=None, onignore=None, onerror=None, progress=None):
+    '''
+    Walks the paths, and yields an `Entry` for each file accepted by
+    `ffilter` (Default: all files) and each empty directory.
+    The names are relative to `prefix` (Default: the common base of the paths).
+    Callbacks:
+        onignore(name, size) for the files rejected by the filter
+        onerror(name, exception) for the files and directories that can't be read
+        progress(files, nbytes) after each entry
+    '''
+    prefix = prefix or basepath(paths)
+    ffilter = ffilter or TrueFilter()
+    direrror = None
+    if onerror:
+        direrror = lambda ex: onerror(os.path.relpath(ex.filename, prefix) + '/', ex)
+    files = nbytes = 0
+    for path in paths:
+        for fn, getstat, empty in _scanpath(path, direrror):
+            if empty is not None:
+                # not ignoring empty dirs
+                if not empty:
+                    continue
+                relfn = os.path.relpath(fn + '/', prefix)
+                try:
+                    entry = Entry(relfn, 0, 0, getstat().st_mtime)
+                except OSError as ex:
+                    if onerror:
+                        onerror(relfn, ex)
+                    continue
+            else:
+                relfn = os.path.relpath(fn, prefix)
+                try:
+                    st = getstat()
+                    accepted = ffilter(relfn, prefix)
+                    filesize = allocsize(fn, st)
+                except Exception as ex:
+                    if onerror:
+                        onerror(relfn, ex)
+                    continue
+                if not accepted:
+                    if onignore:
+                        onignore(relfn, filesize)
+                    continue
+                entry = Entry(relfn, filesize, filesize, st.st_mtime)
+            files += 1
+            nbytes += entry.size
+            yield entry
+            if progress:
+                progress(files, nbytes)
+
+def estimate(entries, prefix, compressfunc, samplesize=1024, executor=None, window=64,
+             cache=None, stats=None, onerror=None, progress=None):
+    '''
+    Yields the entries with their compressed size estimated by
+    `estcompresssize`, in the same order.
+    executor: a concurrent.futures executor to read and compress the samples
+        in, with up to `window` entries in flight (Default: in this thread)
+    cache: a dict-like of (name, size, mtime) -> estimated size, which is
+        looked up and filled, for the entries with mtime
+    stats: an EstimateStats to correct the estimates with
+    Callbacks:
+        onerror(name, exception) for the files that can't be read, which
+            keep their estimated size
+        progress(files, nbytes) after each entry
+    '''
+    counts = [0, 0]
+
+    def start(entry):
+        key = (entry.name, entry.size, entry.mtime)
+        if cache is not None and entry.mtime is not None and key in cache:
+            return cache[key]
+        factor = stats.factor(fileext(entry.name)) if stats else None
+        args = (os.path.join(prefix, entry.name), entry.size, compressfunc, samplesize, factor)
+        if executor is not None:
+            return executor.submit(estcompresssize, *args)
+        try:
+            return estcompresssize(*args)
+        except Exception as ex:
+            return ex
+
+    def finish(entry, result):
+        if hasattr(result, 'result'):
+            try:
+                result = result.result()
+            except Exception as ex:
+                result = ex
+        if isinstance(result, Exception):
+            if onerror:
+                onerror(entry.name, result)
+        else:
+            if cache is not None and entry.mtime is not None:
+                cache[(entry.name, entry.size, entry.mtime)] = result
+            entry = entry._replace(estsize=result)
+        counts[0] += 1
+        counts[1] += entry.size
+        if progress:
+            progress(*counts)
+        return entry
+
+    pending = collections.deque()
+    try:
+        for entry in entries:
+            pending.append((entry, start(entry)))
+            if executor is None or len(pending) >= window:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        for entry, result in pending:
+            if hasattr(result, 'cancel'):
+                result.cancel()
+
+def pack(entries, packer, sortfile=0, prefix='.', store=None):
+    '''
+    Dispatches the entries to partitions with `packer` (a PackerBase),
+    sorts the files of each partition (see `Partition.sortfile`), and
+    returns the list of partitions.
+    With a TableStore `store`, the file lists are kept on disk, and the
+    packer makes its partitions in it.
+    '''
+    if store:
+        filelist = store.new()
+        for entry in entries:
+            filelist.append(entry[:3], entry.mtime or 0.0)
+        packer.store = store
+    else:
+        filelist = [entry[:3] for entry in entries]
+    partitions = packer.dispatch(filelist)
+    for part in partitions:
+        part.sortfile(sortfile, prefix)
+    return partitions
+
+class CallbackStatus:
+    '''
+    Takes the place of the status server of an output, and calls
+    progress(files, nbytes) with the files written so far.
+    '''
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.files = 0
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def set_phase(self, phase, total=0):
+        pass
+
+    def add(self, files_done=0, bytes_done=0, **counters):
+        if not files_done:
+            return
+        with self._lock:
+            self.files += files_done
+            self.nbytes += bytes_done
+            files, nbytes = self.files, self.nbytes
+        self.progress(files, nbytes)
+
+    def set(self, **values):
+        pass
+
+    def worker(self, name, **state):
+        pass
+
+class CallbackJournal:
+    '''
+    Takes the place of the journal of an output, and calls
+    ondone(pn, files) with the archive files of each completed partition,
+    after recording it in the original journal, if any.
+    '''
+
+    def __init__(self, ondone, journal=None):
+        self.ondone = ondone
+        self.journal = journal
+
+    def done(self, pn, files, members=None):
+        files = list(files)
+        if self.journal is not None:
+            self.journal.done(pn, files, members)
+        self.ondone(pn, files)
+
+def write(partitions, output, progress=None, ondone=None):
+    '''
+    Writes the partitions with `output` (an OutputBase), without progress bars.
+    Callbacks:
+        progress(files, nbytes) as the files are written
+        ondone(pn, files) with the archive files of each completed partition
+    Raises ArchiveError if some partitions failed (only Output7z).
+    '''
+    saved = {name: getattr(output, name) for name in ('progressbar', 'status', 'journal')
+             if name in vars(output)}
+    output.progressbar = NoopETA
+    output.status = CallbackStatus(progress) if progress else None
+    if ondone:
+        output.journal = CallbackJournal(ondone, output.journal)
+    try:
+        output.output(partitions)
+    finally:
+        for name in ('progressbar', 'status', 'journal'):
+            if name in saved:
+                setattr(output, name, saved[name])
+            else:
+                vars(output).pop(name, None)
+
+def helpformatter(prog):
+    '''
+    The default argparse formatter, but gets the terminal width without
+    importing shutil, which imports the compression modules.
+    '''
+    try:
+        columns = int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        columns = 0
+    if columns <= 0:
+        try:
+            columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            columns = 0
+    return argparse.HelpFormatter(prog, width=(columns or 80) - 2)
+
+def main_locate(argv):
+    parser = argparse.ArgumentParser(prog='maxpacker.py locate', description="Find the partitions holding the paths.", formatter_class=helpformatter)
+    parser.add_argument("-l", "--lookup", help="lookup table (Default: index.txt.idx)", default="index.txt.idx", metavar='FILE')
+    parser.add_argument("PATH", nargs='+', help="Paths to find, relative to the archive root")
+    args = parser.parse_args(argv)
+    lookup = Lookup(args.lookup)
+    found = True
+    for path in args.PATH:
+        members = list(lookup.locate(path))
+        if not members:
+            logging.error('Not found: ' + path)
+            found = False
+        for member, pn, offset, size in members:
+            print('%03d\t%s\t%s' % (pn, lookup.meta['name'] % pn, member))
+    lookup.close()
+    return 0 if found else 1
+
+def main_verify(argv):
+    parser = argparse.ArgumentParser(prog='maxpacker.py verify', description="Check the archives against the checksums in the lookup table.", formatter_class=helpformatter)
+    parser.add_argument("-l", "--lookup", help="lookup table, created with --checksum (Default: index.txt.idx)", default="index.txt.idx", metavar='FILE')
+    parser.add_argument("-a", "--archives", help="archive location (Default: the directory of the lookup table)", metavar='DIR')
+    parser.add_argument("-j", "--jobs", help="archives to verify at the same time (Default: number of CPUs)", type=int, metavar='NUM')
+    parser.add_argument("--p7z-cmd", help="7z program to use (Default: 7za)", default='7za')
+    parser.add_argument("--p7z-backend", help="how to read 7z archives. cmd: run the 7z program, py7zr: read in-process with py7zr, except multi-volume archives (Default: cmd)", choices=('cmd', 'py7zr'), default='cmd')
+    args = parser.parse_args(argv)
+    lookup = Lookup(args.lookup)
+    archivedir = args.archives or os.path.dirname(os.path.abspath(args.lookup))
+    try:
+        errors = verifyarchives(lookup, archivedir, args.jobs, args.p7z_cmd, args.p7z_backend)
+    except ValueError as ex:
+        parser.error(str(ex))
+    finally:
+        lookup.close()
+    return 1 if errors else 0
+
+def main_worker(argv):
+    parser = argparse.ArgumentParser(prog='maxpacker.py worker', description="Archive the partitions queued by `maxpacker.py --queue`, as a worker of a distributed run. Exits when all partitions are done or failed.", formatter_class=helpformatter)
+    parser.add_argument("-n", "--name", help="worker name (Default: HOST:PID)")
+    parser.add_argument("--interval", help="seconds between polls when no partition is available (Default: 5)", type=float, default=5, metavar='SEC')
+    parser.add_argument("QUEUE", help="queue database on the shared filesystem")
+    args = parser.parse_args(argv)
+    queue = WorkQueue(args.QUEUE)
+    try:
+        failed = runworker(queue, args.name, args.interval)
+    except ValueError as ex:
+        parser.error(str(ex))
+    finally:
+        queue.close()
+    return 1 if failed else 0
+
+def main_extract(argv):
+    parser = argparse.ArgumentParser(prog='maxpacker.py extract', description="Extract files from the archives.", formatter_class=helpformatter)
+    parser.add_argument("-l", "--lookup", help="lookup table (Default: index.txt.idx)", default="index.txt.idx", metavar='FILE')
+    parser.add_argument("-a", "--archives", help="archive location (Default: the directory of the lookup table)", metavar='DIR')
+    parser.add_argument("-C", "--directory", help="extract to DIR (Default: .)", default=".", metavar='DIR')
+    parser.add_argument("--p7z-cmd", help="7z program to use (Default: 7za)", default='7za')
+    parser.add_argument("PATH", nargs='+', help="Paths to extract, relative to the archive root")
+    args = parser.parse_args(argv)
+    lookup = Lookup(args.lookup)
+    archivedir = args.archives or os.path.dirname(os.path.abspath(args.lookup))
+    found = True
+    for path in args.PATH:
+        members = list(lookup.locate(path))
+        if not members:
+            logging.error('Not found: ' + path)
+            found = False
+            continue
+        for member, pn, offset, size in members:
+            logging.info('Extracting %s from %s' % (member, lookup.meta['name'] % pn))
+            extractmember(lookup.meta, archivedir, member, pn, offset, args.directory, args.p7z_cmd)
+        if members[0][0] != os.path.normpath(path):
+            # reassemble chunks
+            import shutil
+            dst = os.path.join(args.directory, os.path.normpath(path))
+            with open(dst, 'wb') as fdst:
+                for member, pn, offset, size in members:
+                    chunkfn = os.path.join(args.directory, member)
+                    with open(chunkfn, 'rb') as fsrc:
+                        shutil.copyfileobj(fsrc, fdst)
+                    os.remove(chunkfn)
+    lookup.close()
+    return 0 if found else 1
+
+COMMANDS = {
+    'locate': main_locate,
+    'extract': main_extract,
+    'verify': main_verify,
+    'worker': main_worker,
+}
+
 def main():
-    parser = argparse.ArgumentParser(description="A flexible backup tool.")
+    logging.basicConfig(stream=sys.stdout, format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description="A flexible backup tool.", epilog="Other commands: %s. Use `maxpacker.py COMMAND -h` for help." % ', '.join(COMMANDS), formatter_class=helpformatter)
 
     group1 = parser.add_argument_group('Output', 'output control')
     group1.add_argument("-o", "--output", help="output location", default=".", metavar='DIR')
     group1.add_argument("-i", "--index", help="index file", default="index.txt", metavar='FILE')
+    group1.add_argument("--lookup", help="binary lookup table for the `locate` and `extract` commands (Default: INDEX.idx, none for -f none, '' to disable)", metavar='FILE')
+    group1.add_argument("--checksum", help="record a checksum of each file in the lookup table, computed from the data read while archiving (xxh64 needs xxhash, not for -f link)", choices=CHECKSUMS)
+    group1.add_argument("--verify", help="verify the archives against the checksums after creating them (implies --checksum blake2b), also see the `verify` command", action='store_true')
+    group1.add_argument("--journal", help="journal of the partition plan and completed partitions (Default: INDEX.journal, none for -f none, '' to disable)", metavar='FILE')
+    group1.add_argument("--resume", help="resume an interrupted run from the journal, without scanning again", action='store_true')
+    group1.add_argument("--index-format", help="index file format. text: plain text list, jsonl: JSON lines written incrementally (Default: text, or jsonl if FILE ends with .jsonl[.gz|.zst])", choices=('text', 'jsonl'))
     group1.add_argument("-n", "--name", help="output file/folder name format (Default: %%03d[.ext])", metavar='PATTERN')
     group1.add_argument("-f", "--format", help="output format, can be one of 'none', 'copy', 'link', '7z', 'zip', 'tar', 'tar.gz', 'tar.bz2', 'tar.xz' (Default: 7z)", default="7z")
+    group1.add_argument("--pipe", help="write archives one after another to a named pipe, or '-' for stdout, instead of files (only for -f zip, tar.*z)", metavar='FILE')
+    group1.add_argument("--pipe-cmd", help="pipe each archive to a shell command, where %%s is replaced by the archive name, eg. 'upload %%s' (only for -f zip, tar.*z)", metavar='CMD')
+    group1.add_argument("--io-bufsize", help="read buffer size for source files (Default: 1M)", metavar='SIZE')
+    group1.add_argument("--keep-cache", help="keep the source files in the page cache after reading them", action='store_true')
+    group1.add_argument("--no-prefetch", help="don't read ahead the next file while compressing", action='store_true')
+    group1.add_argument("--codec-policy", help="choose the compression level of each partition by its estimated ratio (estimated size / original size): store (or the fastest level) above STORE, a fast level above FAST, otherwise a strong level, eg. 0.95,0.7 (only for -f 7z, zip, tar.*z)", metavar='STORE,FAST')
+    group1.add_argument("--est-stats", help="learn correction factors for the compressed size estimation from the archives created, and use them in later runs (JSON file, created if missing)", metavar='FILE')
+    group1.add_argument("--metrics", help="write the time, CPU, I/O and peak memory of each phase (scan, estimate, dispatch, sort, index, output...) to a JSON file", metavar='FILE')
+    group1.add_argument("--profile", help="profile each phase with cProfile, and write the stats to DIR/NN-phase.pstats", metavar='DIR')
+    group1.add_argument("--queue", help="distribute the partitions to workers, on this or other hosts sharing the filesystem, through a queue database, and wait for them (see the `worker` command)", metavar='FILE')
+    group1.add_argument("--queue-workers", help="start NUM local worker processes for --queue (Default: 0)", type=int, default=0, metavar='NUM')
+    group1.add_argument("--lease", help="seconds before the partition of an unresponsive worker is given to another worker (Default: 300)", type=float, default=300, metavar='SEC')
+    group1.add_argument("--status-socket", help="serve the run status as JSON, Prometheus or text on a Unix socket (send 'json', 'prometheus' or 'text', or GET /status or /metrics)", metavar='FILE')
     group1.add_argument("--p7z-args", help="extra arguments for 7z (only for -f 7z) (TIP: use --p7z-args='-xxx' to avoid confusing the argument parser)")
     group1.add_argument("--p7z-cmd", help="7z program to use (Default: 7za, only for -f 7z)", default='7za')
-    group1.add_argument("--tar-sort", help="sort file in a partition (only for -f tar.*z). 0: no sort, 1: normal sort, 2(default): 7z-style sort within a directory, 3: 7z-style sort within a partition.", type=int, choices=(0, 1, 2, 3), default=2)
+    group1.add_argument("--p7z-backend", help="how to write 7z archives. cmd: run the 7z program, py7zr: write in-process with py7zr, which saves starting a process for each partition; multi-volume archives and file chunks still use the 7z program, and --p7z-args and the process limits don't apply (Default: cmd, only for -f 7z)", choices=('cmd', 'py7zr'), default='cmd')
+    group1.add_argument("-j", "--jobs", help="number of 7z processes (or py7zr threads) to run at the same time (Default: 1, only for -f 7z)", type=int, default=1, metavar='NUM')
+    group1.add_argument("--p7z-nice", help="niceness increment of the 7z processes (only for -f 7z)", type=int, default=0, metavar='NUM')
+    group1.add_argument("--p7z-ionice", help="I/O scheduling class of the 7z processes, with an optional priority level, eg. idle, best-effort:7 (only for -f 7z, needs ionice)", metavar='CLASS[:LEVEL]')
+    group1.add_argument("--p7z-memory", help="address space limit of each 7z process (only for -f 7z)", metavar='SIZE')
+    group1.add_argument("--tar-sort", help="sort file in a partition (only for -f tar.*z). 0: no sort, 1: normal sort, 2(default): 7z-style sort within a directory, 3: 7z-style sort within a partition, 4: physical order on disk, 5: 7z-style sort within a directory, directories in physical order.", type=int, choices=(0, 1, 2, 3, 4, 5), default=2)
 
     group2 = parser.add_argument_group('Filter', 'options for filtering files')
     group2.add_argument("-r", "--root", help="relative path root (Default: the longest prefix of all paths)", metavar='DIR')
+    group2.add_argument("--save-scan", help="save the scan result (after filtering and estimation) to FILE", metavar='FILE')
+    group2.add_argument("--load-scan", help="load the scan result from FILE instead of scanning. The filters of the saving run apply, except --totalsize", metavar='FILE')
     group2.add_argument("--totalsize", help="total size limit")
+    group2.add_argument("--select", help="which files to keep within --totalsize. smallest: smallest files first, newest: latest modified files first, priority: files matching earlier --priority patterns first (Default: smallest)", choices=Selector.policies, default='smallest')
+    group2.add_argument("--priority", help="rsync-style pattern of wanted files for --select priority, in the order of preference", action='append', metavar='PATTERN')
     group2.add_argument("-m", "--maxfilesize", help="max size of each file", metavar='SIZE')
     group2.add_argument("--minfilesize", help="min size of each file", metavar='SIZE')
     group2.add_argument("-e", "--exclude", help="exclude files that match the rsync-style pattern", action='append', metavar='PATTERN')
@@ -756,6 +3982,9 @@ def main():
     group3 = parser.add_argument_group('Partition', 'partition methods')
     group3.add_argument("-s", "--maxpartsize", help="max partition size", default=0, metavar='SIZE')
     group3.add_argument("--maxfilenum", help="max file number per partition", type=int, default=0, metavar='NUM')
+    group3.add_argument("--group", help="pack similar files (by extension and directory) together for better solid compression (only for -s, --maxfilenum)", action='store_true')
+    group3.add_argument("--chunk-size", help="split files larger than SIZE into chunks of SIZE, which are packed as independent files named FILE.001, FILE.002, ... (instead of multipart partitions). Fails if such a name is taken by another file", metavar='SIZE')
+    group3.add_argument("--memory-budget", help="keep the file lists in temporary files (in TMPDIR) and sort them out of core, using about SIZE of memory for buffers and sort runs, for more files than the memory can hold (not with --chunk-size)", metavar='SIZE')
     group3.add_argument("-p", "--part", help="partition number (overrides: -s, --maxfilenum)", type=int, metavar='NUM')
 
     parser.add_argument("PATH", nargs='+', help="Paths to archive")
@@ -763,9 +3992,15 @@ def main():
 
     pathlist = args.PATH
     basedir = args.root or basepath(pathlist)
+    if args.queue:
+        # the workers may run in other directories
+        basedir = os.path.abspath(basedir)
+        args.output = os.path.abspath(args.output)
 
     if args.part:
         packer = PartNumberLimitPacker(args.part)
+    elif (args.maxpartsize or args.maxfilenum) and args.group:
+        packer = GroupLimitPacker(human2bytes(args.maxpartsize), args.maxfilenum)
     elif args.maxpartsize or args.maxfilenum:
         packer = LimitPacker(human2bytes(args.maxpartsize), args.maxfilenum)
     else:
@@ -795,6 +4030,17 @@ def main():
         before = time.mktime(time.strptime(args.before, '%Y%m%d%H%M%S')) if args.before else None
         ffilter |= TimeFilter(after, before, 'm')
 
+    sink = None
+    if args.pipe_cmd:
+        sink = PipeSink(args.pipe_cmd)
+    elif args.pipe:
+        sink = StreamSink(args.pipe)
+        if args.pipe == '-':
+            # keep stdout clean for the archives
+            logging.getLogger().handlers[0].setStream(sys.stderr)
+    if sink and not (args.format == 'zip' or args.format.startswith('tar')):
+        parser.error('--pipe and --pipe-cmd only support -f zip, tar.*z')
+
     compressfunc = None
     sortfile = 0
     if args.format == 'none':
@@ -804,35 +4050,121 @@ def main():
     elif args.format == 'link':
         output = OutputLink(basedir, args.output, args.name)
     elif args.format == '7z':
+        import lzma
         compressfunc = lzma.compress
-        output = Output7z(basedir, args.output, args.name, human2bytes(args.maxpartsize), shlex.split(args.p7z_args or ''), args.p7z_cmd)
+        output = Output7z(basedir, args.output, args.name, None if args.chunk_size else human2bytes(args.maxpartsize), shlex.split(args.p7z_args or ''), args.p7z_cmd)
+        if args.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        output.jobs = args.jobs
+        if args.p7z_backend == 'py7zr':
+            try:
+                import py7zr
+            except ImportError:
+                parser.error('py7zr is required for --p7z-backend py7zr')
+        output.backend = args.p7z_backend
+        output.nice = args.p7z_nice
+        if args.p7z_ionice:
+            if not re.match(r'^(idle|best-effort|realtime|[0-3])(:[0-7])?$', args.p7z_ionice):
+                parser.error('invalid --p7z-ionice: ' + args.p7z_ionice)
+            output.ionice = args.p7z_ionice
+        if args.p7z_memory:
+            output.memlimit = human2bytes(args.p7z_memory)
     elif args.format == 'zip':
+        import zlib
         compressfunc = zlib.compress
-        output = OutputZip(basedir, args.output, args.name)
+        output = OutputZip(basedir, args.output, args.name, sink)
     elif args.format.startswith('tar'):
         ext = args.format.split('.')
         compression = ext[1] if len(ext) == 2 else None
         if compression == 'gz':
+            import zlib
             compressfunc = zlib.compress
         elif compression == 'bz2':
+            import bz2
             compressfunc = bz2.compress
         elif compression == 'xz':
+            import lzma
             compressfunc = lzma.compress
         elif compression is None:
             pass
         else:
             raise ValueError('unsupported compression method ' + compression)
         sortfile = args.tar_sort
-        output = OutputTar(basedir, args.output, args.name, compression)
+        output = OutputTar(basedir, args.output, args.name, compression, sink)
     else:
         raise ValueError('unsupported output format ' + args.format)
 
+    if args.io_bufsize:
+        output.bufsize = human2bytes(args.io_bufsize)
+    output.keepcache = args.keep_cache
+    if args.codec_policy:
+        if compressfunc is None:
+            parser.error('--codec-policy needs a compressed format')
+        output.policy = CodecPolicy(*map(float, args.codec_policy.split(',')))
+    output.prefetch = not args.no_prefetch
+    if args.verify and not args.checksum:
+        args.checksum = 'blake2b'
+    if args.checksum:
+        try:
+            newhash(args.checksum)
+        except RuntimeError as ex:
+            parser.error(str(ex))
+        if args.lookup == '':
+            parser.error('--checksum and --verify need the lookup table')
+        if args.format == 'link':
+            parser.error("--checksum and --verify don't work with -f link, which doesn't read the files")
+        output.checksum = args.checksum
+    if args.verify and (sink or args.format == 'none'):
+        parser.error('--verify needs archive files')
+    if args.queue and (sink or args.format == 'none'):
+        parser.error('--queue needs archive files')
+
     vol = Volume(packer, ffilter, os.path.join(args.output, args.index), output, compressfunc, sortfile)
+    if args.est_stats and compressfunc:
+        vol.eststats = output.eststats = EstimateStats(args.est_stats, output.fmt)
 
     if args.totalsize:
         vol.totalsizelim = human2bytes(args.totalsize)
+    if args.select == 'priority' and not args.priority:
+        parser.error('--select priority needs --priority patterns')
+    vol.selector = Selector(args.select, args.priority or ())
+    # planning runs (-f none) only write the index, unless asked
+    if args.lookup is None and args.format != 'none':
+        vol.lookupfile = os.path.join(args.output, args.index) + '.idx'
+    else:
+        vol.lookupfile = args.lookup
+    if args.journal is None and args.format != 'none':
+        vol.journal = Journal(os.path.join(args.output, args.index) + '.journal')
+    elif args.journal:
+        vol.journal = Journal(args.journal)
+    vol.resume = args.resume
+    vol.verify = args.verify
+    vol.savescan = args.save_scan
+    if args.metrics or args.profile:
+        vol.metrics = Metrics(args.metrics, args.profile)
+    if args.status_socket:
+        vol.status = output.status = serve_status(args.status_socket, namespace='maxpacker')
+    vol.loadscan = args.load_scan
+    if args.queue:
+        vol.queue = WorkQueue(args.queue)
+        vol.queue.lease = args.lease
+        vol.workers = args.queue_workers
+    if args.index_format:
+        vol.indexformat = args.index_format
+    elif re.search(r'\.jsonl(\.gz|\.zst)?$', args.index):
+        vol.indexformat = 'jsonl'
+    if args.chunk_size:
+        vol.chunksize = human2bytes(args.chunk_size)
+    if args.memory_budget:
+        if args.chunk_size:
+            parser.error('--memory-budget does not support --chunk-size')
+        vol.store = packer.store = TableStore(human2bytes(args.memory_budget))
 
-    vol.run(pathlist, basedir)
+    try:
+        vol.run(pathlist, basedir)
+    except (ArchiveError, ValueError) as ex:
+        logging.error(str(ex))
+        return 1
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+'''
+Statistics of the files in some paths: counts, size and modification time
+distributions, file types, and optionally the partitions maxpacker would
+create with the given -s, --maxfilenum, --group or -p settings.
+The tree is walked once with the scanner of maxpacker, stat'ing each entry
+once, and the distributions are aggregated on the fly, so memory use doesn't
+grow with the number of files. The file lists of the plan are kept in
+temporary files within --memory-budget.
+'''
+
 import os
 import sys
+import math
 import time
-import statistics
+import argparse
 import collections
 
-_ig0 = lambda x: x[0]
-_ig1 = lambda x: x[1]
+import maxpacker
+from maxpacker import sizeof_fmt
 
 def timestring(seconds):
     m, s = divmod(seconds, 60)
@@ -16,85 +27,300 @@ def timestring(seconds):
     d, h = divmod(h, 24)
     return ('%dd' % d if d else '') + ('%dh' % h if h else '') + ('%dm' % m if m else '') + ('%ds' % s if s else '')
 
+def timefmt(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(t))
+
+class TDigest:
+    '''
+    Estimates quantiles of a stream of numbers in bounded memory,
+    with a merging t-digest of about `compression` centroids.
+    Centroids near the tails are kept small, so the extreme quantiles
+    are more accurate than the middle ones.
+    '''
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, x):
+        self.buffer.append(x)
+        if len(self.buffer) >= self.compression * 10:
+            self.merge()
+
+    def scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0), 1) - 1)
+
+    def merge(self):
+        if not self.buffer:
+            return
+        self.min = min(self.min, min(self.buffer))
+        self.max = max(self.max, max(self.buffer))
+        points = sorted(list(zip(self.means, self.weights)) + [(x, 1) for x in self.buffer])
+        self.buffer = []
+        total = sum(w for m, w in points)
+        means, weights = [], []
+        cum = 0
+        mean, weight = points[0]
+        for x, w in points[1:]:
+            if self.scale((cum + weight + w) / total) - self.scale(cum / total) <= 1:
+                weight += w
+                mean += (x - mean) * w / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                cum += weight
+                mean, weight = x, w
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        '''
+        Returns the estimated `q` quantile (0 <= q <= 1), or None if empty.
+        '''
+        self.merge()
+        if not self.means:
+            return None
+        total = sum(self.weights)
+        target = q * total
+        cum = 0
+        # interpolate between the centers of the centroids
+        prevcenter, prevmean = 0, self.min
+        for mean, weight in zip(self.means, self.weights):
+            center = cum + weight / 2
+            if target < center:
+                return prevmean + (mean - prevmean) * (target - prevcenter) / (center - prevcenter)
+            prevcenter, prevmean = center, mean
+            cum += weight
+        if total > prevcenter:
+            return prevmean + (self.max - prevmean) * (target - prevcenter) / (total - prevcenter)
+        return self.max
+
+class Distribution:
+    '''
+    Count, sum, min, max, mean and standard deviation (Welford's method)
+    of a stream of numbers, and the quantiles from a `TDigest`.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0
+        self.m2 = 0
+        self.digest = TDigest()
+
+    def add(self, x):
+        self.count += 1
+        self.total += x
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.digest.add(x)
+
+    def pstdev(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0
+
+    def quantile(self, q):
+        return self.digest.quantile(q)
+
+class LogHistogram:
+    '''
+    Counts and sums of sizes in power-of-2 buckets:
+    bucket k holds the sizes in [2**(k-1), 2**k), and bucket 0 the zeros.
+    '''
 
-def sizeof_fmt(num, suffix='B'):
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
-
-
-def scanpaths(paths):
-    for path in paths:
-        yield path
-        if os.path.isdir(path):
-            for root, dirs, files in os.walk(path):
-                for name in files:
-                    yield os.path.join(root, name)
-                for name in dirs:
-                    yield os.path.join(root, name)
-
-def stat(paths):
-    # [file, dir, link, mount, error]
-    nums = [0, 0, 0, 0, 0]
-    # file size distribution
-    filesize = []
-    # file type by extension, count by number
-    filetypec = collections.Counter()
-    # file type by extension, count by size
-    filetypes = collections.Counter()
-    # file modification time distribution
-    filetime = []
-    for path in scanpaths(paths):
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.sums = collections.Counter()
+
+    def add(self, size):
+        k = size.bit_length()
+        self.counts[k] += 1
+        self.sums[k] += size
+
+    def lines(self, width=30):
+        if not self.counts:
+            return
+        count = sum(self.counts.values())
+        total = sum(self.sums.values()) or 1
+        peak = max(self.counts.values())
+        for k in range(min(self.counts), max(self.counts) + 1):
+            label = '0' if k == 0 else '%s-%s' % (sizeof_fmt(1 << (k - 1)), sizeof_fmt(1 << k))
+            yield ' %-20s %9d %6.2f%% %6.2f%% %s' % (
+                label, self.counts[k], self.counts[k] / count * 100,
+                self.sums[k] / total * 100, '#' * round(self.counts[k] / peak * width))
+
+class TreeStats:
+    '''
+    Aggregates the entries of a directory tree. If `filelist` is given,
+    the files are also appended to it as maxpacker would scan them.
+    '''
+
+    def __init__(self, filelist=None, prefix='.'):
+        # [file, dir, link, mount, error]
+        self.nums = [0, 0, 0, 0, 0]
+        self.sizes = Distribution()
+        self.mtimes = Distribution()
+        self.histogram = LogHistogram()
+        # file type by extension, count by number and by size
+        self.filetypec = collections.Counter()
+        self.filetypes = collections.Counter()
+        self.filelist = filelist
+        self.prefix = prefix
+
+    def addfile(self, path, st, isfile=True):
+        # special files (fifos, sockets, devices) are only packed
+        if isfile:
+            self.nums[0] += 1
+            root, ext = os.path.splitext(path)
+            self.filetypec[ext] += 1
+            self.filetypes[ext] += st.st_size
+            self.sizes.add(st.st_size)
+            self.mtimes.add(st.st_mtime)
+            self.histogram.add(st.st_size)
+        if self.filelist is not None:
+            size = maxpacker.allocsize(path, st)
+            self.filelist.append((os.path.relpath(path, self.prefix), size, size), st.st_mtime)
+
+    def adddir(self, path, st, empty):
+        self.nums[1] += 1
+        if empty and self.filelist is not None:
+            self.filelist.append((os.path.relpath(path + '/', self.prefix), 0, 0), st.st_mtime)
+
+    def scan(self, path):
         try:
-            isfile = os.path.isfile(path)
-            nums[0] += isfile
-            nums[1] += os.path.isdir(path)
-            nums[2] += os.path.islink(path)
-            nums[3] += os.path.ismount(path)
-            if isfile:
-                root, ext = os.path.splitext(path)
-                filetypec[ext] += 1
-                filetime.append(os.path.getmtime(path))
-                fsize = os.path.getsize(path)
-                filesize.append(fsize)
-                filetypes[ext] += fsize
-        except Exception:
-            nums[4] += 1
-    return nums, filesize, filetypec, filetypes, filetime
-
-def output(nums, filesize, filetypec, filetypes, filetime):
-    fsum = sum(filesize)
-    print(('%s. %s' % (', '.join('%d %s' % vals for vals in filter(_ig1, zip(nums, ('files', 'directories', 'links', 'mount points', 'errors')))), '%s data.' % sizeof_fmt(fsum))).lstrip('. '))
-    if not filesize:
-        return
-    if len(filesize) > 2:
-        favg = fsum / len(filesize)
-        stdev = statistics.pstdev(filesize, favg)
-        print('File size: max %s, mean %s, median %s, stdev %s' % tuple(map(sizeof_fmt, (max(filesize), favg, statistics.median(filesize), stdev))))
-        print(' µ+σ (68%): ' + sizeof_fmt(favg + stdev) +
-              ', µ+2σ (95%): ' + sizeof_fmt(favg + stdev * 2))
+            st = os.stat(path)
+            self.nums[2] += os.path.islink(path)
+            self.nums[3] += os.path.ismount(path)
+            if not os.path.isdir(path):
+                self.addfile(path, st, os.path.isfile(path))
+                return
+        except OSError:
+            self.nums[4] += 1
+            return
+        self.nums[1] += 1
+        # (path, device) of the directories above the current entry
+        parents = [(path, st.st_dev)]
+        for entry, empty in maxpacker.scantree(path, self.onerror):
+            try:
+                if entry.is_symlink():
+                    self.nums[2] += 1
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        # broken link
+                        continue
+                    if empty is None:
+                        self.addfile(entry.path, st, entry.is_file())
+                    else:
+                        self.adddir(entry.path, st, empty)
+                elif empty is None:
+                    self.addfile(entry.path, entry.stat(), entry.is_file())
+                else:
+                    st = entry.stat()
+                    parent = os.path.dirname(entry.path)
+                    while parents[-1][0] != parent:
+                        parents.pop()
+                    self.nums[3] += st.st_dev != parents[-1][1]
+                    parents.append((entry.path, st.st_dev))
+                    self.adddir(entry.path, st, empty)
+            except OSError:
+                self.nums[4] += 1
+
+    def onerror(self, ex):
+        self.nums[4] += 1
+
+    def output(self, top=5):
+        print(('%s. %s' % (', '.join('%d %s' % vals for vals in zip(self.nums, ('files', 'directories', 'links', 'mount points', 'errors'))), '%s data.' % sizeof_fmt(self.sizes.total))).lstrip('. '))
+        sizes, mtimes = self.sizes, self.mtimes
+        if sizes.count < 3:
+            return
+        stdev = sizes.pstdev()
+        print('File size: max %s, mean %s, median %s, stdev %s' % tuple(map(sizeof_fmt, (sizes.max, sizes.mean, sizes.quantile(0.5), stdev))))
+        print(' µ+σ (68%): ' + sizeof_fmt(sizes.mean + stdev) +
+              ', µ+2σ (95%): ' + sizeof_fmt(sizes.mean + stdev * 2))
+        print(' quantiles: ' + ', '.join('%g%% %s' % (q * 100, sizeof_fmt(sizes.quantile(q))) for q in (0.1, 0.25, 0.75, 0.9, 0.99, 0.999)))
+        print('File size histogram:          files          bytes')
+        for line in self.histogram.lines():
+            print(line)
         print('Modification time:')
-        print(' min    ' + time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(min(filetime))))
-        print(' max    ' + time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(max(filetime))))
-        tavg = statistics.mean(filetime)
-        print(' mean   ' + time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(tavg)))
-        print(' median ' + time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(statistics.median(filetime))))
-        print(' stdev  ' + timestring(statistics.pstdev(filetime, tavg)))
-        print('File type by number:')
-        mcomm = filetypec.most_common(5)
-        count = sum(filetypec.values())
-        print('\n'.join(' % 6s: %.2f%%' % (k or '<N/A>', v/count*100) for k, v in mcomm))
-        print(' Others: %.2f%%' % ((count - sum(v for k, v in mcomm)) / count * 100))
-        print('File type by size:')
-        mcomm = filetypes.most_common(5)
-        count = sum(filetypes.values())
-        print('\n'.join(' % 6s: %.2f%%' % (k or '<N/A>', v/count*100) for k, v in mcomm))
-        print(' Others: %.2f%%' % ((count - sum(v for k, v in mcomm)) / count * 100))
+        print(' min    ' + timefmt(mtimes.min))
+        print(' max    ' + timefmt(mtimes.max))
+        print(' mean   ' + timefmt(mtimes.mean))
+        print(' median ' + timefmt(mtimes.quantile(0.5)))
+        print(' stdev  ' + timestring(mtimes.pstdev()))
+        for title, counter in (('number', self.filetypec), ('size', self.filetypes)):
+            print('File type by %s:' % title)
+            mcomm = counter.most_common(top)
+            count = sum(counter.values()) or 1
+            print('\n'.join(' % 6s: %.2f%%' % (k or '<N/A>', v/count*100) for k, v in mcomm))
+            print(' Others: %.2f%%' % ((count - sum(v for k, v in mcomm)) / count * 100))
+
+def plan(filelist, packer, listparts=False):
+    '''
+    Prints the partitions the packer would create from `filelist`,
+    without compressed size estimation (as with -f tar or copy).
+    '''
+    parts = packer.dispatch(filelist)
+    sizes = Distribution()
+    counts = Distribution()
+    for pn, part in enumerate(parts):
+        sizes.add(part.size)
+        counts.add(len(part))
+        if listparts:
+            print(' %03d: %d files, %s' % (pn, len(part), sizeof_fmt(part.size)))
+    print('Plan: %d partitions of %d files, %s.' % (len(parts), counts.total, sizeof_fmt(sizes.total)))
+    if parts:
+        print(' Partition size: min %s, median %s, max %s' % tuple(map(sizeof_fmt, (sizes.min, sizes.quantile(0.5), sizes.max))))
+        print(' Files per partition: min %d, median %d, max %d' % (counts.min, round(counts.quantile(0.5)), counts.max))
 
 def main():
-    output(*stat(sys.argv[1:]))
+    parser = argparse.ArgumentParser(description="Show statistics of the files in the paths, and the partitions maxpacker would create.")
+    parser.add_argument("-t", "--top", help="number of file types to show (Default: 5)", type=int, default=5)
+    group = parser.add_argument_group('Plan', 'show the partitions maxpacker would create with these options, by the original file sizes')
+    group.add_argument("-s", "--maxpartsize", help="max partition size", metavar='SIZE')
+    group.add_argument("--maxfilenum", help="max file number per partition", type=int, default=0, metavar='NUM')
+    group.add_argument("--group", help="pack similar files together (only for -s, --maxfilenum)", action='store_true')
+    group.add_argument("-p", "--part", help="partition number (overrides: -s, --maxfilenum)", type=int, metavar='NUM')
+    group.add_argument("-r", "--root", help="relative path root (Default: the longest prefix of all paths)", metavar='DIR')
+    group.add_argument("-l", "--list", help="list each partition", action='store_true')
+    group.add_argument("--memory-budget", help="memory for the file lists, which are kept in temporary files (Default: 64M)", default='64M', metavar='SIZE')
+    parser.add_argument("PATH", nargs='+', help="Paths to analyse")
+    args = parser.parse_args()
+
+    packer = None
+    maxpartsize = maxpacker.human2bytes(args.maxpartsize) if args.maxpartsize else 0
+    if args.part:
+        packer = maxpacker.PartNumberLimitPacker(args.part)
+    elif (maxpartsize or args.maxfilenum) and args.group:
+        packer = maxpacker.GroupLimitPacker(maxpartsize, args.maxfilenum)
+    elif maxpartsize or args.maxfilenum:
+        packer = maxpacker.LimitPacker(maxpartsize, args.maxfilenum)
+
+    store = filelist = None
+    if packer:
+        store = packer.store = maxpacker.TableStore(maxpacker.human2bytes(args.memory_budget))
+        filelist = store.new()
+    stats = TreeStats(filelist, args.root or maxpacker.basepath(args.PATH))
+    try:
+        for path in args.PATH:
+            stats.scan(path)
+        stats.output(args.top)
+        if packer:
+            plan(filelist, packer, args.list)
+    finally:
+        if store:
+            store.close()
 
 if __name__ == '__main__':
     main()
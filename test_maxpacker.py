@@ -0,0 +1,152 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import maxpacker
+
+
+def makesparse(filename, size, data=b'data' * 1024, offset=1 << 20):
+    '''
+    Creates a file of `size` bytes with `data` at `offset` and holes around it.
+    '''
+    with open(filename, 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate(size)
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='maxpacker-test-')
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.src)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class SparseReaderTest(TempDirTestCase):
+
+    def test_read_all(self):
+        fn = os.path.join(self.src, 'sparse.bin')
+        makesparse(fn, 4 << 20)
+        with open(fn, 'rb') as f:
+            extents = [(1 << 20, 4096)]
+            reader = maxpacker.SparseReader(f, b'map', extents)
+            self.assertEqual(reader.read(), b'map' + b'data' * 1024)
+            self.assertEqual(reader.read(), b'')
+
+    def test_read_rest(self):
+        fn = os.path.join(self.src, 'sparse.bin')
+        makesparse(fn, 4 << 20)
+        with open(fn, 'rb') as f:
+            reader = maxpacker.SparseReader(f, b'map', [(1 << 20, 4096)])
+            self.assertEqual(reader.read(5), b'mapda')
+            self.assertEqual(reader.read(-1), b'ta' + b'data' * 1023)
+
+
+class SparseChecksumTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sparse = os.path.join(self.src, 'sparse.bin')
+        makesparse(self.sparse, 30 << 20, offset=10 << 20)
+        if not maxpacker.issparse(os.stat(self.sparse)):
+            self.skipTest('no sparse files on ' + self.tmpdir)
+        with open(os.path.join(self.src, 'a.txt'), 'w') as f:
+            f.write('hello\n')
+
+    def run_maxpacker(self, *args):
+        out = os.path.join(self.tmpdir, 'out')
+        os.makedirs(out, exist_ok=True)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maxpacker.py')
+        return subprocess.run([sys.executable, script, '-o', out, '-i', os.path.join(self.tmpdir, 'index.txt'),
+                               '--verify'] + list(args) + [self.src],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    def test_digest(self):
+        with open(self.sparse, 'rb') as f:
+            expected = maxpacker.newhash('blake2b')
+            expected.update(f.read())
+        hasher = maxpacker.newhash('blake2b')
+        maxpacker.copysparse(self.sparse, os.path.join(self.tmpdir, 'copy.bin'), hasher=hasher)
+        self.assertEqual(hasher.digest(), expected.digest())
+
+    def test_verify_tar(self):
+        proc = self.run_maxpacker('-f', 'tar', '-s', '200K')
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertIn('Verified 2 files', proc.stdout)
+
+    def test_verify_copy(self):
+        proc = self.run_maxpacker('-f', 'copy', '-s', '200K')
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertIn('Verified 2 files', proc.stdout)
+
+    def test_verify_py7zr(self):
+        try:
+            import py7zr
+        except ImportError:
+            self.skipTest('needs py7zr')
+        proc = self.run_maxpacker('-f', '7z', '--p7z-backend', 'py7zr', '-s', '200K')
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertIn('Verified 2 files', proc.stdout)
+
+
+class SplitFilesTest(TempDirTestCase):
+
+    def split(self, filelist):
+        vol = maxpacker.Volume(maxpacker.LimitPacker(1 << 20), indexfile=None)
+        vol.chunksize = 4096
+        return list(vol.splitfiles(filelist, self.src))
+
+    def test_chunks(self):
+        with open(os.path.join(self.src, 'big.bin'), 'wb') as f:
+            f.write(b'x' * 10000)
+        chunks = self.split([('big.bin', 10000, 10000), ('small', 10, 10)])
+        self.assertEqual([fn for fn, size, estsize in chunks], ['big.bin.001', 'big.bin.002', 'big.bin.003', 'small'])
+        self.assertEqual([(fn.offset, fn.length) for fn, size, estsize in chunks[:3]], [(0, 4096), (4096, 4096), (8192, 1808)])
+
+    def test_collision(self):
+        with open(os.path.join(self.src, 'big.bin'), 'wb') as f:
+            f.write(b'x' * 10000)
+        with self.assertRaises(ValueError):
+            self.split([('big.bin', 10000, 10000), ('big.bin.002', 10, 10)])
+        # a directory of the same name
+        with self.assertRaises(ValueError):
+            self.split([('big.bin', 10000, 10000), (os.path.join('big.bin.001', 'f'), 10, 10)])
+
+
+class OutputOffsetsTest(TempDirTestCase):
+
+    def write(self, output):
+        output.progressbar = maxpacker.NoopETA
+        part = maxpacker.Partition()
+        for fn in ('a.txt', 'gone.txt', 'b.txt'):
+            part.addfile(fn, 6, 6)
+        for fn in ('a.txt', 'b.txt'):
+            with open(os.path.join(self.src, fn), 'w') as f:
+                f.write('hello\n')
+        with self.assertLogs(level='ERROR'):
+            output.output([part])
+        return output
+
+    def test_tar(self):
+        import tarfile
+        output = self.write(maxpacker.OutputTar(self.src, self.tmpdir))
+        self.assertEqual(sorted(output.offsets), ['a.txt', 'b.txt'])
+        with open(os.path.join(self.tmpdir, '000.tar'), 'rb') as f:
+            f.seek(output.offsets['b.txt'])
+            with tarfile.open(fileobj=f, mode='r:') as tar:
+                self.assertEqual(tar.next().name, 'b.txt')
+
+    def test_zip(self):
+        output = self.write(maxpacker.OutputZip(self.src, self.tmpdir))
+        self.assertEqual(sorted(output.offsets), ['a.txt', 'b.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()